@@ -1,14 +1,19 @@
-import csv
 import frappe
-from io import StringIO
 import json
+from itertools import chain, islice
 from frappe import _
-from frappe.utils import nowdate
+from frappe.utils import sbool
 from frappe.utils.background_jobs import enqueue
-from frappe.utils.file_manager import save_file
 from erpnext_my_app.parser.utils import *
 from erpnext_my_app.parser.order_importer import OrderImporter
-from erpnext_my_app.parser.delivery_importer import DeliveryImporter
+from erpnext_my_app.parser.customer_index import partition_by_buyer
+from erpnext_my_app.parser.delivery_importer import DeliveryImporter, partition_by_delivery_note
+from erpnext_my_app.parser.delivery_exporter import DeliveryExporter
+from erpnext_my_app.parser.shipment_exporter import ShipmentExporter
+from erpnext_my_app.parser.sharded_job import ShardedJob, merge_results
+from erpnext_my_app.parser.checkpoint import ExportWatermark, ImportCheckpoint
+from erpnext_my_app.parser.progress import ProgressReporter
+from erpnext_my_app.parser.instrumentation import StageTimer
 
 logger = frappe.logger("erpnext_my_app")
 
@@ -17,16 +22,51 @@ logger = frappe.logger("erpnext_my_app")
 def hello():
     return {"message": "Hello, World!"}
 
-def import_orders_task(file_url: str, platform: str = "amazon", user: str = "Administrator"):
+def import_orders_task(file_url: str, platform: str = "amazon", user: str = "Administrator", shard_size: int = IMPORT_SHARD_SIZE):
     logger = frappe.logger("erpnext_my_app")
-    importer = OrderImporter(platform)
-    orders = importer.import_orders(file_url)
+    importer = OrderImporter(platform, progress=ProgressReporter("import_orders_progress", user, platform=platform))
+    # 同一文件再次提交时，从断点处继续解析，已提交的行不再扫描和解析
+    checkpoint = ImportCheckpoint("orders", file_url, "order_id")
+    rows = importer.iter_orders(file_url, checkpoint)
+    # 只预读一个分片多一个订单，判断是否需要拆分
+    orders = list(islice(rows, shard_size + 1))
+
+    if len(orders) > shard_size:
+        # 边解析边按买家分配到通道，通道中凑满一个分片就交给后台任务，不在内存中保留整个文件；
+        # 同一买家的订单在同一通道中依次执行，避免两个分片同时为同一个新买家创建客户、地址和联系人
+        job = ShardedJob("import_orders_completed", user)
+        job.set_checkpoint(checkpoint.key)
+        shard_count = 0
+        buckets = {}
+        for lane, shard in partition_by_buyer(chain(orders, rows), shard_size, buckets=buckets):
+            job.enqueue_lane_shard(import_orders_shard_task, lane, shard_count, orders=shard, platform=platform)
+            # 已交给分片任务的订单不再重新解析：断点推进到尚未分配的订单之前
+            checkpoint.dispatch(shard, buckets)
+            shard_count += 1
+        # 解析阶段本身也作为一个分片汇报（订单总数和解析错误）
+        job.finish_shard("parse", {
+            "status": len(importer.errors) > 0 and "error" or "success",
+            "errors": importer.errors,
+            "platform": platform,
+            "order_count": importer.orders_count,
+            "imported_count": 0,
+            "timings": importer.timer.log()
+        })
+        job.set_total(shard_count + 1)
+        logger.info(f"import_orders_task: {importer.orders_count} orders split into {shard_count} shards.")
+        return
+
+    # 订单数量不足一个分片时直接在当前任务中导入
+    orders = importer.create_orders(orders, checkpoint)
+    checkpoint.clear()
+    importer.progress.finish()
     result = {
             "status": len(importer.errors) > 0 and "error" or "success",
             "errors": importer.errors,
             "platform": platform,
             "order_count": importer.orders_count,
-            "imported_count": len(orders)
+            "imported_count": len(orders),
+            "timings": importer.timer.log()
     }
 
     # 主动通知客户端
@@ -36,19 +76,35 @@ def import_orders_task(file_url: str, platform: str = "amazon", user: str = "Adm
         user=user
     )
 
-def export_delivery_notes_to_csv_task(sale_order_ids, carrier: str = "upack", ignore_pending_orders: bool = True, user: str = "Administrator"):
-    """
-    sale_order_ids: 逗号分隔的 Sales Order ID 字符串
-    """
-
-    def safe_date_field(doc, fieldname):
-        val = doc.get(fieldname)
-        return val.strftime("%Y%m%d") if val else ""
-
-    errors = []
-    count = 0
+def import_orders_shard_task(orders, batch_id: str, shard_no: int, platform: str = "amazon", user: str = "Administrator"):
     logger = frappe.logger("erpnext_my_app")
-    #logger.info(f"Calling export_delivery_notes_to_csv with sale_order_ids: {sale_order_ids}")
+    progress = ProgressReporter("import_orders_progress", user, total=len(orders), platform=platform, batch_id=batch_id, shard=shard_no)
+    importer = OrderImporter(platform, progress=progress)
+    created_orders = []
+    try:
+        created_orders = importer.create_orders(orders)
+    except Exception as e:
+        # 分片失败也要汇报结果，否则汇总通知永远不会发出
+        frappe.db.rollback()
+        logger.error(f"import_orders_shard_task: shard {shard_no} of batch {batch_id} failed: {e}")
+        importer.errors.append(f"分片 {shard_no} 导入失败：{e}<br>")
+        created_orders = []
+        ShardedJob("import_orders_completed", user, batch_id).clear_checkpoint()
+    progress.finish()
+
+    ShardedJob("import_orders_completed", user, batch_id).finish_shard(shard_no, {
+        "status": len(importer.errors) > 0 and "error" or "success",
+        "errors": importer.errors,
+        "platform": platform,
+        "imported_count": len(created_orders),
+        "timings": importer.timer.log()
+    })
+
+def get_sales_order_pages(sale_order_ids=None, filters=None):
+    """Return the pages of Sales Order IDs to export and their count, selected by filters when given."""
+    if filters:
+        filters = get_sales_order_filters(filters)
+        return iter_sales_order_pages(filters), frappe.db.count("Sales Order", filters)
 
     if isinstance(sale_order_ids, str):
         try:
@@ -56,189 +112,47 @@ def export_delivery_notes_to_csv_task(sale_order_ids, carrier: str = "upack", ig
             sale_order_ids = json.loads(sale_order_ids)
         except Exception:
             sale_order_ids = sale_order_ids.strip("[]").replace('"', '').split(",")  # 保底 fallback
+    sale_order_ids = sale_order_ids or []
+    return [sale_order_ids], len(sale_order_ids)
 
-    output = StringIO()
-    writer = None
-    if carrier == "fukutsu":
-        writer = csv.writer(output, quoting=csv.QUOTE_ALL)
-        writer.writerow([
-            "荷受人コード", "電話番号",
-            "住所１", "住所２", "住所３", "名前１", "名前２", "郵便番号", "特殊計", 
-            "着店コード", "荷送人コード","荷送担当者",
-            "個数", "才数", "重量", "輸送商品１", "輸送商品２", "品名記事１", "品名記事２", "品名記事３", "品名記事４", "品名記事５", "品名記事６",
-            "配達指定日", "必着区分", "お客様管理番号", "元払区分", "保険金額", "出荷日付", "登録日付"
-        ])
-    else:
-        writer = csv.writer(output)
-        writer.writerow([
-            "发货ID", "亚马逊订单号",
-            "客户名称", "客户电话", "收货人名称", "收货人电话",
-            "收货地址明细", "收货城市", "收货省份", "收货邮编",
-            "商品名称", "商品数量",
-            "发货名称", "发货电话",
-            "发货地址明细", "发货城市", "发货省份", "发货邮编",
-            "指定配送日期", "指定配送时间"
-        ])
-
-    for so_id in sale_order_ids:
-        so = frappe.get_doc("Sales Order", so_id)
-        parent_names = frappe.get_all(
-            "Delivery Note Item",
-            filters={"against_sales_order": so_id},
-            pluck="parent",
-            distinct=True
-        )
-        # 第二步：只保留已提交状态的 Delivery Note
-        dn_names = frappe.get_all(
-            "Delivery Note",
-            filters={
-                "docstatus": 1,
-                "is_return": 0,  # ✅ 排除退货
-                "status": ["not in", ["Return", "Return Issued"]],  # 排除退货和已发货的状态
-                "name": ["in", parent_names]
-            },
-            pluck="name"
-        )
-        
-        if not dn_names and ignore_pending_orders:
-            logger.error(f"export_delivery_notes_to_csv: No Delivery Notes found for Sales Order {so_id}.")
-            errors.append(f"销售订单没有关联的发货单: {so_id}<br>")
-            continue
-
-        
-        item_names = ""
-        item_counts = 0
-        item_names_list = []
-        customer_name = ""
-        customer_phone = ""
-        contact = ""
-        shipping_address_name = so.shipping_address_name or so.customer_address
-        shipping_address = frappe.get_doc("Address", shipping_address_name)
-        company = frappe.get_doc("Company", so.company)
-        amazon_order_id = so.amazon_order_id or ""
-        now = nowdate().replace("-", "") 
-        delivery_date = so.delivery_date.strftime("%Y%m%d")
-        my_delivery_date = safe_date_field(so, "my_delivery_date")  # 获取自定义的交货日期字段
-        #delivery_date = delivery_date if delivery_date >= now else now  # 确保交货日期不早于今天
-        delivery_date = now
-        
-        count += 1
-        if dn_names:
-            for dn_name in dn_names:
-                dn = frappe.get_doc("Delivery Note", dn_name)
-                # 忽略未提交的发货单
-                if dn.docstatus != 1:
-                    errors.append(f"忽略非提交状态的出货单：{dn_name}<br>")
-                    continue
-                #for field, value in dn.as_dict().items():
-                #    print(f"{field}: {value}")
-
-                customer_name = frappe.db.get_value("Customer", dn.customer, "customer_name") or ""
-                customer_phone = frappe.db.get_value("Customer", dn.customer, "mobile_no") or ""
-                contact = frappe.db.get_value("Contact", dn.contact_person, "first_name") or customer_name
-
-
-                # 如果是线下客户群组的订单，则联系人不填 
-                if so.customer_group == "线下":
-                    contact = ""
-                    
-                # 获取商品名称和数量
-                item_names = ""
-                item_counts = 0
-                item_names_list = []
-                for item in dn.get("items", []):
-                    item_names_list.append(item.item_name + "*" + str(item.qty))
-                    item_names = item_names + " " + item.item_name + "*" + str(item.qty)
-                    item_counts = item_counts  + item.qty
-                if len(item_names_list) < 6:
-                    item_names_list.extend([""] * (6 - len(item_names_list)))  # 填充到 6 个空位
-                item_names_list[3] = "われもの注意"
-                item_names_list[4] = dn.name  # 将发货单名称放在第五个位置
-                item_names_list[5] = amazon_order_id  # 将亚马逊订单号放在第六个位置
-
-                if carrier == "fukutsu":
-                    writer.writerow([
-                        "", shipping_address.get_formatted("phone") or customer_phone or "0896-22-4988",
-                        shipping_address.get_formatted("address_line1"), shipping_address.get_formatted("city"), shipping_address.get_formatted("state"), customer_name, contact, shipping_address.get_formatted("pincode"), 0, 
-                        "", "1896224988", "",
-                        1, "", "", "", "", item_names_list[0], item_names_list[1], item_names_list[2], item_names_list[3], item_names_list[4], item_names_list[5],
-                        my_delivery_date, "", "", 1, 0, int(delivery_date), ""
-                    ])
-                else:
-                    writer.writerow([
-                        dn.name, amazon_order_id,
-                        customer_name, customer_phone, contact, shipping_address.get_formatted("phone") or "0896-22-4988",
-                        shipping_address.get_formatted("address_line1"), shipping_address.get_formatted("city"), shipping_address.get_formatted("state"), shipping_address.get_formatted("pincode"),
-                        item_names, int(item_counts),
-                        company.get_formatted("company_name"), "0896-22-4988",
-                        "土居町津根2840", "四国中央市", "爱媛県", "799-0704",
-                        my_delivery_date, ""
-                    ])
+def export_delivery_notes_to_csv_task(sale_order_ids=None, carrier: str = "upack", ignore_pending_orders: bool = True, user: str = "Administrator", incremental: bool = False, filters=None):
+    """
+    sale_order_ids: 逗号分隔的 Sales Order ID 字符串
+    incremental: 忽略 sale_order_ids，只导出上次导出之后新提交的发货单
+                 （第一次增量导出从 filters.from_date 开始，没有 from_date 时只记录水位）
+    filters: 代替 sale_order_ids 的筛选条件 {from_date, to_date, customer_group, platform, status}
+    """
+    logger = frappe.logger("erpnext_my_app")
+    #logger.info(f"Calling export_delivery_notes_to_csv with sale_order_ids: {sale_order_ids}")
 
+    progress = ProgressReporter("export_delivery_progress", user, carrier=carrier)
+    exporter = DeliveryExporter(carrier, ignore_pending_orders, progress=progress)
+    watermark = None
+    with exporter.timer.stage("select"):
+        if sbool(incremental):
+            watermark = ExportWatermark("delivery_notes", carrier)
+            from_date = frappe._dict(json.loads(filters) if isinstance(filters, str) else filters or {}).from_date
+            sale_order_ids = exporter.select_since(watermark.value, from_date)
+            pages, order_count = [sale_order_ids], len(sale_order_ids)
         else:
-            # 如果没有找到发货单，则将订单中的所有商品作为一个包裹来打印面单
-            customer_name = frappe.db.get_value("Customer", so.customer, "customer_name") or ""
-            customer_phone = frappe.db.get_value("Customer", so.customer, "mobile_no") or ""
-            contact = frappe.db.get_value("Contact", so.contact_person, "first_name") or customer_name
-
-            # 如果是线下客户群组的订单，则联系人不填 
-            if so.customer_group == "线下":
-                contact = ""
-
-            # 获取商品名称和数量
-            item_names = ""
-            item_counts = 0
-            item_names_list = []
-            for item in so.items:
-                item_names_list.append(item.item_name + "*" + str(item.qty))
-                item_names = item_names + " " + item.item_name + "*" + str(item.qty)
-                item_counts = item_counts  + item.qty
-            if len(item_names_list) < 6:
-                item_names_list.extend([""] * (6 - len(item_names_list)))  # 填充到 6 个空位
-                item_names_list[5] = amazon_order_id  # 将亚马逊订单号放在第六个位置
-
-            if carrier == "fukutsu":
-                writer.writerow([
-                    "", shipping_address.get_formatted("phone") or customer_phone or "0896-22-4988",
-                    shipping_address.get_formatted("address_line1"), shipping_address.get_formatted("city"), shipping_address.get_formatted("state"), customer_name, contact, shipping_address.get_formatted("pincode"), 0, 
-                    "", "1896224988", "",
-                    1, "", "", "", "", item_names_list[0], item_names_list[1], item_names_list[2], item_names_list[3], item_names_list[4], item_names_list[5],
-                    my_delivery_date, "", "", 1, 0, int(delivery_date), ""
-                ])
-            else:
-                writer.writerow([
-                    "", amazon_order_id,
-                    customer_name, customer_phone, contact, shipping_address.get_formatted("phone") or "0896-22-4988",
-                    shipping_address.get_formatted("address_line1"), shipping_address.get_formatted("city"), shipping_address.get_formatted("state"), shipping_address.get_formatted("pincode"),
-                    item_names, int(item_counts),
-                    company.get_formatted("company_name"), "0896-22-4988",
-                    "土居町津根2840", "四国中央市", "爱媛県", "799-0704",
-                    my_delivery_date, ""
-                ])
-
-    # 保存为 Frappe 文件
-    filename = "delivery_export.csv"
-    file_content = output.getvalue()
-    #print(file_content)  # 读取并解码为字符串打印
-    output.close()
-
-    file_doc = None
-    if carrier == "fukutsu":
-        file_doc = save_file(filename, file_content.encode("cp932", errors="replace"), None, "", is_private=0)
-    else:
-        # 使用 UTF-8 编码保存文件
-        # 由于 CSV 文件可能包含非 ASCII 字符，建议使用 UTF-8 编码
-        # 但如果需要兼容某些系统，可以使用 shift_jis 编码
-        # 这里暂时使用 shift_jis 编码，后续可以根据实际需求调整
-        # 例如：file_doc = save_file(filename, file_content.encode("utf-8"), None, "", is_private=0)
-        file_doc = save_file(filename, file_content.encode("utf-8"), None, "", is_private=0)
+            pages, order_count = get_sales_order_pages(sale_order_ids, filters)
+
+    file_url = None
+    if order_count:
+        progress.total = order_count
+        file_doc = exporter.export(pages=pages)
+        file_url = file_doc.file_url
+    if watermark and exporter.watermark:
+        watermark.save(exporter.watermark)
+        logger.info(f"export_delivery_notes_to_csv: {carrier} watermark moved to {exporter.watermark['creation']} {exporter.watermark['name']}.")
     result = {
             "status": "success",
-            "order_count": len(sale_order_ids),
-            "imported_count": count,
+            "order_count": order_count,
+            "imported_count": exporter.count,
             "carrier": carrier,
-            "file_url": file_doc.file_url,
-            "errors": errors
+            "file_url": file_url,
+            "errors": exporter.errors,
+            "timings": exporter.timer.log()
     }
 
     # 主动通知客户端
@@ -248,16 +162,47 @@ def export_delivery_notes_to_csv_task(sale_order_ids, carrier: str = "upack", ig
         user=user
     )
 
-def import_shipments_from_file_task(file_url: str, carrier: str = "upack", user: str = "Administrator"):
+def import_shipments_from_file_task(file_url: str, carrier: str = "upack", user: str = "Administrator", shard_size: int = IMPORT_SHARD_SIZE):
     logger = frappe.logger("erpnext_my_app")
-    importer = DeliveryImporter(carrier)
-    orders = importer.import_orders(file_url)
+    importer = DeliveryImporter(carrier, progress=ProgressReporter("import_shipments_progress", user, carrier=carrier))
+    # 同一文件再次提交时，从断点处继续解析，已提交的行不再解析
+    checkpoint = ImportCheckpoint("shipments", file_url, "delivery_note_id")
+    rows = importer.iter_orders(file_url, checkpoint)
+    # 只预读一个分片多一条记录，判断是否需要拆分
+    orders = list(islice(rows, shard_size + 1))
+
+    if len(orders) > shard_size:
+        # 边解析边按发货单分配到桶，桶中凑满一个分片就交给后台任务并行创建装运单，不在内存中保留整个文件
+        job = ShardedJob("import_shipments_completed", user)
+        job.set_checkpoint(checkpoint.key)
+        shard_count = 0
+        buckets = {}
+        for shard in partition_by_delivery_note(chain(orders, rows), shard_size, buckets=buckets):
+            job.enqueue_shard(import_shipments_shard_task, shard_count, orders=shard, carrier=carrier)
+            # 已交给分片任务的记录不再重新解析：断点推进到尚未分配的记录之前
+            checkpoint.dispatch(shard, buckets)
+            shard_count += 1
+        job.finish_shard("parse", {
+            "status": len(importer.errors) > 0 and "error" or "success",
+            "errors": importer.errors,
+            "carrier": carrier,
+            "order_count": importer.orders_count,
+            "imported_count": 0,
+            "timings": importer.timer.log()
+        })
+        job.set_total(shard_count + 1)
+        logger.info(f"import_shipments_from_file_task: {importer.orders_count} rows split into {shard_count} shards.")
+        return
+
+    orders = importer.import_orders(file_url, orders, checkpoint)
+    importer.progress.finish()
     result = {
             "status": len(importer.errors) > 0 and "error" or "success",
             "errors": importer.errors,
             "carrier": carrier,
             "order_count": importer.orders_count,
-            "imported_count": len(orders)
+            "imported_count": len(orders),
+            "timings": importer.timer.log()
     }
 
     # 主动通知客户端
@@ -267,119 +212,78 @@ def import_shipments_from_file_task(file_url: str, carrier: str = "upack", user:
         user=user
     )
 
-def export_shipment_to_csv_task(sale_order_ids, platform: str = "amazon", user: str = "Administrator"):
+def import_shipments_shard_task(orders, batch_id: str, shard_no: int, carrier: str = "upack", user: str = "Administrator"):
+    logger = frappe.logger("erpnext_my_app")
+    progress = ProgressReporter("import_shipments_progress", user, total=len(orders), carrier=carrier, batch_id=batch_id, shard=shard_no)
+    importer = DeliveryImporter(carrier, progress=progress, lock_delivery_notes=True)
+    shipments = []
+    try:
+        shipments = importer.create_shipments(orders)
+    except Exception as e:
+        # 分片失败也要汇报结果，否则汇总通知永远不会发出
+        frappe.db.rollback()
+        logger.error(f"import_shipments_shard_task: shard {shard_no} of batch {batch_id} failed: {e}")
+        importer.errors.append(f"分片 {shard_no} 导入失败：{e}<br>")
+        shipments = []
+        ShardedJob("import_shipments_completed", user, batch_id).clear_checkpoint()
+    progress.finish()
+
+    ShardedJob("import_shipments_completed", user, batch_id).finish_shard(shard_no, {
+        "status": len(importer.errors) > 0 and "error" or "success",
+        "errors": importer.errors,
+        "carrier": carrier,
+        "imported_count": len(shipments),
+        "timings": importer.timer.log()
+    })
+
+def export_shipment_to_csv_task(sale_order_ids=None, platform: str = "amazon", user: str = "Administrator", filters=None):
     """
     sale_order_ids: 逗号分隔的 Sales Order ID 字符串
+    filters: 代替 sale_order_ids 的筛选条件 {from_date, to_date, customer_group, platform, status}
     """
     logger = frappe.logger("erpnext_my_app")
     #logger.info(f"Calling export_shipment_to_csv with sale_order_ids: {sale_order_ids}")
 
-    errors = []
-    count = 0
-
-    if isinstance(sale_order_ids, str):
-        try:
-            # 前端有时会把 list 转成 JSON 字符串传过来
-            sale_order_ids = json.loads(sale_order_ids)
-        except Exception:
-            sale_order_ids = sale_order_ids.strip("[]").replace('"', '').split(",")  # 保底 fallback
-
-    output = StringIO()
-    
-    if platform == "amazon":
-        writer = csv.writer(output, delimiter="\t") # 使用制表符分隔符
-        writer.writerow([
-            "TemplateType=OrderFulfillment", "Version=2011.1102", "この行はAmazonが使用しますので変更や削除しないでください。",
-        ])
-        writer.writerow([
-            "注文番号", "注文商品番号", "出荷数","出荷日",
-            "配送業者コード", "配送業者名", "お問い合わせ伝票番号", "配送方法", "代金引換"
-        ])
-
-        for so_id in sale_order_ids:
-            so = frappe.get_doc("Sales Order", so_id)
-            if not so:
-                logger.error(f"export_shipment_to_csv: Sales Order {so_id} not found.")
-                errors.append(f"销售订单未找到: {so_id}<br>")
-                continue
-            if len(so.items) <= 0:
-                logger.error(f"export_shipment_to_csv: Sales Order {so_id} has no items.")
-                errors.append(f"销售订单没有商品: {so_id}<br>")
-                continue
-
-            # 1. 找出关联该销售订单的第一条出货单（一个销售订单可能对应多条销售出货，所以只取一条）
-            parent_names = frappe.get_all(
-                "Delivery Note Item",
-                filters={"against_sales_order": so_id},
-                fields=["parent"],
-                distinct=True
-            )
-            # 第二步：只保留已提交状态的 Delivery Note
-            dn_names = frappe.get_all(
-                "Delivery Note",
-                filters={
-                    "docstatus": 1,
-                    "is_return": 0,  # ✅ 排除退货
-                    "status": ["not in", ["Return", "Return Issued"]],  # 排除退货和已发货的状态
-                    "name": ["in", parent_names]
-                },
-                pluck="name"
-            )
-            if not dn_names:
-                logger.error(f"export_shipment_to_csv: Delivery Note Item for Sales Order {so_id} not found.")
-                errors.append(f"销售订单没有关联的出货单: {so_id}<br>")
-                continue  # 如果没有找到出货单，跳过
-
-            delivery_note_id = dn_names[0]  # 取第一条出货单
-            # 2. 查找该出货单对应的装运单（一个销售出货可能对应多条装运单，所以只取一条）
-            shipment_links = frappe.get_all(
-                "Shipment Delivery Note",
-                filters={"delivery_note": delivery_note_id},
-                fields=["parent"],
-                limit=1
-            )
-            if not shipment_links:
-                logger.error(f"export_shipment_to_csv: Shipment link for Delivery Note {delivery_note_id} not found for Sales Order {so_id}.")
-                errors.append(f"出货单没有关联的装运单: {delivery_note_id} [销售订单： {so_id}]<br>")
-                continue  # 如果没有找到出货单，跳过
-
-            shipment_id = shipment_links[0]["parent"]
-            # 3. 获取装运单的详细信息
-            shipment_doc = frappe.get_doc("Shipment", shipment_id)
-            if not shipment_doc:
-                logger.error(f"export_shipment_to_csv: Shipment document {shipment_id} not found for Sales Order {so_id}.") 
-                errors.append(f"装运单文档未找到: {shipment_id} [销售订单： {so_id}， 出货单： {delivery_note_id}]<br>")
-                continue  # 如果没有找到装运单，跳过
-            
-            # 4. 将装运单信息输出到文件中
-            count += 1
-            writer.writerow([
-                so.amazon_order_id or "",  # 亚马逊订单号
-                so.items[0].additional_notes,  # 商品 ASIN
-                sum(parcel.count for parcel in shipment_doc.shipment_parcel),
-                shipment_doc.pickup_date or "",  # 出货日期
-                get_carrier_code(shipment_doc.carrier),  # 配送業者コード
-                "",  # 配送业者名称
-                shipment_doc.awb_number or "",  # 查询号码
-                get_shipment_method(shipment_doc.carrier),  # 配送方法
-                ""
-            ])  # 空行
-
-    # 保存为 Frappe 文件
-    filename = "shipment_export.csv"
-    file_content = output.getvalue()
-    print(file_content)  # 读取并解码为字符串打印
-    output.close()
-
-    file_doc = save_file(filename, file_content.encode("shift_jis", errors="replace"), None, "", is_private=0)
-    #file_doc = save_file(filename, file_content.encode("utf-8"), None, "", is_private=0)
+    timer = StageTimer(f"export_shipment_to_csv {platform}")
+    with timer.stage("select"):
+        pages, order_count = get_sales_order_pages(sale_order_ids, filters)
+
+    if platform == "amazon" and filters and order_count > SHIPMENT_EXPORT_CHUNK_SIZE:
+        # 按条件导出的订单较多时，按主键范围分成小块由多个后台任务并行渲染，
+        # 全部完成后按顺序拼接并按大小上限拆分成文件；后台任务只携带筛选条件和主键范围
+        job = ShardedJob("export_shipments_completed", user)
+        job.set_finalizer("erpnext_my_app.api.assemble_shipment_parts")
+        shard_count = 0
+        with timer.stage("select"):
+            bounds = list(iter_sales_order_bounds(get_sales_order_filters(filters), SHIPMENT_EXPORT_CHUNK_SIZE))
+        for after, last in bounds:
+            job.enqueue_shard(export_shipment_shard_task, shard_count, filters=filters, after=after, last=last, platform=platform)
+            shard_count += 1
+        job.finish_shard("select", {
+            "status": "success",
+            "errors": [],
+            "platform": platform,
+            "order_count": order_count,
+            "imported_count": 0,
+            "part_paths": [],
+            "timings": timer.log()
+        })
+        job.set_total(shard_count + 1)
+        logger.info(f"export_shipment_to_csv: {order_count} orders split into {shard_count} shards.")
+        return
+
+    progress = ProgressReporter("export_shipments_progress", user, total=order_count, platform=platform)
+    exporter = ShipmentExporter(platform, progress=progress, timer=timer)
+    files = exporter.export(pages=pages)
     result = {
             "status": "success",
-            "order_count": len(sale_order_ids),
-            "imported_count": count,
+            "order_count": order_count,
+            "imported_count": exporter.count,
             "platform": platform,
-            "file_url": file_doc.file_url,
-            "errors": errors
+            "file_url": files[0].file_url,
+            "file_urls": [file_doc.file_url for file_doc in files],
+            "errors": exporter.errors,
+            "timings": timer.log()
     }
 
     # 主动通知客户端
@@ -390,13 +294,52 @@ def export_shipment_to_csv_task(sale_order_ids, platform: str = "amazon", user:
     )
 
 
+def export_shipment_shard_task(filters, after, last, batch_id: str, shard_no: int, platform: str = "amazon", user: str = "Administrator"):
+    """Render the Sales Orders named in (after, last] among the filtered ones to a part file."""
+    logger = frappe.logger("erpnext_my_app")
+    filters = get_sales_order_range_filters(get_sales_order_filters(filters), after, last)
+    progress = ProgressReporter("export_shipments_progress", user, total=frappe.db.count("Sales Order", filters), platform=platform, batch_id=batch_id, shard=shard_no)
+    exporter = ShipmentExporter(platform, progress=progress)
+    part_paths = []
+    try:
+        part_paths.append(exporter.render_part(iter_sales_order_pages(filters), f"shipment_export_{batch_id}_{shard_no:04d}.part"))
+    except Exception as e:
+        # 分片失败也要汇报结果，否则汇总通知永远不会发出
+        frappe.db.rollback()
+        logger.error(f"export_shipment_shard_task: shard {shard_no} of batch {batch_id} failed: {e}")
+        exporter.errors.append(f"分片 {shard_no} 导出失败：{e}<br>")
+
+    ShardedJob("export_shipments_completed", user, batch_id).finish_shard(shard_no, {
+        "status": len(part_paths) == 0 and "error" or "success",
+        "errors": exporter.errors,
+        "platform": platform,
+        "imported_count": exporter.count,
+        "part_paths": part_paths,
+        "timings": exporter.timer.log()
+    })
+
+
+def assemble_shipment_parts(result):
+    """Join the parts rendered by the shards into size-bounded feed files (ShardedJob finalizer)."""
+    exporter = ShipmentExporter(result.get("platform") or "amazon")
+    files = exporter.assemble(result.pop("part_paths", []))
+    result["file_url"] = files[0].file_url
+    result["file_urls"] = [file_doc.file_url for file_doc in files]
+    result["timings"] = merge_results([result.get("timings") or {}, exporter.timer.log()])
+    return result
+
+
 @frappe.whitelist()
-def import_orders(file_url: str, platform: str = "amazon"):
+def import_orders(file_url: str, platform: str = "amazon", dry_run: bool = False):
+    if sbool(dry_run):
+        # 预检只做批量查询，直接同步返回每个订单的问题报告
+        return OrderImporter(platform).validate_orders(file_url)
+
     user = frappe.session.user
     enqueue(
         method=import_orders_task,
-        queue='default',
-        timeout=600,
+        queue=IMPORT_QUEUE,
+        timeout=IMPORT_JOB_TIMEOUT,
         file_url=file_url,
         platform=platform,
         user=user
@@ -405,7 +348,11 @@ def import_orders(file_url: str, platform: str = "amazon"):
     return {"status": "queued"}
 
 @frappe.whitelist()
-def export_delivery_notes_to_csv(sale_order_ids, carrier: str = "upack", ignore_pending_orders: bool = True):
+def export_delivery_notes_to_csv(sale_order_ids=None, carrier: str = "upack", ignore_pending_orders: bool = True, incremental: bool = False, filters=None):
+    if filters:
+        # 提前校验筛选条件，后台任务只携带条件而不是订单 ID 列表
+        get_sales_order_filters(filters)
+        sale_order_ids = None
     user = frappe.session.user
     enqueue(
         method=export_delivery_notes_to_csv_task,
@@ -414,6 +361,8 @@ def export_delivery_notes_to_csv(sale_order_ids, carrier: str = "upack", ignore_
         sale_order_ids=sale_order_ids,
         carrier=carrier,
         ignore_pending_orders=ignore_pending_orders,
+        incremental=incremental,
+        filters=filters,
         user=user
     )
     return {"status": "queued"}
@@ -432,7 +381,11 @@ def import_shipments_from_file(file_url: str, carrier: str = "upack"):
     return {"status": "queued"}
 
 @frappe.whitelist()
-def export_shipment_to_csv(sale_order_ids, platform: str = "amazon"):
+def export_shipment_to_csv(sale_order_ids=None, platform: str = "amazon", filters=None):
+    if filters:
+        # 提前校验筛选条件，后台任务只携带条件而不是订单 ID 列表
+        get_sales_order_filters(filters)
+        sale_order_ids = None
     user = frappe.session.user
     enqueue(
         method=export_shipment_to_csv_task,
@@ -440,6 +393,7 @@ def export_shipment_to_csv(sale_order_ids, platform: str = "amazon"):
         timeout=600,
         sale_order_ids=sale_order_ids,
         platform=platform,
+        filters=filters,
         user=user
     )
     return {"status": "queued"}
@@ -0,0 +1,138 @@
+import csv
+import random
+from datetime import date, timedelta
+from frappe.utils import get_files_path
+from erpnext_my_app.parser.postal_codes import JP_POSTAL_CODE_PREFIXES
+
+# 生成测试数据用的名称
+FAMILY_NAMES = ["佐藤", "鈴木", "高橋", "田中", "伊藤", "渡辺", "山本", "中村", "小林", "加藤"]
+GIVEN_NAMES = ["翔太", "陽菜", "蓮", "結衣", "大翔", "葵", "湊", "さくら", "悠真", "美咲"]
+CITIES = ["四国中央市", "松山市", "新宿区", "大阪市北区", "名古屋市中区", "札幌市中央区", "福岡市博多区"]
+STREETS = ["土居町津根", "本町", "中央", "栄", "南町", "旭町", "緑町"]
+ITEM_NAMES = ["ティッシュペーパー", "トイレットペーパー", "キッチンペーパー", "ウェットティッシュ", "紙コップ"]
+
+AMAZON_COLUMNS = [
+    "order-id", "order-item-id", "purchase-date", "payments-date", "buyer-email", "buyer-name",
+    "buyer-phone-number", "sku", "product-name", "quantity-purchased", "recipient-name",
+    "ship-address-1", "ship-address-2", "ship-address-3", "ship-city", "ship-state",
+    "ship-postal-code", "ship-country", "promise-date", "buyer-company-name", "default-ship-from-address-name",
+]
+RAKUTEN_COLUMNS = [
+    "受注番号", "注文日", "商品番号", "商品名", "個数", "単価", "購入者名", "購入者メールアドレス",
+    "購入者電話番号", "宛名", "郵便番号", "国名", "都道府県", "市区町村", "町名・番地",
+]
+UPACK_COLUMNS = ["お問い合わせ番号", "発送日", "記事名１", "記事名2", "お届け先名", "お届け先郵便番号"]
+FUKUTSU_COLUMNS = ["送り状番号", "出荷日", "荷受人名", "郵便番号", "品名記事５", "品名記事６"]
+
+
+class SyntheticData:
+    """Reproducible random buyers, addresses and dates for the synthetic files."""
+
+    def __init__(self, seed: int = 0):
+        self.random = random.Random(seed)
+        self.postal_prefixes = [
+            (state, lower, upper)
+            for state, _range in JP_POSTAL_CODE_PREFIXES.items()
+            for lower, upper in (_range if isinstance(_range[0], tuple) else (_range,))
+        ]
+
+    def buyer(self, n):
+        name = self.random.choice(FAMILY_NAMES) + " " + self.random.choice(GIVEN_NAMES)
+        # 约三分之一的买家重复下单，以覆盖已有客户的查找路径
+        buyer_no = n if self.random.random() > 0.3 else self.random.randrange(max(n, 1))
+        return {
+            "name": name,
+            "email": f"buyer{buyer_no}@example.com",
+            "phone": f"090-{buyer_no // 10000 % 10000:04d}-{buyer_no % 10000:04d}",
+        }
+
+    def address(self):
+        state, lower, upper = self.random.choice(self.postal_prefixes)
+        prefix = self.random.randint(lower, upper)
+        return {
+            "pincode": f"{prefix:03d}-{self.random.randint(0, 9999):04d}",
+            "state": state,
+            "city": self.random.choice(CITIES),
+            "address_line1": f"{self.random.choice(STREETS)}{self.random.randint(1, 3000)}",
+        }
+
+    def date(self, days=30):
+        return date.today() - timedelta(days=self.random.randint(0, days))
+
+
+def get_file_url(filename):
+    """Path of a public site file and its file URL."""
+    return get_files_path(filename), f"/files/{filename}"
+
+
+def write_amazon_orders(filename, orders, skus, items_per_order=2, seed=0):
+    """Amazon order report: shift_jis, tab separated, one row per order item."""
+    data = SyntheticData(seed)
+    file_path, file_url = get_file_url(filename)
+    with open(file_path, "w", encoding="shift_jis", errors="replace", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\r\n")
+        writer.writerow(AMAZON_COLUMNS)
+        for n in range(orders):
+            order_id = f"250-{n // 10000000 % 10000000:07d}-{n % 10000000:07d}"
+            buyer, address, purchase_date = data.buyer(n), data.address(), data.date()
+            for i in range(data.random.randint(1, items_per_order)):
+                writer.writerow([
+                    order_id, f"{n:08d}{i:02d}", purchase_date.isoformat(), purchase_date.isoformat(),
+                    buyer["email"], buyer["name"], buyer["phone"], data.random.choice(skus),
+                    data.random.choice(ITEM_NAMES), data.random.randint(1, 3), buyer["name"],
+                    address["address_line1"], "", "", address["city"], address["state"],
+                    address["pincode"], "JP", (purchase_date + timedelta(days=2)).isoformat(), "", "龍翔産業株式会社",
+                ])
+    return file_url
+
+
+def write_rakuten_orders(filename, orders, items_per_order=2, seed=0):
+    """Rakuten order CSV: UTF-8, comma separated, one row per order item."""
+    data = SyntheticData(seed)
+    file_path, file_url = get_file_url(filename)
+    with open(file_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(RAKUTEN_COLUMNS)
+        for n in range(orders):
+            order_id = f"100000-{data.date().strftime('%Y%m%d')}-{n:010d}"
+            buyer, address = data.buyer(n), data.address()
+            for _ in range(data.random.randint(1, items_per_order)):
+                writer.writerow([
+                    order_id, data.date().isoformat(), f"RAKUTEN-{data.random.randint(1, 50):03d}",
+                    data.random.choice(ITEM_NAMES), data.random.randint(1, 3), data.random.randint(100, 3000),
+                    buyer["name"], buyer["email"], buyer["phone"], buyer["name"], address["pincode"], "JP",
+                    address["state"], address["city"], address["address_line1"],
+                ])
+    return file_url
+
+
+def write_upack_results(filename, delivery_notes, seed=0):
+    """Japan Post upack result file: UTF-8 with BOM, comma separated."""
+    data = SyntheticData(seed)
+    file_path, file_url = get_file_url(filename)
+    with open(file_path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(UPACK_COLUMNS)
+        for n, delivery_note in enumerate(delivery_notes):
+            address = data.address()
+            writer.writerow([
+                f"{data.random.randint(10 ** 11, 10 ** 12 - 1)}", data.date(3).isoformat(), delivery_note,
+                f"250-0000000-{n:07d}", data.buyer(n)["name"], address["pincode"],
+            ])
+    return file_url
+
+
+def write_fukutsu_results(filename, delivery_notes, seed=0):
+    """Fukuyama Transporting result file: cp932, comma separated, IDs quoted with a leading apostrophe."""
+    data = SyntheticData(seed)
+    file_path, file_url = get_file_url(filename)
+    with open(file_path, "w", encoding="cp932", errors="replace", newline="") as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator="\r\n")
+        writer.writerow(FUKUTSU_COLUMNS)
+        for n, delivery_note in enumerate(delivery_notes):
+            address = data.address()
+            writer.writerow([
+                f"{data.random.randint(10 ** 11, 10 ** 12 - 1)}", data.date(3).isoformat(), data.buyer(n)["name"],
+                address["pincode"], f"'{delivery_note}", f"'250-0000000-{n:07d}",
+            ])
+    return file_url
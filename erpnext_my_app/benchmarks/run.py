@@ -0,0 +1,204 @@
+import os
+import time
+import tracemalloc
+import frappe
+from erpnext_my_app.parser.utils import *
+from erpnext_my_app.parser.item_index import split_skus
+from erpnext_my_app.parser.order_importer import OrderImporter
+from erpnext_my_app.parser.delivery_importer import DeliveryImporter
+from erpnext_my_app.parser.delivery_exporter import DeliveryExporter
+from erpnext_my_app.parser.shipment_exporter import ShipmentExporter
+from erpnext_my_app.parser.instrumentation import QueryProfile
+from erpnext_my_app.benchmarks.generators import (
+    get_file_url,
+    write_amazon_orders,
+    write_fukutsu_results,
+    write_rakuten_orders,
+    write_upack_results,
+)
+
+logger = frappe.logger("erpnext_my_app")
+
+BENCHMARKS = ("amazon", "rakuten", "upack", "fukutsu", "delivery_export", "shipment_export")
+FILE_ENCODINGS = {"amazon": "shift_jis", "rakuten": "utf-8", "upack": "utf-8-sig", "fukutsu": "cp932"}
+
+
+class Stage:
+    """
+    Measures wall time and the SQL queries of one benchmark stage, flagging query
+    shapes run about once per row (N+1). Peak Python memory is only measured with
+    trace_memory=True, since tracemalloc slows the stage down several times.
+    """
+
+    def __init__(self, results, benchmark: str, stage: str, trace_memory: bool = False):
+        self.results = results
+        self.benchmark = benchmark
+        self.stage = stage
+        self.trace_memory = trace_memory
+        self.rows = 0
+        self.queries = QueryProfile()
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        # 只在本阶段内统计 frappe.db.sql 的调用次数
+        self.queries.install()
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.started_at
+        self.queries.uninstall()
+        peak = 0
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if exc_type is None:
+            # 同一形状的语句执行次数达到行数的一半，多半是逐行查询
+            repeated = self.queries.repeated_shapes(max(self.rows // 2, 10))
+            if repeated:
+                logger.warning(f"benchmark {self.benchmark}/{self.stage}: possible N+1 queries\n{self.queries.report()}")
+            self.results.append({
+                "benchmark": self.benchmark,
+                "stage": self.stage,
+                "rows": self.rows,
+                "seconds": round(seconds, 3),
+                "rows_per_second": round(self.rows / seconds, 1) if seconds > 0 else None,
+                "peak_memory_mb": round(peak / 1024 / 1024, 2) if self.trace_memory else None,
+                "queries": self.queries.count,
+                "repeated": len(repeated),
+            })
+        return False
+
+
+def run(rows: int = 1000, benchmarks=None, create: bool = False, seed: int = 0, trace_memory: bool = False):
+    """
+    Generate synthetic files and time each stage of the import and export paths.
+
+        bench --site <site> execute erpnext_my_app.benchmarks.run.run --kwargs "{'rows': 5000}"
+
+    With create=True the Sales Orders and Shipments are really created and committed,
+    only use it on a benchmark site.
+
+    With trace_memory=True peak memory is measured with tracemalloc; its overhead
+    distorts rows/sec, so compare timings only between runs without it.
+    """
+    results = []
+    for benchmark in benchmarks or BENCHMARKS:
+        if benchmark in ("amazon", "rakuten"):
+            benchmark_orders(results, benchmark, rows, create, seed, trace_memory)
+        elif benchmark in ("upack", "fukutsu"):
+            benchmark_shipments(results, benchmark, rows, create, seed, trace_memory)
+        elif benchmark == "delivery_export":
+            benchmark_delivery_export(results, rows, trace_memory)
+        elif benchmark == "shipment_export":
+            benchmark_shipment_export(results, rows, trace_memory)
+        else:
+            frappe.throw(f"未知的性能测试：{benchmark}<br>")
+
+    print_report(results)
+    return results
+
+
+def benchmark_orders(results, platform, rows, create, seed, trace_memory):
+    filename = f"benchmark-{platform}-{rows}.txt"
+    if platform == "amazon":
+        skus = []
+        if frappe.get_meta("Item").has_field("custom_amazon_sku"):
+            skus = frappe.get_all("Item", filters={"custom_amazon_sku": ["is", "set"]}, pluck="custom_amazon_sku", limit=50)
+        if not skus:
+            logger.warning("benchmark: no Item has custom_amazon_sku, every Amazon order will be skipped as unmatched.")
+        file_url = write_amazon_orders(filename, rows, [split_skus(sku)[0] for sku in skus if split_skus(sku)] or ["BENCHMARK-SKU"], seed=seed)
+    else:
+        file_url = write_rakuten_orders(filename, rows, seed=seed)
+
+    try:
+        with Stage(results, platform, "decode", trace_memory) as stage:
+            stage.rows = sum(1 for _ in iter_file_lines(file_url, FILE_ENCODINGS[platform]))
+
+        importer = OrderImporter(platform)
+        # 解析阶段包含按 SKU 查找商品和剔除已导入订单的批量查询
+        with Stage(results, platform, "parse", trace_memory) as stage:
+            orders = list(importer.iter_orders(file_url))
+            stage.rows = len(orders)
+
+        with Stage(results, platform, "lookup", trace_memory) as stage:
+            for batch in chunks(orders, CUSTOMER_PRELOAD_BATCH_SIZE):
+                importer.customer_index.preload(batch)
+            stage.rows = len(orders)
+
+        if create:
+            with Stage(results, platform, "create", trace_memory) as stage:
+                stage.rows = len(importer.create_orders(orders))
+    finally:
+        remove_file(filename)
+
+
+def benchmark_shipments(results, carrier, rows, create, seed, trace_memory):
+    # 尽量使用系统中已有的发货单，不足的部分用不存在的发货单号补齐
+    delivery_notes = frappe.get_all(
+        "Delivery Note",
+        filters={"docstatus": 1, "is_return": 0},
+        order_by="modified desc",
+        limit=rows,
+        pluck="name"
+    )
+    delivery_notes += [f"BENCHMARK-DN-{n:07d}" for n in range(len(delivery_notes), rows)]
+    filename = f"benchmark-{carrier}-{rows}.csv"
+    writer = write_upack_results if carrier == "upack" else write_fukutsu_results
+    file_url = writer(filename, delivery_notes, seed=seed)
+
+    try:
+        with Stage(results, carrier, "decode", trace_memory) as stage:
+            stage.rows = sum(1 for _ in iter_file_lines(file_url, FILE_ENCODINGS[carrier]))
+
+        importer = DeliveryImporter(carrier)
+        with Stage(results, carrier, "parse", trace_memory) as stage:
+            records = importer.parse(file_url)
+            stage.rows = len(records)
+
+        with Stage(results, carrier, "lookup", trace_memory) as stage:
+            for batch in chunks(records, SHIPMENT_PRELOAD_BATCH_SIZE):
+                importer._preload({record.get("delivery_note_id") for record in batch})
+            stage.rows = len(records)
+
+        if create:
+            with Stage(results, carrier, "create", trace_memory) as stage:
+                stage.rows = len(importer.create_shipments(records))
+    finally:
+        remove_file(filename)
+
+
+def benchmark_delivery_export(results, rows, trace_memory):
+    sale_order_ids = get_recent_sales_orders(rows)
+    with Stage(results, "delivery_export", "export", trace_memory) as stage:
+        file_doc = DeliveryExporter("upack", ignore_pending_orders=False).export(sale_order_ids)
+        stage.rows = len(sale_order_ids)
+    frappe.delete_doc("File", file_doc.name, ignore_permissions=True)
+
+
+def benchmark_shipment_export(results, rows, trace_memory):
+    sale_order_ids = get_recent_sales_orders(rows)
+    with Stage(results, "shipment_export", "export", trace_memory) as stage:
+        files = ShipmentExporter("amazon").export(sale_order_ids)
+        stage.rows = len(sale_order_ids)
+    for file_doc in files:
+        frappe.delete_doc("File", file_doc.name, ignore_permissions=True)
+
+
+def get_recent_sales_orders(rows):
+    return frappe.get_all("Sales Order", filters={"docstatus": 1}, order_by="modified desc", limit=rows, pluck="name")
+
+
+def remove_file(filename):
+    file_path, _ = get_file_url(filename)
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+
+def print_report(results):
+    columns = ("benchmark", "stage", "rows", "seconds", "rows_per_second", "peak_memory_mb", "queries", "repeated")
+    widths = [max(len(column), *(len(str(result[column])) for result in results)) for column in columns]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths, strict=True)))
+    for result in results:
+        print("  ".join(str(result[column]).ljust(width) for column, width in zip(columns, widths, strict=True)))
@@ -146,13 +146,11 @@ app_logger_handlers = {
 # ---------------
 # Hook on document methods and events
 
-# doc_events = {
-# 	"*": {
-# 		"on_update": "method",
-# 		"on_cancel": "method",
-# 		"on_trash": "method"
-# 	}
-# }
+doc_events = {
+	"Customer": {
+		"validate": "erpnext_my_app.parser.customer_index.set_phone_digits"
+	}
+}
 
 # Scheduled Tasks
 # ---------------
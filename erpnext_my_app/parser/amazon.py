@@ -1,16 +1,29 @@
-import csv
 import frappe
 from io import StringIO
 from frappe.utils import cint, getdate, add_days, nowdate # 假设这些工具函数可用
 from frappe.utils.file_manager import get_file # 正确的导入路径
 from erpnext_my_app.parser.utils import *
+from erpnext_my_app.parser.item_index import ItemIndex
+from erpnext_my_app.parser.instrumentation import StageTimer
 
 logger = frappe.logger("erpnext_my_app")
 
 class AmazonOrderParser:
-    def __init__(self, file_url): # 接受文件URL
+    def __init__(self, file_url, stream=False): # 接受文件URL
         self.file_url = file_url
-        self.content = self._fetch_content_from_file_doc() # 调用方法获取内容
+        # 流式模式下不把整个文件读入内存，而是在解析时从磁盘增量读取
+        self.stream = stream
+        # 已经导入过的订单号（解析时直接跳过）
+        self.imported_order_ids = set()
+        # 断点续传：从这一行开始读取，之前的行已经导入并提交
+        self.resume_line = 0
+        # 扫描后得到的待处理订单数，用于进度显示
+        self.orders_total = None
+        # 订单号 → 在系统中找不到商品的 SKU 列表
+        self.unmatched_skus = {}
+        # 记录解码、查重和 SKU 查询各阶段的耗时，导入时由 OrderImporter 替换为任务共用的计时器
+        self.timer = StageTimer("AmazonOrderParser")
+        self.content = "" if stream else self._fetch_content_from_file_doc() # 调用方法获取内容
 
     def _fetch_content_from_file_doc(self):
         """Fetches and decodes content from a file attached in the File DocType (self.file_url)."""
@@ -27,49 +40,56 @@ class AmazonOrderParser:
             print(f"Error fetching or decoding file from {self.file_url}: {e}")
             return ""
 
-    def parse(self):
+    def _iter_rows(self):
         # StringIO(self.content) 可以处理空字符串，如果 _fetch_content_from_file_doc 返回空，这里也能正常运行
-        reader = csv.DictReader(StringIO(self.content), delimiter='\t')
-        raw_orders = {}
-        for row in reader:
-            order_id = row.get("order-id")
-            if not order_id:
-                continue # 如果没有 order-id，跳过这一行
-            raw_orders.setdefault(order_id, []).append(row)
+        lines = iter_file_lines(self.file_url, "shift_jis", timer=self.timer) if self.stream else StringIO(self.content)
+        return iter_csv_rows(lines, self.resume_line, delimiter='\t')
+
+    def parse(self):
+        return list(self.iter_orders())
+
+    def iter_orders(self):
+        """Yield parsed orders one at a time without buffering the whole report."""
+        # 第一遍只扫描订单号和 SKU：收集文件中所有不重复的 SKU，并找出行不连续的订单
+        order_ids, split_order_ids, skus = scan_row_keys(self._iter_rows(), "order-id", "sku")
+        if split_order_ids:
+            logger.info(f"AmazonOrderParser: {len(split_order_ids)} orders are not contiguous in {self.file_url}.")
 
-        parsed_orders = []
-        for order_id, rows in raw_orders.items():
+        # 一次批量查询剔除已经导入过的订单，后续不再为它们解析商品
+        with self.timer.stage("duplicate_check"):
+            self.imported_order_ids = get_imported_order_ids(order_ids)
+        if self.imported_order_ids:
+            logger.info(f"AmazonOrderParser: {len(self.imported_order_ids)} orders already imported, skipped.")
+        self.orders_total = len(order_ids - self.imported_order_ids)
+
+        # 一次性解析成 SKU → 商品编码的索引
+        item_index = ItemIndex()
+        with self.timer.stage("sku_lookup"):
+            # 已导入订单的 SKU 也一并解析，只在内存中匹配，不增加查询
+            item_index.resolve_skus(skus)
+            # 批量预加载商品名称和销售单价，逐行处理时只查内存
+            item_index.preload_items()
+
+        # 第二遍按订单分组，每凑齐一个订单就立即交给调用方
+        for order_id, rows in group_rows(self._iter_rows(), "order-id", split_order_ids):
             if not rows: # 理论上不会发生，因为只有有 order_id 的行才会被添加
                 continue
+            if order_id in self.imported_order_ids:
+                continue
 
             first_row = rows[0]
 
             items = []
             for row in rows:
                 # 依据商品 SKU 或 ASIN 查找商品编码（一个商品对应多个亚马逊的SKU）
-                item_code = frappe.db.get_value(
-                    "Item",
-                    filters={"custom_amazon_sku": ["like", f"%{row.get('sku')}%"]},
-                    fieldname="item_code",
-                )
-                item_defaultwarehouse = WAREHOUSE_NAME_DEFAULT
-                rate = 0.0 # 默认单价为0.0
-                if item_code:
-                    item = frappe.get_doc("Item", item_code)
-                    for default in item.item_defaults:
-                        #logger.error(f"AmazonOrderParser: Found item_code: {item_code} for sku: {row.get('sku')} default_warehouse: {default.default_warehouse} company: {default.company}  ")
-                        if default.company == COMPANY_NAME_DEFAULT and default.default_warehouse != None:
-                            item_defaultwarehouse = default.default_warehouse
-                    rate = frappe.db.get_value(
-                        "Item Price",
-                        {"item_code": item_code, "price_list": "Standard Selling"},
-                        "price_list_rate"
-                    )
-                
-                    #logger.error(f"AmazonOrderParser: Found item_code: {item_code} for sku: {row.get('sku')} default_warehouse: {item_defaultwarehouse}")
+                item_code = item_index.get_item_code(row.get("sku"))
+                item = item_index.get_item(item_code) if item_code else None
+                if item:
+                    rate = item["rate"] # 商品单价，默认0.0
+
                     items.append({
                         "item_code": item_code, # 商品代码
-                        "item_name": item.item_name[:140], # 商品名称，截断为140个字符
+                        "item_name": item["item_name"][:140], # 商品名称，截断为140个字符
                         "additional_notes": row.get("order-item-id", ""), # 商品 ASIN
                         "description": row.get("order-item-id") or "", # 商品 ASIN
                         "qty": cint(row.get("quantity-purchased", 1)), # 购买数量，转换为整数
@@ -77,8 +97,10 @@ class AmazonOrderParser:
                         "stock_uom": "Nos",
 						"conversion_factor": 1.0,
 						"warehouse": WAREHOUSE_NAME_DEFAULT # 默认仓库
-						#"warehouse": item_defaultwarehouse # 默认仓库
                     })
+                else:
+                    # 记录找不到商品的 SKU，供导入报告和预检使用
+                    self.unmatched_skus.setdefault(order_id, []).append(row.get("sku") or "")
             # 如果没有找到商品，跳过这个订单
             if not items:
                 continue
@@ -90,6 +112,7 @@ class AmazonOrderParser:
                 "transaction_date": getdate(transaction_date_raw) if transaction_date_raw else nowdate(), # 交易日期
                 "delivery_date": getdate(delivery_date_raw) if delivery_date_raw else add_days(nowdate(), 1), # 交货日期
                 "items": items, # 订单包含的商品列表
+                "file_lines": (rows.first_line, rows.resume_line), # 订单在文件中的行号范围，用于导入断点
                 "customer": {
                     "name": first_row.get("buyer-name", ""), # 买家姓名
                     "recipient": first_row.get("recipient-name", ""), # 收件人姓名
@@ -107,5 +130,4 @@ class AmazonOrderParser:
                     "address_line2": first_row.get("ship-address-3", ""), # 地址行2
                 }
             }
-            parsed_orders.append(order)
-        return parsed_orders
\ No newline at end of file
+            yield order
@@ -0,0 +1,120 @@
+import csv
+
+# 发货人（本公司）信息
+SENDER_PHONE = "0896-22-4988"
+SENDER_CODE = "1896224988"
+SENDER_ADDRESS = ("土居町津根2840", "四国中央市", "爱媛県", "799-0704")
+
+
+class Column:
+    """
+    One CSV column: a constant (no source), a context field, or a tuple of
+    fields of which the first non-empty value is used, with optional formatter.
+    """
+
+    __slots__ = ("header", "source", "default", "formatter")
+
+    def __init__(self, header, source=None, default="", formatter=None):
+        self.header = header
+        self.source = source
+        self.default = default
+        self.formatter = formatter
+
+
+class CarrierLayout:
+    """A carrier label CSV layout, compiled once into a row template plus the list of dynamic columns."""
+
+    def __init__(self, columns, encoding="utf-8", quoting=csv.QUOTE_MINIMAL):
+        self.columns = columns
+        self.encoding = encoding
+        self.quoting = quoting
+        self.headers = [column.header for column in columns]
+        # 常量列直接放进模板，生成每一行时只需填充动态列
+        self._template = [column.default if column.source is None else None for column in columns]
+        self._fields = [
+            (i, column.source if isinstance(column.source, tuple) else (column.source,), column.default, column.formatter)
+            for i, column in enumerate(columns)
+            if column.source is not None
+        ]
+
+    def build_row(self, context):
+        row = self._template.copy()
+        for i, sources, default, formatter in self._fields:
+            value = default
+            for source in sources:
+                if context.get(source):
+                    value = context[source]
+                    break
+            row[i] = formatter(value) if formatter else value
+        return row
+
+
+# 行上下文中可用的字段：
+# dn_name, amazon_order_id, customer_name, customer_phone, contact,
+# address_phone, address_line1, city, state, pincode,
+# item_names, item_count, item_note_1 ~ item_note_6, company_name, my_delivery_date, delivery_date
+CARRIER_LAYOUTS = {
+    "fukutsu": CarrierLayout([
+        Column("荷受人コード"),
+        Column("電話番号", ("address_phone", "customer_phone"), SENDER_PHONE),
+        Column("住所１", "address_line1"),
+        Column("住所２", "city"),
+        Column("住所３", "state"),
+        Column("名前１", "customer_name"),
+        Column("名前２", "contact"),
+        Column("郵便番号", "pincode"),
+        Column("特殊計", default=0),
+        Column("着店コード"),
+        Column("荷送人コード", default=SENDER_CODE),
+        Column("荷送担当者"),
+        Column("個数", default=1),
+        Column("才数"),
+        Column("重量"),
+        Column("輸送商品１"),
+        Column("輸送商品２"),
+        Column("品名記事１", "item_note_1"),
+        Column("品名記事２", "item_note_2"),
+        Column("品名記事３", "item_note_3"),
+        Column("品名記事４", "item_note_4"),
+        Column("品名記事５", "item_note_5"),
+        Column("品名記事６", "item_note_6"),
+        Column("配達指定日", "my_delivery_date"),
+        Column("必着区分"),
+        Column("お客様管理番号"),
+        Column("元払区分", default=1),
+        Column("保険金額", default=0),
+        Column("出荷日付", "delivery_date", formatter=int),
+        Column("登録日付"),
+    ], encoding="cp932", quoting=csv.QUOTE_ALL),
+
+    # 使用 UTF-8 编码保存文件
+    # 由于 CSV 文件可能包含非 ASCII 字符，建议使用 UTF-8 编码
+    # 但如果需要兼容某些系统，可以使用 shift_jis 编码
+    "upack": CarrierLayout([
+        Column("发货ID", "dn_name"),
+        Column("亚马逊订单号", "amazon_order_id"),
+        Column("客户名称", "customer_name"),
+        Column("客户电话", "customer_phone"),
+        Column("收货人名称", "contact"),
+        Column("收货人电话", "address_phone", SENDER_PHONE),
+        Column("收货地址明细", "address_line1"),
+        Column("收货城市", "city"),
+        Column("收货省份", "state"),
+        Column("收货邮编", "pincode"),
+        Column("商品名称", "item_names"),
+        Column("商品数量", "item_count", 0, formatter=int),
+        Column("发货名称", "company_name"),
+        Column("发货电话", default=SENDER_PHONE),
+        Column("发货地址明细", default=SENDER_ADDRESS[0]),
+        Column("发货城市", default=SENDER_ADDRESS[1]),
+        Column("发货省份", default=SENDER_ADDRESS[2]),
+        Column("发货邮编", default=SENDER_ADDRESS[3]),
+        Column("指定配送日期", "my_delivery_date"),
+        Column("指定配送时间"),
+    ], encoding="utf-8"),
+}
+
+
+def get_carrier_layout(carrier):
+    # 没有单独定义格式的快递公司沿用 upack 的格式
+    return CARRIER_LAYOUTS.get(carrier) or CARRIER_LAYOUTS["upack"]
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import frappe
+from frappe.utils.file_manager import get_file_path
+from erpnext_my_app.parser.utils import *
+
+logger = frappe.logger("erpnext_my_app")
+
+
+def get_file_hash(file_url):
+    """Hash the stored file content incrementally, so the same file uploaded again maps to the same checkpoint."""
+    file_path = get_file_path(file_url)
+    if not os.path.exists(file_path):
+        return None
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(STREAM_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ImportCheckpoint:
+    """
+    Resume point of importing one file, kept as a JSON DB default keyed on the
+    hash of the file content: the line the parsers resume reading at and the
+    key of the last committed record. It is written in the same transaction as
+    the records it covers, so when the same file is submitted again after the
+    job was killed, the committed rows are skipped before the scan and parse
+    passes.
+    """
+
+    def __init__(self, kind: str, file_url: str, key_field: str):
+        self.kind = kind
+        self.key_field = key_field
+        file_hash = get_file_hash(file_url)
+        self.key = f"erpnext_my_app_checkpoint:{kind}:{file_hash}" if file_hash else None
+        value = frappe.db.get_default(self.key) if self.key else None
+        value = json.loads(value) if value else {}
+        # 解析器从这一行开始读取，之前的行已经导入并提交
+        self.line = value.get("line") or 0
+        self.last_key = value.get("key")
+        self.saved_line = self.line
+        if self.line:
+            logger.info(f"ImportCheckpoint: resuming {kind} import of {file_url} at line {self.line}, after {self.last_key}.")
+
+    def advance(self, record, line=None):
+        """Move the resume point past a processed record, or to `line`; written by the next save()."""
+        if line is None:
+            line = (record.get("file_lines") or (None, None))[1]
+        if line is not None and line > self.line:
+            self.line = line
+            self.last_key = record.get(self.key_field)
+
+    def save(self):
+        """Write the resume point; called right before the commit of the records it covers."""
+        if self.key and self.line != self.saved_line:
+            frappe.db.set_default(self.key, json.dumps({"line": self.line, "key": self.last_key}))
+            self.saved_line = self.line
+
+    def dispatch(self, shard, buckets):
+        """
+        Move the resume point past a shard handed to a background job, but not
+        past the first line of the records still buffered in `buckets`, and commit.
+        """
+        first_lines = [record["file_lines"][0] for records in buckets.values() for record in records if record.get("file_lines")]
+        self.advance(shard[-1], min(first_lines) if first_lines else None)
+        self.save()
+        # 分片已经进入队列，断点立即提交
+        frappe.db.commit()
+
+    def clear(self):
+        """The whole file has been processed, drop the checkpoint."""
+        if self.key:
+            frappe.defaults.clear_default(key=self.key)
+        self.line = self.saved_line = 0
+        self.last_key = None
+
+
+class ExportWatermark:
+    """
+    Position of the last exported record of an incremental export, kept per
+    kind and carrier as a JSON DB default.
+    """
+
+    def __init__(self, kind: str, carrier: str):
+        self.key = f"erpnext_my_app_watermark:{kind}:{carrier}"
+        value = frappe.db.get_default(self.key)
+        self.value = json.loads(value) if value else None
+
+    def save(self, value):
+        # 与导出文件在同一个事务中提交
+        frappe.db.set_default(self.key, json.dumps(value))
+        self.value = value
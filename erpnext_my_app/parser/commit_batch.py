@@ -0,0 +1,36 @@
+import frappe
+from erpnext_my_app.parser.utils import *
+from erpnext_my_app.parser.instrumentation import StageTimer
+
+logger = frappe.logger("erpnext_my_app")
+
+
+class CommitBatcher:
+    """
+    Commits the imported records every `size` records, so a long import never
+    holds one transaction (and its locks) for the whole file. A job killed by
+    the RQ timeout keeps the committed batches.
+    """
+
+    def __init__(self, kind: str, size: int | None = None, on_save=None, timer=None):
+        self.kind = kind
+        self.size = size or get_commit_batch_size()
+        # 提交前调用，用于把批量缓存的更新和导入断点写入同一个事务
+        self.on_save = on_save
+        # 提交耗时记录为导入任务的 commit 阶段
+        self.timer = timer or StageTimer(f"CommitBatcher {kind}")
+        self.pending = 0
+
+    def add(self):
+        """Count one processed record; every `size` records the transaction is committed."""
+        self.pending += 1
+        if self.pending >= self.size:
+            self.save()
+
+    def save(self):
+        with self.timer.stage("commit"):
+            if self.on_save:
+                self.on_save()
+            # 定期提交，释放长事务持有的锁
+            frappe.db.commit()
+        self.pending = 0
@@ -0,0 +1,95 @@
+import codecs
+import csv
+import io
+import os
+import frappe
+from frappe.utils import get_files_path
+
+logger = frappe.logger("erpnext_my_app")
+
+
+class CsvFileWriter:
+    """
+    Writes CSV rows straight into a file under the site's files directory,
+    encoding them incrementally, and registers the File doc once finished,
+    so an export never holds the whole CSV in memory.
+    """
+
+    def __init__(self, filename: str, encoding: str = "utf-8", is_private: int = 0, **csv_kwargs):
+        self.is_private = is_private
+        self.file_name = self._get_unique_file_name(filename)
+        self.file_path = get_files_path(self.file_name, is_private=is_private)
+        self.rows = 0
+        self.size = 0
+        # 每行先写入内存缓冲再编码，顺便累计字节数，不必每行 tell() 刷新文件缓冲
+        # 无法用目标编码表示的字符用 ? 代替，与原来 encode(errors="replace") 一致
+        self.encoder = codecs.getincrementalencoder(encoding)(errors="replace")
+        self.buffer = io.StringIO(newline="")
+        self.file = open(self.file_path, "wb")
+        self.writer = csv.writer(self.buffer, **csv_kwargs)
+
+    def _get_unique_file_name(self, filename):
+        name, ext = os.path.splitext(filename)
+        file_name = filename
+        while os.path.exists(get_files_path(file_name, is_private=self.is_private)):
+            file_name = f"{name}{frappe.generate_hash(length=6)}{ext}"
+        return file_name
+
+    def writerow(self, row):
+        self.writer.writerow(row)
+        data = self.encoder.encode(self.buffer.getvalue())
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.file.write(data)
+        self.size += len(data)
+        self.rows += 1
+
+    def tell(self):
+        """Number of encoded bytes written so far."""
+        return self.size
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def write_encoded(self, line):
+        """Write one row that is already encoded, e.g. copied from another file written by this class."""
+        self.file.write(line)
+        self.size += len(line)
+        self.rows += 1
+
+    def close(self):
+        """Close the file without registering it, returns its path."""
+        self.file.write(self.encoder.encode("", final=True))
+        self.file.close()
+        return self.file_path
+
+    def save(self):
+        """Close the file and register it in the File DocType, returns the File doc."""
+        self.close()
+        file_url = f"/private/files/{self.file_name}" if self.is_private else f"/files/{self.file_name}"
+        file_doc = frappe.get_doc({
+            "doctype": "File",
+            "file_name": self.file_name,
+            "file_url": file_url,
+            "is_private": self.is_private,
+            "attached_to_doctype": None,
+            "attached_to_name": None,
+        })
+        file_doc.insert(ignore_permissions=True)
+        return file_doc
+
+    def discard(self):
+        """Remove the partially written file after a failure."""
+        if not self.file.closed:
+            self.file.close()
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.discard()
+        return False
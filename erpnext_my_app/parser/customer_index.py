@@ -0,0 +1,195 @@
+import re
+import unicodedata
+import frappe
+from erpnext_my_app.parser.utils import *
+
+logger = frappe.logger("erpnext_my_app")
+
+def normalize_text(value):
+    """Full-width → half-width, drop whitespace and lowercase, so equal addresses compare equal."""
+    if not value:
+        return ""
+    return re.sub(r"\s+", "", unicodedata.normalize("NFKC", str(value))).lower()
+
+
+def normalize_email(value):
+    return (value or "").strip().lower()
+
+
+def normalize_phone(value):
+    digits = re.sub(r"\D", "", unicodedata.normalize("NFKC", str(value or "")))
+    # +81 开头的国际号码统一成国内号码
+    if digits.startswith("81") and len(digits) >= 11:
+        digits = "0" + digits[2:]
+    return digits if len(digits) >= 6 else ""
+
+
+def set_phone_digits(doc, method=None):
+    """Customer validate hook: keep the indexed custom_phone_digits column equal to the normalized custom_phone."""
+    if doc.meta.has_field("custom_phone_digits"):
+        doc.custom_phone_digits = normalize_phone(doc.get("custom_phone"))
+
+
+def get_buyer_keys(customer_info):
+    """The normalized (kind, value) keys a buyer is looked up by, in the order find_customer tries them."""
+    keys = (("email", normalize_email(customer_info.get("email"))), ("phone", normalize_phone(customer_info.get("phone"))))
+    return [key for key in keys if key[1]]
+
+
+def partition_by_buyer(orders, size, lanes=IMPORT_SHARD_LANES, buckets=None):
+    """
+    Route streamed orders to lanes by buyer and yield (lane, shard) as soon as a
+    lane holds `size` orders. An order goes to the lane of any of its buyer keys
+    (normalized email or phone) seen before, otherwise to the lane its first key
+    hashes to, so the orders of a buyer share a lane. Shards of one lane run one
+    after another (ShardedJob.enqueue_lane_shard), so no two jobs create the
+    same new customer at the same time. `buckets` (see partition_stream)
+    exposes the orders not yet handed out.
+    """
+    # 只保留买家键 → 通道的映射，订单本身在分片交出后即可释放
+    lanes_by_key = {}
+
+    def get_buyer_lane(order):
+        keys = get_buyer_keys(order.get("customer") or {})
+        lane = next((lanes_by_key[key] for key in keys if key in lanes_by_key), None)
+        if lane is None:
+            lane = get_lane(keys[0] if keys else order.get("order_id"), lanes)
+        for key in keys:
+            lanes_by_key.setdefault(key, lane)
+        return lane
+
+    return partition_stream(orders, size, get_buyer_lane, buckets)
+
+
+class CustomerIndex:
+    """
+    Lookup index of existing Customers (by buyer email / phone) and their
+    Addresses and Contacts, loaded in bulk and kept for the whole import job.
+    """
+
+    def __init__(self):
+        self.customers = {}   # ("email"|"phone", 规范化值) → Customer
+        self.addresses = {}   # (Customer, 邮编, 地址行1) → Address
+        self.contacts = {}    # (Customer, 联系人名) → Contact
+        self._queried_emails = set()
+        self._queried_phones = set()
+        self._loaded_customers = set()
+        # 自上一个保存点以来新加入索引的条目，记录回滚时一并撤销
+        self._added = []
+
+    def preload(self, orders):
+        """Bulk load the customers matching the buyers of these orders, plus their addresses and contacts."""
+        emails, phones = set(), set()
+        for order in orders:
+            customer_info = order.get("customer") or {}
+            email = normalize_email(customer_info.get("email"))
+            phone = normalize_phone(customer_info.get("phone"))
+            if email and email not in self._queried_emails:
+                emails.add(email)
+            if phone and phone not in self._queried_phones:
+                phones.add(phone)
+        self._queried_emails.update(emails)
+        self._queried_phones.update(phones)
+
+        # 通过联系人邮箱找到关联的客户：两边都转成小写比较，与文件中邮箱的大小写无关
+        for values in chunks(emails):
+            contacts = frappe.db.sql(
+                """
+                select contact.email_id, link.link_name as customer
+                from `tabContact` contact
+                inner join `tabDynamic Link` link
+                    on link.parent = contact.name and link.parenttype = 'Contact'
+                where lower(contact.email_id) in %(emails)s and link.link_doctype = 'Customer'
+                """,
+                {"emails": tuple(values)},
+                as_dict=True,
+            )
+            for contact in contacts:
+                self._set_customer("email", normalize_email(contact.email_id), contact.customer)
+
+        # 通过客户电话找到客户：已保存的电话格式不一（090-1234-5678、+81 90 1234 5678 等），
+        # 规范化后的号码保存在带索引的 custom_phone_digits 中（见 set_phone_digits），直接按该列匹配
+        for values in chunks(phones):
+            for customer in frappe.get_all(
+                "Customer",
+                filters={"custom_phone_digits": ["in", values]},
+                fields=["name", "custom_phone_digits"],
+            ):
+                self._set_customer("phone", customer.custom_phone_digits, customer.name)
+
+        self._load_links({name for name in self.customers.values() if name not in self._loaded_customers})
+
+    def _set_customer(self, kind, value, customer):
+        if value and customer:
+            self.customers.setdefault((kind, value), customer)
+
+    def _load_links(self, customers):
+        """Load the addresses and contacts linked to the given customers."""
+        self._loaded_customers.update(customers)
+        for names in chunks(customers):
+            addresses = frappe.get_all(
+                "Address",
+                filters=[
+                    ["Dynamic Link", "link_doctype", "=", "Customer"],
+                    ["Dynamic Link", "link_name", "in", names],
+                ],
+                fields=["name", "pincode", "address_line1", "`tabDynamic Link`.link_name as customer"],
+            )
+            for address in addresses:
+                self.addresses.setdefault(
+                    (address.customer, normalize_text(address.pincode), normalize_text(address.address_line1)),
+                    address.name
+                )
+
+            contacts = frappe.get_all(
+                "Contact",
+                filters=[
+                    ["Dynamic Link", "link_doctype", "=", "Customer"],
+                    ["Dynamic Link", "link_name", "in", names],
+                ],
+                fields=["name", "first_name", "`tabDynamic Link`.link_name as customer"],
+            )
+            for contact in contacts:
+                self.contacts.setdefault((contact.customer, normalize_text(contact.first_name)), contact.name)
+
+    def find_customer(self, customer_info):
+        for key in get_buyer_keys(customer_info):
+            if key in self.customers:
+                return self.customers[key]
+        return None
+
+    def add_customer(self, customer_info, customer):
+        if customer:
+            for key in get_buyer_keys(customer_info):
+                self._add(self.customers, key, customer)
+        self._loaded_customers.add(customer)
+
+    def _address_key(self, customer, address_info):
+        return (customer, normalize_text(address_info.get("pincode")), normalize_text(address_info.get("address_line1")))
+
+    def find_address(self, customer, address_info):
+        return self.addresses.get(self._address_key(customer, address_info))
+
+    def add_address(self, customer, address_info, address):
+        self._add(self.addresses, self._address_key(customer, address_info), address)
+
+    def find_contact(self, customer, first_name):
+        return self.contacts.get((customer, normalize_text(first_name)))
+
+    def add_contact(self, customer, first_name, contact):
+        self._add(self.contacts, (customer, normalize_text(first_name)), contact)
+
+    def _add(self, mapping, key, value):
+        if key not in mapping:
+            mapping[key] = value
+            self._added.append((mapping, key))
+
+    def savepoint(self):
+        """Keep the entries added so far, called together with the database savepoint."""
+        self._added = []
+
+    def rollback(self):
+        """Forget the entries added since the last savepoint, whose records were rolled back."""
+        for mapping, key in reversed(self._added):
+            mapping.pop(key, None)
+        self._added = []
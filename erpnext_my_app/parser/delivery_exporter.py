@@ -0,0 +1,332 @@
+import frappe
+from frappe.utils import add_days, get_datetime, getdate, now_datetime, nowdate
+from erpnext_my_app.parser.utils import *
+from erpnext_my_app.parser.csv_file import CsvFileWriter
+from erpnext_my_app.parser.carrier_layouts import get_carrier_layout
+from erpnext_my_app.parser.instrumentation import StageTimer
+
+logger = frappe.logger("erpnext_my_app")
+
+
+def safe_date_field(doc, fieldname):
+    val = doc.get(fieldname)
+    return val.strftime("%Y%m%d") if val else ""
+
+
+def get_watermark(value):
+    """Normalize a stored watermark; the old [modified, name] form is read as a creation watermark."""
+    if not value:
+        return None
+    if isinstance(value, (list, tuple)):
+        return {"creation": value[0], "name": value[1], "drafts": []}
+    return {"creation": value["creation"], "name": value.get("name") or "", "drafts": value.get("drafts") or []}
+
+
+class DeliveryExporter:
+    """Exports the Delivery Notes of a list of Sales Orders to a carrier label CSV."""
+
+    def __init__(self, carrier: str = "upack", ignore_pending_orders: bool = True, progress=None, timer=None):
+        self.carrier = carrier
+        self.ignore_pending_orders = ignore_pending_orders
+        self.progress = progress
+        self.errors = []
+        self.count = 0
+        # 增量导出时只导出这些发货单，以及导出后新的水位
+        self.delivery_note_names = None
+        self.watermark = None
+        # 记录查询、生成和保存文件各阶段的耗时与查询次数
+        self.timer = timer or StageTimer(f"DeliveryExporter {carrier}")
+
+    def select_since(self, watermark=None, from_date=None):
+        """
+        Restrict the export to the Delivery Notes created after the (creation, name)
+        watermark, plus the drafts pending at the last export that were submitted
+        since, and return their Sales Orders in creation order. Billing or status
+        updates change `modified` but not `creation`, so exported notes are not
+        exported again. Without a watermark the export starts at `from_date`, or
+        exports nothing and only sets the watermark to now.
+        """
+        watermark = get_watermark(watermark)
+        if not watermark:
+            if not from_date:
+                # 第一次增量导出：不导出全部历史发货单，从现在开始记录水位
+                now = str(now_datetime())
+                self.delivery_note_names = set()
+                self.watermark = {"creation": now, "name": "", "drafts": self._get_drafts(None, now)}
+                return []
+            watermark = {"creation": f"{getdate(from_date)} 00:00:00", "name": "", "drafts": []}
+
+        filters = [
+            ["Delivery Note", "docstatus", "=", 1],
+            ["Delivery Note", "is_return", "=", 0],
+            ["Delivery Note", "status", "not in", ["Return", "Return Issued"]],
+            ["Delivery Note Item", "against_sales_order", "is", "set"],
+        ]
+        fields = ["name", "creation", "`tabDelivery Note Item`.against_sales_order as sales_order"]
+        order_by = "`tabDelivery Note`.creation asc, `tabDelivery Note`.name asc"
+        last = (get_datetime(watermark["creation"]), watermark["name"])
+
+        # 上次导出时还是草稿、之后才提交的发货单
+        drafts = set(watermark["drafts"])
+        delivery_notes = []
+        for names in chunks(drafts):
+            delivery_notes += frappe.get_all(
+                "Delivery Note", filters=filters + [["Delivery Note", "name", "in", names]],
+                fields=fields, order_by=order_by, distinct=True,
+            )
+        # 只扫描水位之后新建的发货单
+        delivery_notes += frappe.get_all(
+            "Delivery Note", filters=filters + [["Delivery Note", "creation", ">=", watermark["creation"]]],
+            fields=fields, order_by=order_by, distinct=True,
+        )
+
+        sale_order_ids = {}
+        self.delivery_note_names = set()
+        for dn in sorted(delivery_notes, key=lambda dn: (dn.creation, dn.name)):
+            if dn.name not in drafts and (dn.creation, dn.name) <= last:
+                continue
+            self.delivery_note_names.add(dn.name)
+            sale_order_ids.setdefault(dn.sales_order, None)
+            if (dn.creation, dn.name) > last:
+                last = (dn.creation, dn.name)
+        self.watermark = {"creation": str(last[0]), "name": last[1], "drafts": self._get_drafts(watermark, last[0])}
+        return list(sale_order_ids)
+
+    def _get_drafts(self, watermark, creation):
+        """
+        Draft Delivery Notes checked again on the next export: the drafts created
+        since the previous watermark up to `creation`, and the previous drafts
+        that are still drafts (submitted, cancelled or deleted ones drop out).
+        Drafts older than EXPORT_DRAFT_MAX_DAYS are not carried over.
+        """
+        oldest = add_days(now_datetime(), -EXPORT_DRAFT_MAX_DAYS)
+        since = max(get_datetime(watermark["creation"]), oldest) if watermark else oldest
+        drafts = frappe.get_all(
+            "Delivery Note",
+            filters=[
+                ["Delivery Note", "docstatus", "=", 0],
+                ["Delivery Note", "creation", ">", since],
+                ["Delivery Note", "creation", "<=", creation],
+            ],
+            pluck="name",
+        )
+        # 上次记录的草稿中仍未提交的部分
+        for names in chunks(set(watermark["drafts"]) if watermark else ()):
+            drafts += frappe.get_all(
+                "Delivery Note",
+                filters=[
+                    ["Delivery Note", "name", "in", names],
+                    ["Delivery Note", "docstatus", "=", 0],
+                    ["Delivery Note", "creation", ">=", oldest],
+                ],
+                pluck="name",
+            )
+        return sorted(set(drafts))
+
+    def _load(self, sale_order_ids):
+        """Load SOs, their submitted DNs, items, customers, contacts and addresses in chunked bulk queries."""
+        self.sales_orders = {}
+        self.so_items = {}
+        self.dns_by_so = {}
+        self.delivery_notes = {}
+        self.dn_items = {}
+        self._address_values = {}
+
+        so_meta = frappe.get_meta("Sales Order")
+        so_fields = [
+            "name", "customer", "company", "customer_group", "contact_person",
+            "shipping_address_name", "customer_address",
+        ] + [field for field in ("amazon_order_id", "my_delivery_date") if so_meta.has_field(field)]
+
+        for ids in chunks(set(sale_order_ids)):
+            for so in frappe.get_all("Sales Order", filters={"name": ["in", ids]}, fields=so_fields):
+                self.sales_orders[so.name] = so
+
+            # 只保留已提交、非退货的 Delivery Note
+            delivery_notes = frappe.get_all(
+                "Delivery Note",
+                filters=[
+                    ["Delivery Note", "docstatus", "=", 1],
+                    ["Delivery Note", "is_return", "=", 0],  # ✅ 排除退货
+                    ["Delivery Note", "status", "not in", ["Return", "Return Issued"]],  # 排除退货和已发货的状态
+                    ["Delivery Note Item", "against_sales_order", "in", ids],
+                ],
+                fields=["name", "customer", "contact_person", "`tabDelivery Note Item`.against_sales_order as sales_order"],
+                distinct=True,
+            )
+            for dn in delivery_notes:
+                if self.delivery_note_names is not None and dn.name not in self.delivery_note_names:
+                    continue
+                self.delivery_notes[dn.name] = dn
+                dn_names = self.dns_by_so.setdefault(dn.sales_order, [])
+                if dn.name not in dn_names:
+                    dn_names.append(dn.name)
+
+            # 没有发货单时按销售订单的商品打印面单
+            for item in frappe.get_all(
+                "Sales Order Item",
+                filters={"parent": ["in", ids], "parenttype": "Sales Order"},
+                fields=["parent", "item_name", "qty"],
+                order_by="parent, idx",
+            ):
+                self.so_items.setdefault(item.parent, []).append(item)
+
+        for names in chunks(self.delivery_notes):
+            for item in frappe.get_all(
+                "Delivery Note Item",
+                filters={"parent": ["in", names], "parenttype": "Delivery Note"},
+                fields=["parent", "item_name", "qty"],
+                order_by="parent, idx",
+            ):
+                self.dn_items.setdefault(item.parent, []).append(item)
+
+        customers = {so.customer for so in self.sales_orders.values()} | {dn.customer for dn in self.delivery_notes.values()}
+        contacts = {so.contact_person for so in self.sales_orders.values()} | {dn.contact_person for dn in self.delivery_notes.values()}
+        addresses = {so.shipping_address_name or so.customer_address for so in self.sales_orders.values()}
+        companies = {so.company for so in self.sales_orders.values()}
+
+        self.customers = self._get_map("Customer", customers, ["name", "customer_name", "mobile_no"])
+        self.contacts = self._get_map("Contact", contacts, ["name", "first_name"])
+        self.addresses = self._get_map("Address", addresses, ["name", "phone", "address_line1", "city", "state", "pincode"])
+        self.companies = self._get_map("Company", companies, ["name", "company_name"])
+
+    def _get_map(self, doctype, names, fields):
+        records = {}
+        for values in chunks({name for name in names if name}):
+            for record in frappe.get_all(doctype, filters={"name": ["in", values]}, fields=fields):
+                records[record.name] = record
+        return records
+
+    def export(self, sale_order_ids=None, pages=None):
+        """
+        Write the label CSV and save it as a File, returns the File doc.
+        The Sales Orders are given as one list or as an iterable of pages,
+        each page is loaded and written before the next one is read.
+        """
+        # 边生成边编码写入文件，内存中不保留整个 CSV
+        layout = get_carrier_layout(self.carrier)
+        writer = CsvFileWriter("delivery_export.csv", layout.encoding, quoting=layout.quoting)
+        writer.writerow(layout.headers)
+
+        try:
+            for page in self.timer.iterate("select", pages if pages is not None else [sale_order_ids]):
+                with self.timer.stage("load"):
+                    self._load(page)
+                with self.timer.stage("render"):
+                    self._write_rows(writer, layout, page)
+        except Exception:
+            writer.discard()
+            raise
+
+        if self.progress:
+            self.progress.finish()
+
+        # 注册为 Frappe 文件
+        with self.timer.stage("save_file"):
+            return writer.save()
+
+    def _write_rows(self, writer, layout, sale_order_ids):
+        now = nowdate().replace("-", "")
+        for so_id in sale_order_ids:
+            if self.progress:
+                self.progress.update()
+            so = self.sales_orders.get(so_id)
+            if not so:
+                logger.error(f"export_delivery_notes_to_csv: Sales Order {so_id} not found.")
+                self.errors.append(f"销售订单未找到: {so_id}<br>")
+                continue
+            dn_names = self.dns_by_so.get(so_id, [])
+
+            if not dn_names and self.ignore_pending_orders:
+                logger.error(f"export_delivery_notes_to_csv: No Delivery Notes found for Sales Order {so_id}.")
+                self.errors.append(f"销售订单没有关联的发货单: {so_id}<br>")
+                continue
+
+            amazon_order_id = so.get("amazon_order_id") or ""
+            context = {
+                "amazon_order_id": amazon_order_id,
+                "company_name": (self.companies.get(so.company) or frappe._dict()).company_name or "",
+                "my_delivery_date": safe_date_field(so, "my_delivery_date"),  # 获取自定义的交货日期字段
+                "delivery_date": now,
+            }
+            context.update(self._get_address_values(so.shipping_address_name or so.customer_address))
+
+            self.count += 1
+            if dn_names:
+                for dn_name in dn_names:
+                    dn = self.delivery_notes[dn_name]
+                    customer = self.customers.get(dn.customer) or frappe._dict()
+                    customer_name = customer.customer_name or ""
+                    customer_phone = customer.mobile_no or ""
+                    contact = (self.contacts.get(dn.contact_person) or frappe._dict()).first_name or customer_name
+
+                    # 如果是线下客户群组的订单，则联系人不填
+                    if so.customer_group == "线下":
+                        contact = ""
+
+                    item_names, item_counts, item_names_list = self._get_item_values(so, dn_name)
+                    self._write_row(writer, layout, context, dn_name, customer_name, customer_phone, contact,
+                        item_names, item_counts, item_names_list)
+
+            else:
+                # 如果没有找到发货单，则将订单中的所有商品作为一个包裹来打印面单
+                customer = self.customers.get(so.customer) or frappe._dict()
+                customer_name = customer.customer_name or ""
+                customer_phone = customer.mobile_no or ""
+                contact = (self.contacts.get(so.contact_person) or frappe._dict()).first_name or customer_name
+
+                # 如果是线下客户群组的订单，则联系人不填
+                if so.customer_group == "线下":
+                    contact = ""
+
+                item_names, item_counts, item_names_list = self._get_item_values(so)
+                self._write_row(writer, layout, context, "", customer_name, customer_phone, contact,
+                    item_names, item_counts, item_names_list)
+
+    def _get_item_values(self, so, dn_name=None):
+        """
+        Item names, total qty and the six item note columns of one parcel:
+        the Delivery Note's items, or all Sales Order items when no Delivery Note exists.
+        """
+        items = self.dn_items.get(dn_name, []) if dn_name else self.so_items.get(so.name, [])
+        amazon_order_id = so.get("amazon_order_id") or ""
+
+        # 获取商品名称和数量
+        item_names_list = [item.item_name + "*" + str(item.qty) for item in items]
+        item_names = "".join(" " + name for name in item_names_list)
+        item_counts = sum(item.qty for item in items)
+        if dn_name:
+            item_names_list.extend([""] * (6 - len(item_names_list)))  # 填充到 6 个空位
+            item_names_list[3] = "われもの注意"
+            item_names_list[4] = dn_name  # 将发货单名称放在第五个位置
+            item_names_list[5] = amazon_order_id  # 将亚马逊订单号放在第六个位置
+        elif len(item_names_list) < 6:
+            item_names_list.extend([""] * (6 - len(item_names_list)))  # 填充到 6 个空位
+            item_names_list[5] = amazon_order_id  # 将亚马逊订单号放在第六个位置
+        return item_names, item_counts, item_names_list
+
+    def _get_address_values(self, address_name):
+        """Formatted shipping address columns, computed once per address."""
+        values = self._address_values.get(address_name)
+        if values is None:
+            address = self.addresses.get(address_name) or frappe._dict()
+            values = self._address_values[address_name] = {
+                "address_phone": address.phone or "",
+                "address_line1": address.address_line1 or "",
+                "city": address.city or "",
+                "state": address.state or "",
+                "pincode": address.pincode or "",
+            }
+        return values
+
+    def _write_row(self, writer, layout, context, dn_name, customer_name, customer_phone, contact,
+            item_names, item_counts, item_names_list):
+        context["dn_name"] = dn_name
+        context["customer_name"] = customer_name
+        context["customer_phone"] = customer_phone
+        context["contact"] = contact
+        context["item_names"] = item_names
+        context["item_count"] = item_counts
+        for i, note in enumerate(item_names_list[:6], 1):
+            context[f"item_note_{i}"] = note
+        writer.writerow(layout.build_row(context))
@@ -1,70 +1,223 @@
 import frappe
 import importlib
 from frappe.utils import getdate
+from erpnext_my_app.parser.utils import *
+from erpnext_my_app.parser.checkpoint import ImportCheckpoint
+from erpnext_my_app.parser.commit_batch import CommitBatcher
+from erpnext_my_app.parser.instrumentation import StageTimer
 
 logger = frappe.logger("erpnext_my_app")
 
+def partition_by_delivery_note(orders, size, lanes=IMPORT_SHARD_LANES, buckets=None):
+    """
+    Route streamed records to buckets by Delivery Note and yield each bucket as
+    a shard once it holds `size` records, so shards start while the file is
+    still being parsed. Rows of a Delivery Note share a bucket; the per-Delivery
+    Note lock of the shard jobs keeps the duplicate check correct across shards.
+    `buckets` (see partition_stream) exposes the records not yet handed out.
+    """
+    for _, shard in partition_stream(orders, size, lambda order: get_lane(order.get("delivery_note_id"), lanes), buckets):
+        yield shard
+
+
 class DeliveryImporter:
-    def __init__(self, carrier: str):
+    def __init__(self, carrier: str, progress=None, lock_delivery_notes: bool = False, timer=None):
         self.carrier = carrier
         self.errors = []
         self.orders_count = 0
+        # 可选的 ProgressReporter，用于定期推送导入进度
+        self.progress = progress
+        # 多个后台任务并行导入时，创建装运单前锁住发货单并重新检查是否已有装运单
+        self.lock_delivery_notes = lock_delivery_notes
+        self.pending_tracking_numbers = {}
+        # 记录解析、预加载和创建装运单各阶段的耗时与查询次数
+        self.timer = timer or StageTimer(f"DeliveryImporter {carrier}")
 
-    def import_orders(self, file_url: str):
+    def iter_orders(self, file_url: str, checkpoint=None):
+        """Stream the shipment records of a carrier file, one per delivery note."""
         # 根据快递公司创建对应的快递单解析器
         parser_module = f"erpnext_my_app.parser.{self.carrier}"
         parser_class_name = f"{self.carrier.capitalize()}Parser"
         parser_module = importlib.import_module(parser_module)
         parser_class = getattr(parser_module, parser_class_name)
-        parser = parser_class(file_url)
-        orders = parser.parse()
-        self.orders_count = len(orders)
+        parser = parser_class(file_url, stream=True)
+        parser.timer = self.timer
+        # 断点之前的行直接跳过，不再解析
+        parser.resume_line = checkpoint.line if checkpoint else 0
+        for order in self.timer.iterate("parse", parser.iter_orders()):
+            self.orders_count += 1
+            yield order
+
+    def parse(self, file_url: str):
+        return list(self.iter_orders(file_url))
+
+    def import_orders(self, file_url: str, orders=None, checkpoint=None):
+        # 同一文件再次提交时，从上次提交的发货单之后继续导入
+        checkpoint = checkpoint or ImportCheckpoint("shipments", file_url, "delivery_note_id")
+        if orders is None:
+            # 边解析边导入，不在内存中保留整个文件
+            orders = self.iter_orders(file_url, checkpoint)
+        elif self.progress:
+            self.progress.total = self.orders_count
+
+        shippments = self.create_shipments(orders, checkpoint)
+        checkpoint.clear()
+        return shippments
 
-        #logger.error(f"DeliveryImporter: Delivery parser has done: {len(orders)} records found.")
+    def create_shipments(self, orders, checkpoint=None):
+        def save():
+            # 提交前写入排队的快递单号和导入断点
+            self._update_tracking_numbers()
+            if checkpoint:
+                checkpoint.save()
+
+        batcher = CommitBatcher("shipments", on_save=save, timer=self.timer)
 
         # 将快递单号同步到ERPNext
         shippments = []
-        for shippment_data in orders:
-            s = self._create_shippment(shippment_data)
-            if s:
-                shippments.append(s.name)
+        for batch in chunks(orders, SHIPMENT_PRELOAD_BATCH_SIZE):
+            # 每批记录先批量加载涉及的发货单、商品和已有的装运单
+            with self.timer.stage("preload"):
+                self._preload({order.get("delivery_note_id") for order in batch})
+            for shippment_data in batch:
+                s = self._create_shippment_isolated(shippment_data)
+                if s:
+                    shippments.append(s.name)
+                if checkpoint:
+                    checkpoint.advance(shippment_data)
+                batcher.add()
+                if self.progress:
+                    self.progress.update()
+        self._update_tracking_numbers()
         return shippments
 
+    def _preload(self, delivery_note_ids):
+        """Load the Delivery Notes, their items, the existing non-cancelled Shipments and item weights in chunked bulk queries."""
+        self.delivery_notes = {}
+        self.dn_items = {}
+        self.shipped_delivery_notes = set()
+        self.items = {}
+        # 销售订单当前的快递单号（等待批量写入的新快递单号跨批次保留，在提交前写入）
+        self.tracking_numbers = {}
+
+        for names in chunks({name for name in delivery_note_ids if name}):
+            for dn in frappe.get_all(
+                "Delivery Note",
+                filters={"name": ["in", names]},
+                fields=[
+                    "name", "company_address", "posting_date", "posting_time", "customer",
+                    "shipping_address_name", "contact_person", "contact_display",
+                ],
+            ):
+                self.delivery_notes[dn.name] = dn
+
+            for item in frappe.get_all(
+                "Delivery Note Item",
+                filters={"parent": ["in", names], "parenttype": "Delivery Note"},
+                fields=["parent", "item_code", "item_name", "qty", "amount", "against_sales_order"],
+                order_by="parent, idx",
+            ):
+                self.dn_items.setdefault(item.parent, []).append(item)
+
+            # 已经关联了未取消装运单的发货单
+            self.shipped_delivery_notes.update(
+                shipment.delivery_note for shipment in frappe.get_all(
+                    "Shipment",
+                    filters=[
+                        ["Shipment", "docstatus", "!=", 2],  # 不是已取消
+                        ["Shipment Delivery Note", "delivery_note", "in", names],
+                    ],
+                    fields=["`tabShipment Delivery Note`.delivery_note as delivery_note"],
+                    distinct=True,
+                )
+            )
+
+        item_codes = {item.item_code for items in self.dn_items.values() for item in items}
+        for codes in chunks(item_codes):
+            for item in frappe.get_all(
+                "Item",
+                filters={"name": ["in", codes]},
+                fields=["name", "item_name", "weight_per_unit", "weight_uom"],
+            ):
+                self.items[item.name] = item
+
+        if frappe.get_meta("Sales Order").has_field("custom_tracking_number"):
+            order_ids = {items[0].against_sales_order for items in self.dn_items.values() if items[0].against_sales_order}
+            for ids in chunks(order_ids):
+                for so in frappe.get_all("Sales Order", filters={"name": ["in", ids]}, fields=["name", "custom_tracking_number"]):
+                    self.tracking_numbers[so.name] = so.custom_tracking_number or ""
+
+    def _update_tracking_numbers(self):
+        """Write the queued tracking numbers with batched UPDATE statements, without loading or saving the Sales Orders."""
+        if not self.pending_tracking_numbers:
+            return
+        with self.timer.stage("tracking_numbers"):
+            frappe.db.bulk_update("Sales Order", {
+                order_id: {"custom_tracking_number": tracking_number}
+                for order_id, tracking_number in self.pending_tracking_numbers.items()
+            })
+        self.pending_tracking_numbers = {}
+
+    def _lock_delivery_note(self, delivery_note_id):
+        """
+        Lock the Delivery Note row until the transaction commits and return whether
+        it already has a non-cancelled Shipment, read with a locking read so
+        Shipments committed by other workers are seen.
+        """
+        frappe.db.get_value("Delivery Note", delivery_note_id, "name", for_update=True)
+        return bool(frappe.get_all(
+            "Shipment",
+            filters=[
+                ["Shipment", "docstatus", "!=", 2],  # 不是已取消
+                ["Shipment Delivery Note", "delivery_note", "=", delivery_note_id],
+            ],
+            pluck="name",
+            limit=1,
+            for_update=True,
+        ))
+
+    def _create_shippment_isolated(self, shipment_data):
+        # 每条快递记录使用一个保存点，失败时只回滚这一条
+        frappe.db.savepoint(IMPORT_SAVEPOINT)
+        try:
+            return self._create_shippment(shipment_data)
+        except Exception as e:
+            frappe.db.rollback(save_point=IMPORT_SAVEPOINT)
+            delivery_note_id = shipment_data.get("delivery_note_id")
+            logger.error(f"DeliveryImporter: failed to create Shipment for Delivery Note {delivery_note_id}: {e}")
+            self.errors.append(f"装运单创建失败：{delivery_note_id} {e}<br>")
+            return None
+
     def _create_shippment(self, shipment_data):
         delivery_note_id = shipment_data.get("delivery_note_id")
         tracking_number = shipment_data.get("tracking_no")
         carrier = shipment_data.get("carrier")
         shipping_date = shipment_data.get("shipping_date")
 
-        # 加载 Delivery Note 文档
-        dn = frappe.get_doc("Delivery Note", delivery_note_id)
-        
+        dn = self.delivery_notes.get(delivery_note_id)
+
         # 检查发货单是否存在
         if not dn:
             logger.error(f"DeliveryImporter: Delivery Note {delivery_note_id} not found.")
             self.errors.append(f"发货单不存在： {delivery_note_id}<br>")
             return None
 
-        order_id = dn.items[0].against_sales_order if dn.items else None
-        # 更新销售订单中的自定义字段“快递单号”
-        #so = frappe.get_doc("Sales Order", shipment_data.get("amazon_order_id"))
-        so = frappe.get_doc("Sales Order", order_id)
-        if so:
-            so.custom_tracking_number = f"{tracking_number} ({carrier})"
-            so.save()
+        dn_items = self.dn_items.get(delivery_note_id, [])
+        order_id = dn_items[0].against_sales_order if dn_items else None
+
+        if self.lock_delivery_notes:
+            with self.timer.stage("lock"):
+                if self._lock_delivery_note(delivery_note_id):
+                    self.shipped_delivery_notes.add(delivery_note_id)
 
         # 检查是否已经存在对应发货单的 Shipment
-        existing_shipment = frappe.db.exists("Shipment", {
-            "delivery_note": delivery_note_id,
-            "docstatus": ["!=", 2]  # 不是已取消
-        })
-        if existing_shipment:
+        if delivery_note_id in self.shipped_delivery_notes:
             logger.error(f"DeliveryImporter: Shipment for Delivery Note {delivery_note_id} already exists.")
             self.errors.append(f"发货单对应的装运单已经存在：{delivery_note_id}<br>")
             return None
 
         # 估算总价值（简单求和）
-        total_value = sum([item.amount for item in dn.items])
+        total_value = sum([item.amount for item in dn_items])
 
         #logger.error(f"DeliveryImporter: Creating Shipment for Delivery Note {delivery_note_id} with tracking number {tracking_number}.")
         # 创建 Shipment
@@ -95,9 +248,9 @@ class DeliveryImporter:
         })
         
         # 添加 Shipment Parcel 信息
-        for i in dn.items:
+        for i in dn_items:
             #logger.error(f"DeliveryImporter: Item code {i.item_name}.")
-            item = frappe.get_doc("Item", i.item_code)
+            item = self.items.get(i.item_code)
             if not item:
                 logger.error(f"DeliveryImporter: Item {i.item_name} not found.")
                 self.errors.append(f"出货单的商品没有找到： {i.item_name}[出货单: {delivery_note_id}]<br>")
@@ -113,6 +266,16 @@ class DeliveryImporter:
                     "dimension_uom": "cm",
             })
 
-        shipment.insert(ignore_permissions=True)
-        shipment.submit()
+        with self.timer.stage("shipment_insert"):
+            shipment.insert(ignore_permissions=True)
+        with self.timer.stage("shipment_submit"):
+            shipment.submit()
+        # 文件中同一发货单的后续行视为重复
+        self.shipped_delivery_notes.add(delivery_note_id)
+
+        # 装运单创建成功后才更新销售订单中的自定义字段“快递单号”，值没有变化时不更新
+        tracking_value = f"{tracking_number} ({carrier})"
+        if order_id in self.tracking_numbers and self.tracking_numbers[order_id] != tracking_value:
+            self.tracking_numbers[order_id] = tracking_value
+            self.pending_tracking_numbers[order_id] = tracking_value
         return shipment
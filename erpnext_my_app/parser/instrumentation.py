@@ -0,0 +1,246 @@
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+import frappe
+from erpnext_my_app.parser.utils import *
+
+logger = frappe.logger("erpnext_my_app")
+
+# 归一化 SQL 语句时替换掉的字面量和参数
+SQL_STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\"")
+SQL_PARAM = re.compile(r"%\(\w+\)s|%s")
+SQL_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+SQL_VALUE_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+SQL_WHITESPACE = re.compile(r"\s+")
+# 事务控制语句不算作数据查询
+SQL_TRANSACTION_KEYWORDS = {"savepoint", "release", "rollback", "commit", "start", "begin"}
+
+
+def get_query_kind(query):
+    """Classify a SQL statement as select, insert, update, delete, transaction or other."""
+    words = str(query or "").lstrip(" \t\r\n(").split(None, 1)
+    keyword = words[0].lower() if words else ""
+    if keyword in ("select", "with"):
+        return "select"
+    if keyword in ("insert", "update", "delete"):
+        return keyword
+    if keyword in SQL_TRANSACTION_KEYWORDS:
+        return "transaction"
+    return "other"
+
+
+def get_query_shape(query):
+    """Normalize a SQL statement so that statements differing only in their values compare equal."""
+    shape = SQL_STRING.sub("?", str(query or ""))
+    shape = SQL_PARAM.sub("?", shape)
+    shape = SQL_NUMBER.sub("?", shape)
+    # IN 列表的长度不影响语句形状
+    shape = SQL_VALUE_LIST.sub("(?)", shape)
+    return SQL_WHITESPACE.sub(" ", shape).strip().lower()
+
+
+class QueryCounter:
+    """
+    Counts the SQL statements sent through frappe.db.sql while installed.
+    Installs may nest; the counter is detached when the outermost one ends.
+    All counters installed on a connection share one wrapper, so they can
+    be installed and uninstalled in any order.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._depth = 0
+        self._db = None
+
+    @property
+    def installed(self):
+        """Whether the counter is attached to the current database connection."""
+        return self._db is not None and self._db is getattr(frappe.local, "db", None)
+
+    def install(self):
+        self._depth += 1
+        if self._depth > 1:
+            return self
+        self._db = frappe.local.db
+        counted_sql = vars(self._db).get("sql")
+        if not hasattr(counted_sql, "query_counters"):
+            # 第一个计数器：包装当前连接对象上的 sql 方法，之后的计数器共用这个包装
+            sql = self._db.sql
+
+            def counted_sql(*args, **kwargs):
+                query = args[0] if args else kwargs.get("query")
+                for counter in counted_sql.query_counters:
+                    counter.record(query)
+                return sql(*args, **kwargs)
+
+            counted_sql.query_counters = []
+            counted_sql.previous = vars(self._db).get("sql")
+            self._db.sql = counted_sql
+        counted_sql.query_counters.append(self)
+        return self
+
+    def uninstall(self):
+        self._depth -= 1
+        if self._depth > 0:
+            return
+        counted_sql = vars(self._db).get("sql")
+        counters = getattr(counted_sql, "query_counters", [])
+        if self in counters:
+            counters.remove(self)
+        # 最后一个计数器移除时恢复原来的 sql 方法
+        if counted_sql is not None and not counters:
+            if counted_sql.previous is None:
+                del self._db.sql
+            else:
+                self._db.sql = counted_sql.previous
+        self._db = None
+
+    def record(self, query):
+        self.count += 1
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.uninstall()
+        return False
+
+
+class QueryProfile(QueryCounter):
+    """
+    Counts the SQL statements by kind and by shape, to find N+1 patterns
+    (the same statement shape run once per record) and to let tests and
+    benchmarks enforce a query budget per record.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.kinds = Counter()
+        self.shapes = Counter()
+
+    def record(self, query):
+        super().record(query)
+        self.kinds[get_query_kind(query)] += 1
+        self.shapes[get_query_shape(query)] += 1
+
+    @property
+    def data_queries(self):
+        """Number of statements other than transaction control (savepoints, commits)."""
+        return self.count - self.kinds["transaction"]
+
+    def repeated_shapes(self, min_count: int = 2):
+        """Data statement shapes run at least `min_count` times, most frequent first."""
+        return [
+            (shape, count) for shape, count in self.shapes.most_common()
+            if count >= min_count and get_query_kind(shape) != "transaction"
+        ]
+
+    def report(self, limit: int = 10):
+        lines = [f"{self.count} queries: " + ", ".join(f"{kind} {count}" for kind, count in self.kinds.most_common())]
+        lines += [f"{count}x {shape[:200]}" for shape, count in self.repeated_shapes()[:limit]]
+        return "\n".join(lines)
+
+    def assert_within(self, records: int, max_per_record: float, max_repeats: int | None = None):
+        """
+        Raise AssertionError when the data statements exceed `max_per_record` per
+        record, or when one statement shape was run more than `max_repeats` times.
+        """
+        per_record = self.data_queries / max(records, 1)
+        if per_record > max_per_record:
+            raise AssertionError(
+                f"{self.data_queries} queries for {records} records ({per_record:.2f} per record, "
+                f"limit {max_per_record}).\n{self.report()}"
+            )
+        if max_repeats is not None:
+            repeated = self.repeated_shapes(max_repeats + 1)
+            if repeated:
+                raise AssertionError(
+                    f"{len(repeated)} query shapes run more than {max_repeats} times (N+1).\n{self.report()}"
+                )
+
+
+class StageTimer:
+    """
+    Records wall time, call count and SQL query count per named stage of a job.
+    Time and queries of a nested stage are not counted in its parent, so the
+    stages add up to the tracked total. The query counter is installed when
+    the first stage starts and stays installed until summary(); stages only
+    read its count.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.stages = {}
+        self.queries = QueryCounter()
+        self.started_at = time.perf_counter()
+        # 正在执行的阶段：[开始时间, 开始时的查询数, 子阶段耗时, 子阶段查询数]
+        self._stack = []
+        self._counting = False
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.queries.installed:
+            self.start_counting()
+        frame = [time.perf_counter(), self.queries.count, 0.0, 0]
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            seconds = time.perf_counter() - frame[0]
+            queries = self.queries.count - frame[1]
+            stats = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "queries": 0})
+            stats["calls"] += 1
+            stats["seconds"] += seconds - frame[2]
+            stats["queries"] += queries - frame[3]
+            if self._stack:
+                self._stack[-1][2] += seconds
+                self._stack[-1][3] += queries
+
+    def start_counting(self):
+        # 数据库连接被替换时（如重新连接）改装到新的连接上
+        self.stop_counting()
+        self.queries.install()
+        self._counting = True
+
+    def stop_counting(self):
+        if self._counting:
+            self.queries.uninstall()
+            self._counting = False
+
+    def iterate(self, name: str, iterable):
+        """Yield the items of `iterable`, timing the production of each item as one call of stage `name`."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def summary(self):
+        # 作业结束时移除查询计数器；之后再进入阶段会重新安装
+        if not self._stack:
+            self.stop_counting()
+        elapsed = time.perf_counter() - self.started_at
+        stages = {
+            name: {"calls": stats["calls"], "seconds": round(stats["seconds"], 3), "queries": stats["queries"]}
+            for name, stats in self.stages.items()
+        }
+        return {
+            "elapsed": round(elapsed, 3),
+            # 不属于任何阶段的时间
+            "untracked": round(max(elapsed - sum(stats["seconds"] for stats in self.stages.values()), 0.0), 3),
+            "queries": sum(stats["queries"] for stats in self.stages.values()),
+            "stages": stages,
+        }
+
+    def log(self):
+        summary = self.summary()
+        stages = ", ".join(
+            f"{name} {stats['seconds']}s/{stats['calls']} calls/{stats['queries']} queries"
+            for name, stats in sorted(summary["stages"].items(), key=lambda item: -item[1]["seconds"])
+        )
+        logger.info(f"{self.name}: {summary['elapsed']}s, {summary['queries']} queries; {stages}")
+        return summary
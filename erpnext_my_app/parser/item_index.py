@@ -0,0 +1,100 @@
+import re
+import frappe
+from erpnext_my_app.parser.utils import *
+
+logger = frappe.logger("erpnext_my_app")
+
+# custom_amazon_sku 字段里可能登记了多个亚马逊 SKU，用这些分隔符切分
+SKU_SEPARATORS = re.compile(r"[\s,;|、，；]+")
+
+
+def split_skus(value):
+    """Split a multi-SKU custom_amazon_sku value into individual SKUs."""
+    if not value:
+        return []
+    return [sku for sku in SKU_SEPARATORS.split(value) if sku]
+
+
+class ItemIndex:
+    """In-memory SKU → item_code index and item master data, built once per import job."""
+
+    def __init__(self, company=COMPANY_NAME_DEFAULT, price_list=PRICE_LIST_DEFAULT):
+        self.company = company
+        self.price_list = price_list
+        self.sku_index = {}
+        self.items = {}
+
+    def resolve_skus(self, skus):
+        """Resolve all SKUs of a file with a single Item query, returns {sku: item_code}."""
+        skus = {sku for sku in skus if sku}
+        if not skus:
+            return self.sku_index
+
+        items = frappe.get_all(
+            "Item",
+            filters={"custom_amazon_sku": ["is", "set"]},
+            fields=["item_code", "custom_amazon_sku"],
+        )
+
+        # 按分隔符拆开 custom_amazon_sku，建立 SKU → 商品编码的精确索引
+        token_index = {}
+        for item in items:
+            for token in split_skus(item.custom_amazon_sku):
+                token_index.setdefault(token.lower(), item.item_code)
+
+        unresolved = []
+        for sku in skus:
+            item_code = token_index.get(sku.lower())
+            if item_code:
+                self.sku_index[sku] = item_code
+            else:
+                unresolved.append(sku)
+
+        # 精确匹配不到的 SKU，在内存中按原来 like '%sku%' 的方式做包含匹配
+        for sku in unresolved:
+            needle = sku.lower()
+            for item in items:
+                if needle in item.custom_amazon_sku.lower():
+                    self.sku_index[sku] = item.item_code
+                    break
+
+        logger.info(f"ItemIndex: resolved {len(self.sku_index)} of {len(skus)} SKUs from {len(items)} items.")
+        return self.sku_index
+
+    def get_item_code(self, sku):
+        return self.sku_index.get(sku)
+
+    def preload_items(self, item_codes=None):
+        """
+        Bulk load item name and selling rate for the resolved items. The Item Default
+        warehouse is not loaded, orders always ship from WAREHOUSE_NAME_DEFAULT.
+        """
+        if item_codes is None:
+            item_codes = self.sku_index.values()
+        item_codes = {code for code in item_codes if code and code not in self.items}
+        if not item_codes:
+            return self.items
+
+        for codes in chunks(item_codes):
+            for item in frappe.get_all("Item", filters={"name": ["in", codes]}, fields=["name", "item_name"]):
+                self.items[item.name] = {
+                    "item_name": item.item_name or item.name,
+                    "rate": 0.0,
+                }
+
+            # 价格表中的销售单价（同一商品有多条价格时取第一条，与 get_value 一致）
+            prices = frappe.get_all(
+                "Item Price",
+                filters={"item_code": ["in", codes], "price_list": self.price_list},
+                fields=["item_code", "price_list_rate"],
+            )
+            priced = set()
+            for price in prices:
+                if price.item_code in self.items and price.item_code not in priced:
+                    self.items[price.item_code]["rate"] = price.price_list_rate or 0.0
+                    priced.add(price.item_code)
+
+        return self.items
+
+    def get_item(self, item_code):
+        return self.items.get(item_code)
@@ -1,39 +1,138 @@
 import frappe
 import importlib
 from erpnext_my_app.parser.utils import *
+from erpnext_my_app.parser.customer_index import CustomerIndex
+from erpnext_my_app.parser.checkpoint import ImportCheckpoint
+from erpnext_my_app.parser.commit_batch import CommitBatcher
+from erpnext_my_app.parser.instrumentation import StageTimer
+from erpnext_my_app.parser.postal_codes import (
+    JP_COUNTRY_CODES,
+    JP_POSTAL_CODE_PREFIXES,
+    get_postal_code_index,
+    get_postal_code_prefix,
+)
 
 logger = frappe.logger("erpnext_my_app")
 
 class OrderImporter:
-    def __init__(self, platform: str):
+    def __init__(self, platform: str, stream: bool = True, progress=None, timer=None):
 		# 根据仓库名称查找仓库
         #self.warehouse = frappe.get_doc("Warehouse", WAREHOUSE_NAME_DEFAULT)
         self.warehouse = WAREHOUSE_NAME_DEFAULT
         self.platform = platform
+        # 流式解析：边读文件边创建销售订单，内存占用不随文件大小增长
+        self.stream = stream
         self.errors = []
         self.orders_count = 0
+        # 整个导入任务共用的客户/地址/联系人索引
+        self.customer_index = CustomerIndex()
+        # 可选的 ProgressReporter，用于定期推送导入进度
+        self.progress = progress
+        # 记录解析、查询和创建单据各阶段的耗时与查询次数
+        self.timer = timer or StageTimer(f"OrderImporter {platform}")
         logger.error(f"OrderImporter initialized for platform: {self.platform} with warehouse: {self.warehouse}")
 
     def import_orders(self, file_url: str):
+        # 同一文件再次提交时，从上次提交的订单之后继续导入
+        checkpoint = ImportCheckpoint("orders", file_url, "order_id")
+        created_orders = self.create_orders(self.iter_orders(file_url, checkpoint), checkpoint)
+        checkpoint.clear()
+        return created_orders
+
+    def _get_parser(self, file_url: str):
         # 根据电商平台创建对应的订单解析器
         parser_module = f"erpnext_my_app.parser.{self.platform}"
         parser_class_name = f"{self.platform.capitalize()}OrderParser"
         parser_module = importlib.import_module(parser_module)
         parser_class = getattr(parser_module, parser_class_name)
-        parser = parser_class(file_url)
-        orders = parser.parse()
-        self.orders_count = len(orders)
+        parser = parser_class(file_url, stream=self.stream)
+        parser.timer = self.timer
+        return parser
 
-        #logger.error(f"orders parser has done: {len(orders)} orders found.")
-		
-        # 将文件中的销售订单同步到ERPNext
+    def iter_orders(self, file_url: str, checkpoint=None):
+        parser = self._get_parser(file_url)
+        # 断点之前的行在扫描和解析两遍中都直接跳过
+        parser.resume_line = checkpoint.line if checkpoint else 0
+        self.orders_count = 0
+
+        for order_data in self.timer.iterate("parse", parser.iter_orders()):
+            self.orders_count += 1
+            if self.progress:
+                self.progress.total = parser.orders_total
+            yield order_data
+
+        # 解析前已批量剔除的重复订单
+        self.orders_count += len(parser.imported_order_ids)
+        for order_id in sorted(parser.imported_order_ids):
+            self.errors.append(f"电商订单已经导入：{order_id}<br>")
+
+    def validate_orders(self, file_url: str):
+        """
+        Dry run: parse the file, resolve SKUs and check for already imported
+        orders using bulk reads only, and report the problems of each order
+        without creating any document.
+        """
+        parser = self._get_parser(file_url)
+        problems = {}
+        valid_count = 0
+        for order_data in parser.iter_orders():
+            order_id = order_data["order_id"]
+            shipping_address_info = order_data.get("shipping_address") or {}
+            missing_fields = [field for field in ("pincode", "address_line1") if not shipping_address_info.get(field)]
+            if missing_fields:
+                problems.setdefault(order_id, {})["missing_address"] = missing_fields
+            elif order_id not in parser.unmatched_skus:
+                valid_count += 1
+
+        # 商品全部匹配不到的订单不会被解析器产出，但同样记录在 unmatched_skus 中
+        for order_id, skus in parser.unmatched_skus.items():
+            problems.setdefault(order_id, {})["unmatched_skus"] = skus
+        for order_id in parser.imported_order_ids:
+            problems.setdefault(order_id, {})["already_imported"] = True
+        self.orders_count = len(parser.imported_order_ids) + (parser.orders_total or 0)
+
+        return {
+            "status": problems and "error" or "success",
+            "platform": self.platform,
+            "dry_run": True,
+            "order_count": self.orders_count,
+            "valid_count": valid_count,
+            "orders": [{"order_id": order_id, **problem} for order_id, problem in problems.items()],
+        }
+
+    def create_orders(self, orders, checkpoint=None):
+        # 将文件中的销售订单同步到ERPNext（解析器每产出一个订单就立即创建）
+        # 按批提交，避免整个文件在一个事务中；断点与这一批订单在同一个事务中保存
+        batcher = CommitBatcher("orders", on_save=checkpoint.save if checkpoint else None, timer=self.timer)
         created_orders = []
-        for order_data in orders:
-            so = self._create_sales_order(order_data)
-            if so:
-                created_orders.append(so.name)
+        for batch in chunks(orders, CUSTOMER_PRELOAD_BATCH_SIZE):
+            # 每批订单先一次性加载买家对应的已有客户、地址和联系人
+            with self.timer.stage("customer_preload"):
+                self.customer_index.preload(batch)
+            for order_data in batch:
+                so = self._create_sales_order_isolated(order_data)
+                if so:
+                    created_orders.append(so.name)
+                if checkpoint:
+                    checkpoint.advance(order_data)
+                batcher.add()
+                if self.progress:
+                    self.progress.update()
         return created_orders
 
+    def _create_sales_order_isolated(self, order_data):
+        # 每个订单使用一个保存点，失败时只回滚这个订单（包括为它新建的客户、地址和联系人）
+        frappe.db.savepoint(IMPORT_SAVEPOINT)
+        self.customer_index.savepoint()
+        try:
+            return self._create_sales_order(order_data)
+        except Exception as e:
+            frappe.db.rollback(save_point=IMPORT_SAVEPOINT)
+            self.customer_index.rollback()
+            logger.error(f"OrderImporter: failed to import order {order_data.get('order_id')}: {e}")
+            self.errors.append(f"电商订单导入失败：{order_data.get('order_id')} {e}<br>")
+            return None
+
     def _create_sales_order(self, order_data):
         customer_info = order_data["customer"]
         items = order_data["items"]
@@ -42,37 +141,79 @@ class OrderImporter:
         transaction_date = order_data.get("transaction_date")
         delivery_date = order_data.get("delivery_date")
 		
-        # 检查订单是否已经存在或者找不到商品（有可能通过sku找不到对应商品）
-        existing_so = frappe.db.exists("Sales Order", {
-            "amazon_order_id": order_id,
-            "docstatus": 1
-        })
-
-        if existing_so:
-            logger.error(f"Amazon order: {order_id} already exists.")
-            self.errors.append(f"电商订单已经导入：{order_id}<br>")
-            return None
+        # 检查订单是否找不到商品（有可能通过sku找不到对应商品）
+        # 已经导入过的订单在解析阶段已经通过一次批量查询剔除
         if len(items) <= 0:
             logger.error(f"Amazon order: {order_id} has no items to create Sales Order.")
             self.errors.append(f"电商订单中的商品在系统中找不到: {order_id} <br>")
             return None
 		
+        # 复用已有的客户、地址和联系人，只为新买家创建主数据
+        with self.timer.stage("customer"):
+            customer_name = self._get_or_create_customer(customer_info)
+        with self.timer.stage("address"):
+            shipping_address_name = self._get_or_create_address(customer_name, customer_info, shipping_address_info)
+        with self.timer.stage("contact"):
+            contact_name = self._get_or_create_contact(customer_name, customer_info)
+
+        # 遍历商品列表，为其设置仓库
+        #for item in items:
+        #    item["warehouse"] = self.warehouse
+        # 创建销售订单
+        so_data = {
+            "doctype": "Sales Order",
+			"amazon_order_id": order_id,
+            "customer": customer_name,
+            "transaction_date": transaction_date,
+            "delivery_date": delivery_date,
+            "items": items,
+            "company": COMPANY_NAME_DEFAULT,
+            "territory": TERRITORY_DEFAULT,
+            "customer_address": shipping_address_name,
+			"shipping_address": shipping_address_name,
+            "contact_person": contact_name,
+			"currency": "JPY"
+			#"set_warehouse": self.warehouse
+        }
+        with self.timer.stage("sales_order_insert"):
+            so = frappe.get_doc(so_data)
+            so.insert()
+        with self.timer.stage("sales_order_submit"):
+            so.submit()
+        return so
+
+    # 新的客户、地址和联系人逐个 insert，不做批量插入：它们要经过 ERPNext 的命名、校验和
+    # Dynamic Link 子表等控制器逻辑，db.bulk_insert 会绕过这些；随后的销售订单也需要它们已经存在，
+    # 且出错时按订单回滚。已有记录由 customer_index 预先批量查出并去重，
+    # 所以 insert 次数只随新买家增长，而不是随订单数增长
+    def _get_or_create_customer(self, customer_info):
+        customer_name = self.customer_index.find_customer(customer_info)
+        if customer_name:
+            return customer_name
+
         # 创建客户
         customer = frappe.get_doc({
             "doctype": "Customer",
             "customer_name": customer_info.get("name"),
             "customer_group": customer_info.get("group"),
-			"customer_type": "Company" if customer_info.get("company") != "" else "Individual",
+            "customer_type": "Company" if customer_info.get("company") != "" else "Individual",
             "territory": TERRITORY_DEFAULT,
             "custom_phone": customer_info.get("phone")
         })
         customer.flags.ignore_mandatory = True
         customer.insert(ignore_if_duplicate=True)
-		
+        self.customer_index.add_customer(customer_info, customer.name)
+        return customer.name
+
+    def _get_or_create_address(self, customer_name, customer_info, shipping_address_info):
+        address_name = self.customer_index.find_address(customer_name, shipping_address_info)
+        if address_name:
+            return address_name
+
         # 创建客户地址
         shipping_address = frappe.get_doc({
             "doctype": "Address",
-            "address_title": customer.name + " - Shipping",
+            "address_title": customer_name + " - Shipping",
             "address_type": "Shipping",
             "pincode": shipping_address_info.get("pincode", ""),
             "address_line1": shipping_address_info.get("address_line1"),
@@ -86,81 +227,58 @@ class OrderImporter:
             "country": "Japan",
             "phone": customer_info.get("phone"),
             "email_id": customer_info.get("email"),
-			"links": [{"link_doctype": "Customer", "link_name": customer.name}]
+            "links": [{"link_doctype": "Customer", "link_name": customer_name}]
         })
-        #shipping_address.append("links", {"link_doctype": "Customer", "link_name": customer.name})
+        #shipping_address.append("links", {"link_doctype": "Customer", "link_name": customer_name})
         shipping_address.flags.ignore_mandatory = True
         shipping_address.insert(ignore_if_duplicate=True)
-		
+        self.customer_index.add_address(customer_name, shipping_address_info, shipping_address.name)
+        return shipping_address.name
+
+    def _get_or_create_contact(self, customer_name, customer_info):
+        first_name = customer_info.get("recipient", customer_info.get("name"))
+        contact_name = self.customer_index.find_contact(customer_name, first_name)
+        if contact_name:
+            return contact_name
+
         # 创建客户联系人
         contact = frappe.get_doc({
             "doctype": "Contact",
-            "first_name": customer_info.get("recipient", customer_info.get("name")),
+            "first_name": first_name,
             "email_id": customer_info.get("email"),
             "phone": customer_info.get("phone"),
-            "links": [{"link_doctype": "Customer", "link_name": customer.name}]
+            "links": [{"link_doctype": "Customer", "link_name": customer_name}]
         })
         contact.flags.ignore_mandatory = True
         contact.insert(ignore_if_duplicate=True)
-
-        # 遍历商品列表，为其设置仓库
-        #for item in items:
-        #    item["warehouse"] = self.warehouse
-        # 创建销售订单
-        so_data = {
-            "doctype": "Sales Order",
-			"amazon_order_id": order_id,
-            "customer": customer.name,
-            "transaction_date": transaction_date,
-            "delivery_date": delivery_date,
-            "items": items,
-            "company": COMPANY_NAME_DEFAULT,
-            "territory": TERRITORY_DEFAULT,
-            "customer_address": shipping_address.name,
-			"shipping_address": shipping_address.name,
-            "contact_person": contact.name,
-			"currency": "JPY"
-			#"set_warehouse": self.warehouse
-        }
-        so = frappe.get_doc(so_data)
-        so.insert()
-        so.submit()
-        return so
+        self.customer_index.add_contact(customer_name, first_name, contact.name)
+        return contact.name
 
 def get_state_name_from_pincode(country_code=None, postal_code=None, state=None):
 	if not all((country_code, postal_code)):
 		return state
 
-	def get_first_three_digits(value):
-		if isinstance(value, str):
-			if len(value.strip()) == 6 and value.strip().isdigit():
-				return int(value[:3])
-		elif isinstance(value, int):
-			if len(str(value)) == 6:
-				return int(str(value)[:3])
-
-	if "india_compliance" in frappe.get_installed_apps() and country_code.lower() == "in":
-		from india_compliance.gst_india.constants import STATE_PINCODE_MAPPING
-
-		first_three_digits = get_first_three_digits(postal_code)
-
-		if first_three_digits:
-			state_name = ""
-			for _state, _range in STATE_PINCODE_MAPPING.items():
-				if isinstance(_range[0], tuple):
-					for c_range in _range:
-						lower_range, upper_range = c_range
-						if lower_range <= first_three_digits <= upper_range:
-							state_name = _state
-							if state and state[0].lower() == _state[0].lower():
-								return _state
-				else:
-					lower_range, upper_range = _range
-					if lower_range <= first_three_digits <= upper_range:
-						state_name = _state
-						if state and state[0].lower() == _state[0].lower():
-							return _state
-			if state_name:
-				return state_name
+	country_code = country_code.strip().lower()
+	if country_code in JP_COUNTRY_CODES:
+		# 文件中已经是规范的都道府县名称时直接使用，否则按邮编前三位查找
+		if state in JP_POSTAL_CODE_PREFIXES:
+			return state
+		first_three_digits = get_postal_code_prefix(postal_code, 7)
+		if first_three_digits is not None:
+			states = get_postal_code_index("jp").lookup(first_three_digits)
+			if states:
+				return states[0]
+
+	elif country_code == "in":
+		index = get_postal_code_index("in")
+		first_three_digits = get_postal_code_prefix(postal_code, 6)
+
+		if index and first_three_digits is not None:
+			states = index.lookup(first_three_digits)
+			for _state in states:
+				if state and state[0].lower() == _state[0].lower():
+					return _state
+			if states:
+				return states[-1]
 
 	return state
@@ -0,0 +1,108 @@
+import re
+import unicodedata
+from bisect import bisect_right
+from functools import cache
+import frappe
+
+# 日本邮编前三位 → 都道府县（离线表，与 india_compliance 的 STATE_PINCODE_MAPPING 格式相同）
+# 少数跨县的邮编以所属区域的主要都道府县为准
+JP_POSTAL_CODE_PREFIXES = {
+    "北海道": ((1, 9), (40, 99)),
+    "秋田県": (10, 19),
+    "岩手県": (20, 29),
+    "青森県": (30, 39),
+    "東京都": (100, 209),
+    "神奈川県": (210, 259),
+    "千葉県": (260, 299),
+    "茨城県": (300, 319),
+    "栃木県": (320, 329),
+    "埼玉県": (330, 369),
+    "群馬県": (370, 379),
+    "長野県": (380, 399),
+    "山梨県": (400, 409),
+    "静岡県": (410, 439),
+    "愛知県": (440, 498),
+    "岐阜県": (500, 509),
+    "三重県": (510, 519),
+    "滋賀県": (520, 529),
+    "大阪府": (530, 599),
+    "京都府": (600, 629),
+    "奈良県": (630, 639),
+    "和歌山県": (640, 649),
+    "兵庫県": (650, 679),
+    "鳥取県": (680, 689),
+    "島根県": (690, 699),
+    "岡山県": (700, 719),
+    "広島県": (720, 739),
+    "山口県": (740, 759),
+    "香川県": (760, 769),
+    "徳島県": (770, 779),
+    "高知県": (780, 789),
+    "愛媛県": (790, 799),
+    "福岡県": (800, 839),
+    "佐賀県": (840, 849),
+    "長崎県": (850, 859),
+    "熊本県": (860, 869),
+    "大分県": (870, 879),
+    "宮崎県": (880, 889),
+    "鹿児島県": (890, 899),
+    "沖縄県": (900, 909),
+    "福井県": (910, 919),
+    "石川県": (920, 929),
+    "富山県": (930, 939),
+    "新潟県": (940, 959),
+    "福島県": (960, 979),
+    "宮城県": (980, 989),
+    "山形県": (990, 999),
+}
+
+JP_COUNTRY_CODES = ("jp", "jpn", "japan", "日本")
+
+
+class PostalCodeIndex:
+    """Sorted-interval index over {state: (lower, upper) | ((lower, upper), ...)} mappings, looked up with bisect."""
+
+    def __init__(self, mapping):
+        ranges = []
+        for state, _range in mapping.items():
+            for lower, upper in (_range if isinstance(_range[0], tuple) else (_range,)):
+                ranges.append((lower, upper, state))
+
+        # 把可能重叠的区间拆成互不重叠的小段，每段记录覆盖它的所有州（保持原映射顺序）
+        self.starts = sorted({lower for lower, _, _ in ranges} | {upper + 1 for _, upper, _ in ranges})
+        self.states = [
+            [state for lower, upper, state in ranges if lower <= start <= upper]
+            for start in self.starts
+        ]
+
+    def lookup(self, value):
+        i = bisect_right(self.starts, value) - 1
+        return self.states[i] if i >= 0 else []
+
+
+@cache
+def get_postal_code_index(country):
+    """Build the index of a country once per process."""
+    if country == "jp":
+        return PostalCodeIndex(JP_POSTAL_CODE_PREFIXES)
+    if country == "in" and "india_compliance" in frappe.get_installed_apps():
+        from india_compliance.gst_india.constants import STATE_PINCODE_MAPPING
+
+        return PostalCodeIndex(STATE_PINCODE_MAPPING)
+    return None
+
+
+def get_postal_code_prefix(value, length):
+    """
+    First three digits of a postal code with exactly `length` digits. Full-width
+    digits, hyphens and a leading postal mark (〒) are allowed.
+    """
+    if isinstance(value, int):
+        value = str(value)
+    if not isinstance(value, str):
+        return None
+    # NFKC 把全角数字转成半角，〶 转成 〒
+    digits = re.sub(r"[\s\-‐－ー]", "", unicodedata.normalize("NFKC", value).lstrip().removeprefix("〒"))
+    if len(digits) == length and digits.isdigit():
+        return int(digits[:3])
+    return None
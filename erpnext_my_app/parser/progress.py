@@ -0,0 +1,57 @@
+import time
+import frappe
+from erpnext_my_app.parser.utils import *
+
+logger = frappe.logger("erpnext_my_app")
+
+
+class ProgressReporter:
+    """
+    Publishes periodic realtime progress events (processed/total, rows per
+    second, ETA) for a background job, at most once per `interval` seconds.
+    """
+
+    def __init__(self, event: str, user: str, total: int | None = None, interval: float = PROGRESS_INTERVAL, **extra):
+        self.event = event
+        self.user = user
+        self.total = total
+        self.interval = interval
+        # 附加在每条进度消息中的信息，例如平台、快递公司、分片编号
+        self.extra = extra
+        self.processed = 0
+        self.started_at = time.monotonic()
+        self.published_at = self.started_at
+
+    def update(self, count: int = 1):
+        self.processed += count
+        now = time.monotonic()
+        if now - self.published_at >= self.interval:
+            self.publish(now)
+
+    def finish(self):
+        self.publish(time.monotonic())
+
+    def get_stats(self, now=None):
+        now = now or time.monotonic()
+        elapsed = now - self.started_at
+        rate = self.processed / elapsed if elapsed > 0 else 0.0
+        eta = None
+        if self.total and rate > 0:
+            eta = max(self.total - self.processed, 0) / rate
+        return {
+            "processed": self.processed,
+            "total": self.total,
+            "elapsed": round(elapsed, 1),
+            "rows_per_second": round(rate, 2),
+            "eta": round(eta, 1) if eta is not None else None,
+        }
+
+    def publish(self, now=None):
+        self.published_at = now or time.monotonic()
+        progress = self.get_stats(self.published_at)
+        progress.update(self.extra)
+        frappe.publish_realtime(
+            event=self.event,
+            message={'progress': progress},
+            user=self.user
+        )
@@ -1,13 +1,26 @@
-import csv
 from io import StringIO
 from frappe.utils import cint, flt
 from frappe.utils.file_manager import get_file # Import get_file
+from erpnext_my_app.parser.utils import get_imported_order_ids, group_rows, iter_csv_rows, iter_file_lines, scan_row_keys
+from erpnext_my_app.parser.instrumentation import StageTimer
 
 class RakutenOrderParser:
-    def __init__(self, file_url): # Change content to file_url
+    def __init__(self, file_url, stream=False): # Change content to file_url
         self.file_url = file_url
+        # In stream mode the file is read incrementally from disk while parsing
+        self.stream = stream
+        # Orders that already have a submitted Sales Order are skipped while parsing
+        self.imported_order_ids = set()
+        # When resuming from a checkpoint, reading starts at this line (the lines before it were committed)
+        self.resume_line = 0
+        # Number of orders left after the first scan, used for progress reporting
+        self.orders_total = None
+        # Rakuten items are not matched against the Item master, kept for interface parity
+        self.unmatched_skus = {}
+        # Per-stage timings (decode, duplicate check); OrderImporter replaces it with the timer of the job
+        self.timer = StageTimer("RakutenOrderParser")
         # Fetch content from the file URL using get_file and decode it
-        self.content = self._fetch_content_from_file_doc()
+        self.content = "" if stream else self._fetch_content_from_file_doc()
 
     def _fetch_content_from_file_doc(self):
         """Fetches and decodes content from a file document using frappe.utils.file_manager.get_file."""
@@ -30,24 +43,31 @@ class RakutenOrderParser:
             print(f"Error fetching or decoding file from {self.file_url}: {e}")
             return "" # Return an empty string on error
 
-    def parse(self):
-        # Create a CSV DictReader from the fetched content.
+    def _iter_rows(self):
+        # Read the rows as dicts (like csv.DictReader), starting at the checkpoint line.
         # Note: Rakuten CSVs often do not use a delimiter like '\t',
-        # they are typically comma-separated (default for csv.DictReader).
+        # they are typically comma-separated (the default of the csv module).
         # If your Rakuten CSV is tab-separated, you would add delimiter='\t'.
-        reader = csv.DictReader(StringIO(self.content))
-        raw_orders = {}
-        for row in reader:
-            # Use "受注番号" (Order Number) as the order_id
-            order_id = row.get("受注番号")
-            if not order_id:
-                continue # Skip rows without an order ID
-            raw_orders.setdefault(order_id, []).append(row)
+        lines = iter_file_lines(self.file_url, "utf-8", timer=self.timer) if self.stream else StringIO(self.content)
+        return iter_csv_rows(lines, self.resume_line)
+
+    def parse(self):
+        return list(self.iter_orders())
+
+    def iter_orders(self):
+        """Yield parsed orders one at a time without buffering the whole file."""
+        # First pass only looks at "受注番号" (Order Number) to find orders whose rows are not contiguous
+        order_ids, split_order_ids, _ = scan_row_keys(self._iter_rows(), "受注番号")
+        # One bulk query drops the orders that were already imported
+        with self.timer.stage("duplicate_check"):
+            self.imported_order_ids = get_imported_order_ids(order_ids)
+        self.orders_total = len(order_ids - self.imported_order_ids)
 
-        parsed_orders = []
-        for order_id, rows in raw_orders.items():
+        for order_id, rows in group_rows(self._iter_rows(), "受注番号", split_order_ids):
             if not rows:
                 continue # Skip if no rows are grouped under this order_id
+            if order_id in self.imported_order_ids:
+                continue # Skip orders that were already imported
 
             first_row = rows[0]
 
@@ -69,6 +89,7 @@ class RakutenOrderParser:
                     "phone": first_row.get("購入者電話番号", "") # Buyer Phone Number
                 },
                 "items": items, # List of items in the order
+                "file_lines": (rows.first_line, rows.resume_line), # Lines of the order in the file, for the import checkpoint
                 "shipping_address": {
                     "name": first_row.get("宛名", ""), # Recipient Name
                     "pincode": first_row.get("郵便番号", ""), # Postal Code
@@ -78,5 +99,4 @@ class RakutenOrderParser:
                     "address_line1": first_row.get("町名・番地", "") # Address Line 1
                 }
             }
-            parsed_orders.append(order)
-        return parsed_orders
\ No newline at end of file
+            yield order
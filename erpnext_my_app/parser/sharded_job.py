@@ -0,0 +1,170 @@
+import pickle
+import frappe
+from frappe.utils.background_jobs import enqueue
+from erpnext_my_app.parser.utils import *
+
+logger = frappe.logger("erpnext_my_app")
+
+
+def merge_results(results):
+    """Merge per-shard result dicts: numbers are summed, lists concatenated, dicts merged the same way, any error wins."""
+    merged = {}
+    for result in results:
+        for key, value in result.items():
+            if key == "status":
+                merged[key] = "error" if value == "error" or merged.get(key) == "error" else value
+            elif isinstance(value, list):
+                merged.setdefault(key, []).extend(value)
+            elif isinstance(value, dict):
+                # 例如各分片的阶段耗时：按阶段累加
+                merged[key] = merge_results([merged.get(key) or {}, value])
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                merged[key] = merged.get(key, 0) + value
+            else:
+                merged.setdefault(key, value)
+    return merged
+
+
+class ShardedJob:
+    """
+    Fan one import out to several background jobs and publish a single merged
+    realtime event once every shard has reported its result.
+
+    Shards queued on a lane (enqueue_lane_shard) run one after another: each
+    lane keeps its pending shards in a Redis list and has at most one job
+    running, which starts the job of the next shard when it finishes.
+
+    All keys expire after SHARD_RESULT_EXPIRY seconds. If a shard never reports
+    (its worker was killed or it hit the job timeout), the merged event is not
+    published and the partial results are dropped when the keys expire.
+    """
+
+    def __init__(self, event: str, user: str, batch_id: str | None = None):
+        self.event = event
+        self.user = user
+        self.batch_id = batch_id or frappe.generate_hash(length=12)
+        self.cache = frappe.cache()
+
+    def _name(self, suffix):
+        return f"erpnext_my_app:{self.event}:{self.batch_id}:{suffix}"
+
+    def _key(self, suffix):
+        return self.cache.make_key(self._name(suffix))
+
+    def enqueue_shard(self, method, shard_no, **kwargs):
+        enqueue(
+            method=method,
+            queue=IMPORT_QUEUE,
+            timeout=IMPORT_SHARD_TIMEOUT,
+            batch_id=self.batch_id,
+            shard_no=shard_no,
+            user=self.user,
+            **kwargs
+        )
+
+    def enqueue_lane_shard(self, method, lane, shard_no, **kwargs):
+        """Queue a shard on a lane; it runs after the shards queued on the same lane before it."""
+        self.cache.rpush(self._name(f"lane:{lane}"), pickle.dumps({"method": method, "shard_no": shard_no, "kwargs": kwargs}))
+        self.cache.expire(self._key(f"lane:{lane}"), SHARD_RESULT_EXPIRY)
+        self._start_lane(lane)
+
+    def _start_lane(self, lane):
+        # 通道空闲时才启动任务；通道中正在执行的任务结束时会启动下一个分片
+        if self.cache.set(self._key(f"lane:{lane}:running"), 1, nx=True, ex=IMPORT_SHARD_TIMEOUT):
+            self._enqueue_lane(lane)
+
+    def _enqueue_lane(self, lane):
+        enqueue(
+            method=run_lane_shard,
+            queue=IMPORT_QUEUE,
+            timeout=IMPORT_SHARD_TIMEOUT,
+            event=self.event,
+            batch_id=self.batch_id,
+            lane=lane,
+            user=self.user
+        )
+
+    def _next_lane_shard(self, lane):
+        running = self._key(f"lane:{lane}:running")
+        if self.cache.llen(self._name(f"lane:{lane}")):
+            # 通道中还有分片：保留占用标记，直接启动下一个任务
+            self.cache.expire(running, IMPORT_SHARD_TIMEOUT)
+            self._enqueue_lane(lane)
+            return
+        self.cache.delete(running)
+        # 释放标记前协调任务可能刚放入新的分片，而它看到通道仍被占用没有启动任务
+        if self.cache.llen(self._name(f"lane:{lane}")):
+            self._start_lane(lane)
+
+    def finish_shard(self, shard_no, result):
+        """Store the result of one shard; the last shard to finish publishes the merged event."""
+        self.cache.hset(self._name("results"), str(shard_no), result)
+        # 分片或协调任务中途退出时，结果不会被合并，过期后由 Redis 清理
+        self.cache.expire(self._key("results"), SHARD_RESULT_EXPIRY)
+        self.cache.incr(self._key("done"))
+        self.cache.expire(self._key("done"), SHARD_RESULT_EXPIRY)
+        self._publish_if_complete()
+
+    def set_checkpoint(self, key):
+        """Remember the import checkpoint of the file; it is dropped when the last shard finishes or a shard fails."""
+        if key:
+            self.cache.set(self._key("checkpoint"), key, ex=SHARD_RESULT_EXPIRY)
+
+    def clear_checkpoint(self):
+        # 分片失败时它的记录没有导入，断点不能再跳过它们；全部完成后也不再需要断点
+        key = self.cache.get(self._key("checkpoint"))
+        if key:
+            frappe.defaults.clear_default(key=frappe.safe_decode(key))
+
+    def set_finalizer(self, method):
+        """Dotted path of a function that receives the merged result and returns the result to publish."""
+        self.cache.set(self._key("finalizer"), method, ex=SHARD_RESULT_EXPIRY)
+
+    def set_total(self, total):
+        """Called by the coordinator once all shards have been enqueued."""
+        self.cache.set(self._key("total"), total, ex=SHARD_RESULT_EXPIRY)
+        self._publish_if_complete()
+
+    def _publish_if_complete(self):
+        total = self.cache.get(self._key("total"))
+        done = self.cache.get(self._key("done"))
+        if total is None or int(done or 0) < int(total):
+            return
+        # 协调任务与最后一个分片可能同时发现全部完成，用原子计数保证只通知一次
+        if self.cache.incr(self._key("published")) != 1:
+            return
+        self.cache.expire(self._key("published"), SHARD_RESULT_EXPIRY)
+
+        results = self.cache.hgetall(self._name("results")) or {}
+        # 按分片编号的数值顺序合并，使合并后的列表（例如文件列表）保持原来的顺序
+        shard_nos = sorted(results, key=lambda shard_no: (not shard_no.isdigit(), int(shard_no) if shard_no.isdigit() else 0, shard_no))
+        result = merge_results(results[shard_no] for shard_no in shard_nos)
+        finalizer = self.cache.get(self._key("finalizer"))
+        if finalizer:
+            # 例如把各分片渲染的部分拼接成最终文件，在最后完成的任务中执行
+            result = frappe.get_attr(frappe.safe_decode(finalizer))(result)
+        logger.info(f"ShardedJob {self.event}/{self.batch_id}: {total} shards completed.")
+
+        # 主动通知客户端
+        frappe.publish_realtime(
+            event=self.event,
+            message={'result': result},
+            user=self.user
+        )
+        self.cache.delete_value(self._name("results"))
+        self.cache.delete(self._key("total"), self._key("done"), self._key("finalizer"))
+        self.clear_checkpoint()
+
+
+def run_lane_shard(event: str, batch_id: str, lane: int, user: str = "Administrator"):
+    """Background job running the next shard queued on a lane, then starting the job of the shard after it."""
+    job = ShardedJob(event, user, batch_id)
+    item = job.cache.lpop(job._name(f"lane:{lane}"))
+    try:
+        if item:
+            item = pickle.loads(item)
+            item["method"](batch_id=batch_id, shard_no=item["shard_no"], user=user, **item["kwargs"])
+            # 先提交本分片，同一通道的下一个分片才能看到它创建的客户
+            frappe.db.commit()
+    finally:
+        job._next_lane_shard(lane)
@@ -0,0 +1,216 @@
+import os
+import frappe
+from frappe.utils import cint
+from erpnext_my_app.parser.utils import *
+from erpnext_my_app.parser.csv_file import CsvFileWriter
+from erpnext_my_app.parser.instrumentation import StageTimer
+
+logger = frappe.logger("erpnext_my_app")
+
+
+class ShipmentExporter:
+    """
+    Exports the Shipments of a list of Sales Orders to the platform's shipment
+    confirmation feed, split into files of at most about `max_bytes` each.
+    Large exports render chunks of orders in parallel (render_part) and join
+    them into the feed files afterwards (assemble).
+    """
+
+    def __init__(self, platform: str = "amazon", progress=None, max_bytes: int = AMAZON_FEED_MAX_BYTES, filename: str = "shipment_export.csv", timer=None):
+        self.platform = platform
+        self.progress = progress
+        self.max_bytes = max_bytes
+        self.filename = filename
+        self.errors = []
+        self.count = 0
+        # 记录查询、生成和保存文件各阶段的耗时与查询次数
+        self.timer = timer or StageTimer(f"ShipmentExporter {platform}")
+
+    def _load(self, sale_order_ids):
+        """Load SOs, their first item, latest submitted DN, its Shipment and the summed parcel counts in bulk queries."""
+        self.sales_orders = {}
+        self.first_items = {}
+        self.dn_by_so = {}
+        self.shipment_by_dn = {}
+        self.shipments = {}
+        self.parcel_counts = {}
+
+        so_fields = ["name"] + [field for field in ("amazon_order_id",) if frappe.get_meta("Sales Order").has_field(field)]
+        for ids in chunks(set(sale_order_ids)):
+            for so in frappe.get_all("Sales Order", filters={"name": ["in", ids]}, fields=so_fields):
+                self.sales_orders[so.name] = so
+
+            # 每个销售订单只需要第一行商品（商品 ASIN）
+            for item in frappe.get_all(
+                "Sales Order Item",
+                filters={"parent": ["in", ids], "parenttype": "Sales Order"},
+                fields=["parent", "additional_notes"],
+                order_by="parent, idx",
+            ):
+                self.first_items.setdefault(item.parent, item)
+
+            # 一个销售订单可能对应多条出货单，与原来一样取最近修改的一条已提交、非退货的出货单
+            for dn in frappe.get_all(
+                "Delivery Note",
+                filters=[
+                    ["Delivery Note", "docstatus", "=", 1],
+                    ["Delivery Note", "is_return", "=", 0],  # ✅ 排除退货
+                    ["Delivery Note", "status", "not in", ["Return", "Return Issued"]],  # 排除退货和已发货的状态
+                    ["Delivery Note Item", "against_sales_order", "in", ids],
+                ],
+                fields=["name", "`tabDelivery Note Item`.against_sales_order as sales_order"],
+                order_by="`tabDelivery Note`.modified desc",
+                distinct=True,
+            ):
+                self.dn_by_so.setdefault(dn.sales_order, dn.name)
+
+        # 一个出货单可能对应多条装运单，只取一条
+        for names in chunks(set(self.dn_by_so.values())):
+            for link in frappe.get_all(
+                "Shipment Delivery Note",
+                filters={"delivery_note": ["in", names], "parenttype": "Shipment"},
+                fields=["parent", "delivery_note"],
+                order_by="modified desc",
+            ):
+                self.shipment_by_dn.setdefault(link.delivery_note, link.parent)
+
+        for names in chunks(set(self.shipment_by_dn.values())):
+            for shipment in frappe.get_all(
+                "Shipment",
+                filters={"name": ["in", names]},
+                fields=["name", "pickup_date", "carrier", "awb_number"],
+            ):
+                self.shipments[shipment.name] = shipment
+
+            # 包裹数量在数据库中汇总
+            for parcel in frappe.get_all(
+                "Shipment Parcel",
+                filters={"parent": ["in", names], "parenttype": "Shipment"},
+                fields=["parent", "sum(count) as parcel_count"],
+                group_by="parent",
+            ):
+                self.parcel_counts[parcel.parent] = cint(parcel.parcel_count)
+
+    def export(self, sale_order_ids=None, pages=None):
+        """Write the feed files and save them as Files, returns the list of File docs."""
+        rows = self._iter_rows(pages if pages is not None else [sale_order_ids]) if self.platform == "amazon" else []
+        return self._write_feeds(rows)
+
+    def render_part(self, pages, filename):
+        """Render the rows of the Sales Order pages to a private part file without header, returns its path."""
+        writer = CsvFileWriter(filename, "shift_jis", is_private=1, delimiter="\t")
+        try:
+            for row in self._iter_rows(pages):
+                writer.writerow(row)
+        except Exception:
+            writer.discard()
+            raise
+
+        if self.progress:
+            self.progress.finish()
+        return writer.close()
+
+    def assemble(self, part_paths):
+        """Join the part files in order into the feed files, removing the parts; returns the list of File docs."""
+        def iter_lines():
+            for path in part_paths:
+                # 分片已按 shift_jis 编码，逐行复制即可，不需要重新解析
+                with open(path, "rb") as f:
+                    yield from f
+                os.remove(path)
+
+        return self._write_feeds(iter_lines(), encoded=True)
+
+    def _iter_rows(self, pages):
+        for page in self.timer.iterate("select", pages):
+            with self.timer.stage("load"):
+                self._load(page)
+            with self.timer.stage("render"):
+                yield from self._render_rows(page)
+
+    def _write_feeds(self, rows, encoded=False):
+        files = []
+        writer = self._open_feed()
+        try:
+            for row in rows:
+                # 当前文件写满后另起一个带表头的新文件
+                if writer.rows > self.header_rows and writer.tell() >= self.max_bytes:
+                    with self.timer.stage("save_file"):
+                        files.append(writer.save())
+                    writer = self._open_feed()
+                if encoded:
+                    writer.write_encoded(row)
+                else:
+                    writer.writerow(row)
+        except Exception:
+            writer.discard()
+            raise
+
+        if self.progress:
+            self.progress.finish()
+
+        # 保存为 Frappe 文件
+        with self.timer.stage("save_file"):
+            files.append(writer.save())
+        return files
+
+    def _open_feed(self):
+        # 边生成边按 shift_jis 编码写入文件，内存中不保留整个文件
+        writer = CsvFileWriter(self.filename, "shift_jis", delimiter="\t") # 使用制表符分隔符
+        if self.platform == "amazon":
+            writer.writerow([
+                "TemplateType=OrderFulfillment", "Version=2011.1102", "この行はAmazonが使用しますので変更や削除しないでください。",
+            ])
+            writer.writerow([
+                "注文番号", "注文商品番号", "出荷数","出荷日",
+                "配送業者コード", "配送業者名", "お問い合わせ伝票番号", "配送方法", "代金引換"
+            ])
+        self.header_rows = writer.rows
+        return writer
+
+    def _render_rows(self, sale_order_ids):
+        for so_id in sale_order_ids:
+            if self.progress:
+                self.progress.update()
+            so = self.sales_orders.get(so_id)
+            if not so:
+                logger.error(f"export_shipment_to_csv: Sales Order {so_id} not found.")
+                self.errors.append(f"销售订单未找到: {so_id}<br>")
+                continue
+            first_item = self.first_items.get(so_id)
+            if not first_item:
+                logger.error(f"export_shipment_to_csv: Sales Order {so_id} has no items.")
+                self.errors.append(f"销售订单没有商品: {so_id}<br>")
+                continue
+
+            delivery_note_id = self.dn_by_so.get(so_id)
+            if not delivery_note_id:
+                logger.error(f"export_shipment_to_csv: Delivery Note Item for Sales Order {so_id} not found.")
+                self.errors.append(f"销售订单没有关联的出货单: {so_id}<br>")
+                continue  # 如果没有找到出货单，跳过
+
+            shipment_id = self.shipment_by_dn.get(delivery_note_id)
+            if not shipment_id:
+                logger.error(f"export_shipment_to_csv: Shipment link for Delivery Note {delivery_note_id} not found for Sales Order {so_id}.")
+                self.errors.append(f"出货单没有关联的装运单: {delivery_note_id} [销售订单： {so_id}]<br>")
+                continue  # 如果没有找到出货单，跳过
+
+            shipment = self.shipments.get(shipment_id)
+            if not shipment:
+                logger.error(f"export_shipment_to_csv: Shipment document {shipment_id} not found for Sales Order {so_id}.")
+                self.errors.append(f"装运单文档未找到: {shipment_id} [销售订单： {so_id}， 出货单： {delivery_note_id}]<br>")
+                continue  # 如果没有找到装运单，跳过
+
+            # 将装运单信息输出到文件中
+            self.count += 1
+            yield [
+                so.get("amazon_order_id") or "",  # 亚马逊订单号
+                first_item.additional_notes,  # 商品 ASIN
+                self.parcel_counts.get(shipment_id, 0),
+                shipment.pickup_date or "",  # 出货日期
+                get_carrier_code(shipment.carrier),  # 配送業者コード
+                "",  # 配送业者名称
+                shipment.awb_number or "",  # 查询号码
+                get_shipment_method(shipment.carrier),  # 配送方法
+                ""
+            ]
@@ -1,15 +1,22 @@
-import csv
 from io import StringIO
 import frappe
-from frappe.utils import getdate, nowdate # 假设这些工具函数可用
+from frappe.utils import nowdate # 假设这些工具函数可用
 from frappe.utils.file_manager import get_file # 正确的导入路径
+from erpnext_my_app.parser.utils import ROW_LINES_FIELD, get_cached_date, iter_csv_rows, iter_file_lines
+from erpnext_my_app.parser.instrumentation import StageTimer
 
 logger = frappe.logger("erpnext_my_app")
 
 class UpackParser:
-    def __init__(self, file_url): # 接受文件URL
+    def __init__(self, file_url, stream=False): # 接受文件URL
         self.file_url = file_url
-        self.content = self._fetch_content_from_file_doc().lstrip("\ufeff") # 调用方法获取内容
+        # 流式模式下不把整个文件读入内存，而是在解析时从磁盘增量读取
+        self.stream = stream
+        # 断点续传：从这一行开始读取，之前的行已经导入并提交
+        self.resume_line = 0
+        # 记录解码阶段的耗时，导入时由 DeliveryImporter 替换为任务共用的计时器
+        self.timer = StageTimer("UpackParser")
+        self.content = "" if stream else self._fetch_content_from_file_doc().lstrip("\ufeff") # 调用方法获取内容
 
     def _fetch_content_from_file_doc(self):
         """Fetch UTF-8 content from attached File DocType (self.file_url)."""
@@ -28,30 +35,31 @@ class UpackParser:
             logger.error(f"Error fetching or decoding file from {self.file_url}: {e}")
             return ""
 
+    def _iter_rows(self):
+        # StringIO(self.content) 可以处理空字符串，如果 _fetch_content_from_file_doc 返回空，这里也能正常运行
+        lines = iter_file_lines(self.file_url, "utf-8-sig", timer=self.timer) if self.stream else StringIO(self.content)
+        return iter_csv_rows(lines, self.resume_line, delimiter=',')
 
     def parse(self):
-        # StringIO(self.content) 可以处理空字符串，如果 _fetch_content_from_file_doc 返回空，这里也能正常运行
-        reader = csv.DictReader(StringIO(self.content), delimiter=',')
-        raw_orders = {}
-        for row in reader:
+        return list(self.iter_orders())
+
+    def iter_orders(self):
+        """Yield one shipment record per delivery note as the rows are read, keeping only the seen IDs in memory."""
+        seen_order_ids = set()
+        for row in self._iter_rows():
             order_id = row.get("記事名１")
             if not order_id:
                 logger.error("UpackParser: Missing order-id in row, skipping.")
                 continue # 如果没有 order-id，跳过这一行
-            raw_orders.setdefault(order_id, []).append(row)
-
-        parsed_orders = []
-        for order_id, rows in raw_orders.items():
-            if not rows: # 理论上不会发生，因为只有有 order_id 的行才会被添加
-                continue
+            if order_id in seen_order_ids:
+                continue # 同一发货单只取第一行
+            seen_order_ids.add(order_id)
 
-            first_row = rows[0]
-            order = {
+            yield {
                 "delivery_note_id": order_id,   #销售出货ID
-                "amazon_order_id": first_row.get("記事名2", ""), # 亚马逊订单ID
-                "tracking_no": first_row.get("お問い合わせ番号", ""), # 追踪号码
+                "amazon_order_id": row.get("記事名2", ""), # 亚马逊订单ID
+                "tracking_no": row.get("お問い合わせ番号", ""), # 追踪号码
                 "carrier": "upack", # 物流公司
-                "shipping_date": getdate(first_row.get("発送日", nowdate())) # 发货日期
+                "shipping_date": get_cached_date(row.get("発送日") or nowdate()), # 发货日期
+                "file_lines": row[ROW_LINES_FIELD] # 记录在文件中的行号范围，用于导入断点
             }
-            parsed_orders.append(order)
-        return parsed_orders
\ No newline at end of file
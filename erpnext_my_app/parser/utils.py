@@ -1,7 +1,328 @@
+import codecs
+import csv
+from contextlib import nullcontext
+from functools import lru_cache
+from itertools import islice
+import json
+import os
+import pickle
+import tempfile
+import zlib
+import frappe
+from frappe.utils import cint, getdate
+from frappe.utils.file_manager import get_file_path
+
 # 定义几个常量
 COMPANY_NAME_DEFAULT = "龍越商事株式会社"
 WAREHOUSE_NAME_DEFAULT = "龍越仓库 - 龍越商事"
 TERRITORY_DEFAULT = "Japan"
+PRICE_LIST_DEFAULT = "Standard Selling"
+# IN 查询每批最多携带的值数量，避免 SQL 语句过长
+DB_IN_CHUNK_SIZE = 1000
+# 大文件导入拆分成多个后台任务并行执行
+IMPORT_QUEUE = "long"
+IMPORT_JOB_TIMEOUT = 1800
+IMPORT_SHARD_SIZE = 200
+IMPORT_SHARD_TIMEOUT = 1800
+# 流式拆分时按键分配的通道数：同一通道的分片依次执行，不同通道并行执行
+IMPORT_SHARD_LANES = 8
+# 分片结果在 Redis 中的保留时间（秒）
+SHARD_RESULT_EXPIRY = 24 * 3600
+# 导入订单时每批预加载已有客户的订单数量
+CUSTOMER_PRELOAD_BATCH_SIZE = 200
+# 导入快递单号时每批预加载发货单的记录数量
+SHIPMENT_PRELOAD_BATCH_SIZE = 500
+# 每处理多少条记录提交一次（可在 site_config.json 中用 erpnext_my_app_commit_batch_size 覆盖）
+COMMIT_BATCH_SIZE = 50
+# 解析出的每行中保存该行在文件中的行号范围 (起始行, 下一行)，用于导入断点
+ROW_LINES_FIELD = "__lines__"
+# 导入时每条记录使用的数据库保存点名称
+IMPORT_SAVEPOINT = "erpnext_my_app_import_record"
+# 后台任务推送进度消息的最小间隔（秒）
+PROGRESS_INTERVAL = 2.0
+# 流式读取文件时每次从磁盘读取的字节数
+STREAM_CHUNK_SIZE = 1024 * 1024
+# 按条件导出时每页读取的销售订单数量
+SALES_ORDER_PAGE_SIZE = 500
+# 亚马逊出货确认文件的大小上限（字节），超过后拆分成多个文件，每个文件都带表头
+AMAZON_FEED_MAX_BYTES = 5 * 1024 * 1024
+# 增量导出发货单时，创建超过这么多天仍是草稿的发货单不再在下次导出时检查
+EXPORT_DRAFT_MAX_DAYS = 30
+# 出货确认文件每个并行后台任务渲染的销售订单数量，与文件大小上限无关：
+# 各块渲染完成后按顺序拼接，再按大小上限拆分成文件
+SHIPMENT_EXPORT_CHUNK_SIZE = 2000
+# 平台对应的客户群组（按平台筛选销售订单时使用）
+PLATFORM_CUSTOMER_GROUPS = {
+    "amazon": ["亚马逊", "亚马逊 - Amanex"],
+}
+
+
+def chunks(values, size=DB_IN_CHUNK_SIZE):
+    # 惰性切分，既能用于列表也能用于流式产出的生成器
+    iterator = iter(values)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def get_lane(key, lanes=IMPORT_SHARD_LANES):
+    """Lane number of a key, stable across worker processes (unlike the salted built-in hash)."""
+    return zlib.crc32(str(key).encode("utf-8")) % lanes
+
+
+def partition_stream(records, size, get_bucket, buckets=None):
+    """
+    Route streamed records to buckets and yield (bucket, records) as soon as a
+    bucket holds `size` records, then the partly filled buckets at the end.
+    Only the records of unflushed buckets are kept in memory.
+    """
+    # 调用方可以传入 buckets 查看尚未产出的记录（例如计算导入断点）
+    buckets = {} if buckets is None else buckets
+    for record in records:
+        bucket = get_bucket(record)
+        pending = buckets.setdefault(bucket, [])
+        pending.append(record)
+        if len(pending) >= size:
+            yield bucket, buckets.pop(bucket)
+    for bucket in list(buckets):
+        yield bucket, buckets.pop(bucket)
+
+
+def get_commit_batch_size():
+    """Number of records committed together by the importers."""
+    return cint(frappe.conf.get("erpnext_my_app_commit_batch_size")) or COMMIT_BATCH_SIZE
+
+
+def get_imported_order_ids(order_ids):
+    """Return the subset of order_ids that already have a submitted Sales Order, using chunked IN queries."""
+    imported = set()
+    for ids in chunks(order_ids):
+        imported.update(frappe.get_all(
+            "Sales Order",
+            filters={"amazon_order_id": ["in", ids], "docstatus": 1},
+            pluck="amazon_order_id"
+        ))
+    return imported
+
+
+def get_sales_order_filters(criteria):
+    """
+    Build Sales Order filters from export criteria:
+    {from_date, to_date, customer_group, platform, status}, given as a dict or JSON string.
+    """
+    criteria = frappe._dict(json.loads(criteria) if isinstance(criteria, str) else criteria or {})
+    filters = [["Sales Order", "docstatus", "=", 1]]
+    if criteria.from_date:
+        filters.append(["Sales Order", "transaction_date", ">=", criteria.from_date])
+    if criteria.to_date:
+        filters.append(["Sales Order", "transaction_date", "<=", criteria.to_date])
+    if criteria.customer_group:
+        groups = criteria.customer_group
+        filters.append(["Sales Order", "customer_group", "in", groups if isinstance(groups, list) else [groups]])
+    if criteria.platform:
+        groups = PLATFORM_CUSTOMER_GROUPS.get(criteria.platform)
+        if not groups:
+            frappe.throw(f"不支持按平台筛选销售订单：{criteria.platform}<br>")
+        filters.append(["Sales Order", "customer_group", "in", groups])
+    if criteria.status:
+        status = criteria.status
+        filters.append(["Sales Order", "status", "in", status if isinstance(status, list) else [status]])
+    return filters
+
+
+def iter_sales_order_pages(filters, page_size=SALES_ORDER_PAGE_SIZE):
+    """Yield the names of the matching Sales Orders page by page, using keyset pagination on the primary key."""
+    last_name = None
+    while True:
+        page = frappe.get_all(
+            "Sales Order",
+            filters=filters + ([["Sales Order", "name", ">", last_name]] if last_name else []),
+            order_by="name asc",
+            limit=page_size,
+            pluck="name"
+        )
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        last_name = page[-1]
+
+
+def iter_sales_order_bounds(filters, size):
+    """
+    Split the matching Sales Orders into ranges of `size` by primary key and
+    yield (after, last) name bounds, reading only the last name of each range.
+    The final range has no upper bound.
+    """
+    after = None
+    while True:
+        last = frappe.get_all(
+            "Sales Order",
+            filters=filters + ([["Sales Order", "name", ">", after]] if after else []),
+            order_by="name asc",
+            limit_start=size - 1,
+            limit=1,
+            pluck="name"
+        )
+        if not last:
+            yield after, None
+            return
+        yield after, last[0]
+        after = last[0]
+
+
+def get_sales_order_range_filters(filters, after=None, last=None):
+    """Restrict Sales Order filters to the names in (after, last]."""
+    filters = list(filters)
+    if after:
+        filters.append(["Sales Order", "name", ">", after])
+    if last:
+        filters.append(["Sales Order", "name", "<=", last])
+    return filters
+
+
+def iter_file_lines(file_url, encoding="utf-8", chunk_size=STREAM_CHUNK_SIZE, timer=None):
+    """
+    Read a stored File incrementally from disk and yield decoded lines (line endings kept).
+    Reading and decoding are recorded as the "decode" stage of `timer` when given.
+    """
+    file_path = get_file_path(file_url)
+    if not os.path.exists(file_path):
+        frappe.logger("erpnext_my_app").error(f"iter_file_lines: file not found: {file_url}")
+        return
+
+    # 增量解码器能正确处理跨块截断的 shift_jis/cp932/utf-8 多字节字符
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    buffer = ""
+    stage = timer.stage if timer else (lambda name: nullcontext())
+    with open(file_path, "rb") as f:
+        while True:
+            with stage("decode"):
+                chunk = f.read(chunk_size)
+                lines = (buffer + decoder.decode(chunk)).split("\n")
+            if not chunk:
+                break
+            buffer = lines.pop()
+            for line in lines:
+                yield line + "\n"
+        buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer
+
+
+def iter_csv_rows(lines, start_line=0, **kwargs):
+    """
+    Yield the rows of CSV lines as dicts like csv.DictReader, each with the
+    (first, next) line numbers of the row under ROW_LINES_FIELD (the header is
+    line 0). The lines between the header and start_line are skipped without
+    CSV parsing.
+    """
+    lines = iter(lines)
+    reader = csv.reader(lines, **kwargs)
+    fieldnames = next(reader, None)
+    if fieldnames is None:
+        return
+    line = reader.line_num
+    if start_line > line:
+        # 断点之前的行已经导入，只数行数不解析
+        line += sum(1 for _ in islice(lines, start_line - line))
+    offset = line
+    rows = csv.DictReader(lines, fieldnames=fieldnames, **kwargs)
+    for row in rows:
+        row[ROW_LINES_FIELD] = (line, offset + rows.line_num)
+        line = offset + rows.line_num
+        yield row
+
+
+@lru_cache(maxsize=1024)
+def get_cached_date(value):
+    # 快递单文件中的发货日期大多相同，缓存解析结果
+    return getdate(value)
+
+
+def scan_row_keys(rows, key_field, value_field=None):
+    """
+    Scan rows once and return (keys, split_keys, values):
+    all keys, keys whose rows are not contiguous, and the distinct values of value_field.
+    """
+    keys, split_keys, values = set(), set(), set()
+    last_key = None
+    for row in rows:
+        key = row.get(key_field)
+        if not key:
+            continue
+        if key != last_key:
+            if key in keys:
+                split_keys.add(key)
+            keys.add(key)
+            last_key = key
+        if value_field:
+            values.add(row.get(value_field))
+    return keys, split_keys, values
+
+
+class RowGroup(list):
+    """
+    Rows of one key yielded by group_rows. When the rows carry ROW_LINES_FIELD,
+    every line before first_line belongs to groups yielded earlier, and every
+    line before resume_line is done once this group and the earlier ones are.
+    """
+
+    first_line = None
+    resume_line = None
+
+
+def group_rows(rows, key_field, split_keys=()):
+    """
+    Yield (key, rows) for each run of contiguous rows sharing key_field.
+    Rows of keys listed in split_keys (not contiguous in the file) are spilled
+    to a temporary file and yielded as complete groups at the end. Each group
+    is a RowGroup carrying the file lines it covers.
+    """
+    spill = None
+    # 第一条被暂存的行：它所在的订单最后才产出，断点不能越过这一行
+    spill_line = None
+    current_key, current_rows = None, RowGroup()
+
+    def close(group):
+        if ROW_LINES_FIELD in group[0]:
+            first_line, resume_line = group[0][ROW_LINES_FIELD][0], group[-1][ROW_LINES_FIELD][1]
+            if spill_line is not None:
+                first_line, resume_line = min(first_line, spill_line), min(resume_line, spill_line)
+            group.first_line, group.resume_line = first_line, resume_line
+        return group
+
+    for row in rows:
+        key = row.get(key_field)
+        if not key:
+            continue
+        if key in split_keys:
+            if spill is None:
+                spill = tempfile.TemporaryFile()
+                spill_line = row.get(ROW_LINES_FIELD, (None,))[0]
+            pickle.dump(row, spill)
+            continue
+        if key != current_key:
+            if current_rows:
+                yield current_key, close(current_rows)
+            current_key, current_rows = key, RowGroup()
+        current_rows.append(row)
+    if current_rows:
+        yield current_key, close(current_rows)
+
+    if spill is None:
+        return
+    # 不连续的订单只占少数，回读临时文件后按订单号合并
+    spilled = {}
+    with spill:
+        spill.seek(0)
+        while True:
+            try:
+                row = pickle.load(spill)
+            except EOFError:
+                break
+            spilled.setdefault(row.get(key_field), RowGroup()).append(row)
+    for key, group in spilled.items():
+        yield key, close(group)
 
 
 def get_carrier_code(carrier):
@@ -0,0 +1,28 @@
+import frappe
+from frappe.custom.doctype.custom_field.custom_field import create_custom_field
+from erpnext_my_app.parser.customer_index import normalize_phone
+
+
+def execute():
+    """Add the indexed Customer.custom_phone_digits column and backfill it from custom_phone."""
+    create_custom_field("Customer", {
+        "fieldname": "custom_phone_digits",
+        "label": "Phone Digits",
+        "fieldtype": "Data",
+        "insert_after": "custom_phone",
+        "read_only": 1,
+        "hidden": 1,
+        "search_index": 1,
+    })
+
+    if not frappe.db.has_column("Customer", "custom_phone"):
+        return
+
+    # 直接批量写入规范化的号码，不触发客户的保存逻辑，也不修改 modified
+    updates = {}
+    for customer in frappe.get_all("Customer", filters={"custom_phone": ["is", "set"]}, fields=["name", "custom_phone"]):
+        digits = normalize_phone(customer.custom_phone)
+        if digits:
+            updates[customer.name] = {"custom_phone_digits": digits}
+    if updates:
+        frappe.db.bulk_update("Customer", updates, update_modified=False)
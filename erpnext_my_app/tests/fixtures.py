@@ -0,0 +1,269 @@
+import csv
+import os
+from contextlib import contextmanager
+from unittest.mock import patch
+import frappe
+from frappe.utils import add_days, getdate, nowdate
+from frappe.utils.file_manager import get_file_path
+from frappe.custom.doctype.custom_field.custom_field import create_custom_field
+from erpnext_my_app.parser.utils import *
+from erpnext_my_app.benchmarks.generators import AMAZON_COLUMNS, FUKUTSU_COLUMNS, UPACK_COLUMNS, get_file_url
+
+# 测试用的商品、亚马逊 SKU 和单价
+TEST_ITEM = "导入测试商品"
+TEST_SKU = "test-import-sku"
+TEST_RATE = 1000
+
+
+def setup_test_data():
+    """Create the master data used by the importers and exporters: company, warehouse, groups, item and custom fields."""
+    frappe.set_user("Administrator")
+
+    # 导入和导出用到的自定义字段
+    create_custom_field("Item", {
+        "fieldname": "custom_amazon_sku",
+        "label": "Amazon SKU",
+        "fieldtype": "Data",
+        "insert_after": "item_code",
+    })
+    create_custom_field("Sales Order", {
+        "fieldname": "amazon_order_id",
+        "label": "Amazon Order ID",
+        "fieldtype": "Data",
+        "unique": 1,
+    })
+    create_custom_field("Sales Order", {
+        "fieldname": "custom_tracking_number",
+        "label": "Tracking Number",
+        "fieldtype": "Data",
+    })
+    create_custom_field("Customer", {
+        "fieldname": "custom_phone",
+        "label": "Phone",
+        "fieldtype": "Data",
+    })
+    create_custom_field("Customer", {
+        "fieldname": "custom_phone_digits",
+        "label": "Phone Digits",
+        "fieldtype": "Data",
+        "insert_after": "custom_phone",
+        "read_only": 1,
+        "hidden": 1,
+        "search_index": 1,
+    })
+
+    # 树形结构的根节点和子节点
+    make_record("Customer Group", "All Customer Groups", customer_group_name="All Customer Groups", is_group=1)
+    make_record("Customer Group", "Amazon", customer_group_name="Amazon", parent_customer_group="All Customer Groups", is_group=1)
+    for group in PLATFORM_CUSTOMER_GROUPS["amazon"]:
+        make_record("Customer Group", group, customer_group_name=group, parent_customer_group="Amazon")
+    make_record("Territory", "All Territories", territory_name="All Territories", is_group=1)
+    make_record("Territory", TERRITORY_DEFAULT, territory_name=TERRITORY_DEFAULT, parent_territory="All Territories")
+    make_record("Item Group", "All Item Groups", item_group_name="All Item Groups", is_group=1)
+    make_record("UOM", "Nos", uom_name="Nos")
+    for warehouse_type in ["Transit", "Stores", "Raw Material", "Finished Goods", "Scrap"]:
+        make_record("Warehouse Type", warehouse_type, warehouse_type_name=warehouse_type)
+    make_record("Address Template", "Japan", country="Japan", is_default=1)
+
+    # 公司和公司地址（出货单的 company_address 取自公司的默认地址）
+    make_record("Company", COMPANY_NAME_DEFAULT, company_name=COMPANY_NAME_DEFAULT, abbr="龍越商事", default_currency="JPY", country="Japan")
+    if not frappe.db.exists("Dynamic Link", {"parenttype": "Address", "link_doctype": "Company", "link_name": COMPANY_NAME_DEFAULT}):
+        frappe.get_doc({
+            "doctype": "Address",
+            "address_title": COMPANY_NAME_DEFAULT,
+            "address_type": "Shipping",
+            "address_line1": "土居町津根2840",
+            "city": "四国中央市",
+            "state": "愛媛県",
+            "pincode": "799-0704",
+            "country": "Japan",
+            "is_your_company_address": 1,
+            "links": [{"link_doctype": "Company", "link_name": COMPANY_NAME_DEFAULT}],
+        }).insert()
+    if not frappe.db.exists("Warehouse", WAREHOUSE_NAME_DEFAULT):
+        frappe.get_doc({
+            "doctype": "Warehouse",
+            "warehouse_name": WAREHOUSE_NAME_DEFAULT.split(" - ")[0],
+            "warehouse_type": "Stores",
+            "company": COMPANY_NAME_DEFAULT,
+        }).insert(set_name=WAREHOUSE_NAME_DEFAULT)
+
+    # 当前日期所在的会计年度
+    today = getdate()
+    if not frappe.db.exists("Fiscal Year", {"year_start_date": ["<=", today], "year_end_date": [">=", today]}):
+        frappe.get_doc({
+            "doctype": "Fiscal Year",
+            "year": str(today.year),
+            "year_start_date": f"{today.year}-01-01",
+            "year_end_date": f"{today.year}-12-31",
+        }).insert()
+
+    make_record("Price List", PRICE_LIST_DEFAULT, price_list_name=PRICE_LIST_DEFAULT, selling=1, currency="JPY")
+    make_record(
+        "Item", TEST_ITEM,
+        item_code=TEST_ITEM,
+        item_name=TEST_ITEM,
+        item_group="All Item Groups",
+        stock_uom="Nos",
+        is_stock_item=0,
+        weight_per_unit=2.5,
+        weight_uom="Kg",
+        custom_amazon_sku=TEST_SKU,
+    )
+    if not frappe.db.exists("Item Price", {"item_code": TEST_ITEM, "price_list": PRICE_LIST_DEFAULT}):
+        frappe.get_doc({
+            "doctype": "Item Price",
+            "item_code": TEST_ITEM,
+            "price_list": PRICE_LIST_DEFAULT,
+            "price_list_rate": TEST_RATE,
+        }).insert()
+
+
+def make_record(doctype, name, **values):
+    """Insert a record with the given name unless it already exists."""
+    if not frappe.db.exists(doctype, name):
+        frappe.get_doc({"doctype": doctype, **values}).insert(set_name=name)
+    return name
+
+
+def make_customer(customer_name, email=None, phone=None, pincode="799-0704", address_line1="土居町津根2840"):
+    """Create a Customer with a shipping Address and a Contact, returns their names."""
+    customer = frappe.get_doc({
+        "doctype": "Customer",
+        "customer_name": customer_name,
+        "customer_group": PLATFORM_CUSTOMER_GROUPS["amazon"][0],
+        "territory": TERRITORY_DEFAULT,
+        "custom_phone": phone,
+    }).insert()
+    address = frappe.get_doc({
+        "doctype": "Address",
+        "address_title": f"{customer.name} - Shipping",
+        "address_type": "Shipping",
+        "address_line1": address_line1,
+        "city": "四国中央市",
+        "state": "愛媛県",
+        "pincode": pincode,
+        "country": "Japan",
+        "phone": phone,
+        "links": [{"link_doctype": "Customer", "link_name": customer.name}],
+    }).insert()
+    contact = frappe.get_doc({
+        "doctype": "Contact",
+        "first_name": customer_name,
+        "email_ids": [{"email_id": email, "is_primary": 1}] if email else [],
+        "links": [{"link_doctype": "Customer", "link_name": customer.name}],
+    }).insert()
+    return frappe._dict(customer=customer.name, address=address.name, contact=contact.name)
+
+
+def make_sales_order(customer, amazon_order_id=None, qty=1, submit=True):
+    """Create a Sales Order of TEST_ITEM for a customer made by make_customer."""
+    so = frappe.get_doc({
+        "doctype": "Sales Order",
+        "customer": customer.customer,
+        "company": COMPANY_NAME_DEFAULT,
+        "transaction_date": nowdate(),
+        "delivery_date": add_days(nowdate(), 1),
+        "amazon_order_id": amazon_order_id,
+        "customer_address": customer.address,
+        "shipping_address_name": customer.address,
+        "contact_person": customer.contact,
+        "selling_price_list": PRICE_LIST_DEFAULT,
+        "currency": "JPY",
+        "items": [{
+            "item_code": TEST_ITEM,
+            "qty": qty,
+            "rate": TEST_RATE,
+            "warehouse": WAREHOUSE_NAME_DEFAULT,
+            "delivery_date": add_days(nowdate(), 1),
+        }],
+    }).insert()
+    if submit:
+        so.submit()
+    return so
+
+
+def make_delivery_note(sales_order, submit=True):
+    """Create the Delivery Note of a submitted Sales Order the way the Sales Order form does."""
+    from erpnext.selling.doctype.sales_order.sales_order import make_delivery_note as map_delivery_note
+
+    dn = map_delivery_note(sales_order.name)
+    dn.insert()
+    if submit:
+        dn.submit()
+    return dn
+
+
+def amazon_row(order_id, buyer="山田 太郎", email=None, phone="090-1234-5678", sku=TEST_SKU, **values):
+    """One row of an Amazon order report; keyword arguments override columns, e.g. ship_postal_code for ship-postal-code."""
+    row = {
+        "order-id": order_id,
+        "order-item-id": f"{order_id}-1",
+        "purchase-date": nowdate(),
+        "payments-date": nowdate(),
+        "buyer-email": email if email is not None else f"{order_id}@example.com",
+        "buyer-name": buyer,
+        "buyer-phone-number": phone,
+        "sku": sku,
+        "product-name": TEST_ITEM,
+        "quantity-purchased": 1,
+        "recipient-name": buyer,
+        "ship-address-1": "土居町津根2840",
+        "ship-city": "四国中央市",
+        "ship-state": "愛媛県",
+        "ship-postal-code": "799-0704",
+        "ship-country": "JP",
+        "promise-date": add_days(nowdate(), 2),
+        "default-ship-from-address-name": "龍翔産業株式会社",
+    }
+    row.update({key.replace("_", "-"): value for key, value in values.items()})
+    return row
+
+
+def write_amazon_file(filename, rows):
+    """Write an Amazon order report (shift_jis, tab separated) into the site's public files, returns its file URL."""
+    return write_csv_file(filename, AMAZON_COLUMNS, rows, "shift_jis", delimiter="\t", lineterminator="\r\n")
+
+
+def write_upack_file(filename, rows):
+    """Write a Japan Post upack result file (UTF-8 with BOM) from rows of UPACK_COLUMNS values."""
+    return write_csv_file(filename, UPACK_COLUMNS, rows, "utf-8-sig")
+
+
+def write_fukutsu_file(filename, rows):
+    """Write a Fukuyama Transporting result file (cp932, all fields quoted) from rows of FUKUTSU_COLUMNS values."""
+    return write_csv_file(filename, FUKUTSU_COLUMNS, rows, "cp932", quoting=csv.QUOTE_ALL, lineterminator="\r\n")
+
+
+def write_csv_file(filename, columns, rows, encoding, **csv_kwargs):
+    file_path, file_url = get_file_url(filename)
+    with open(file_path, "w", encoding=encoding, newline="") as f:
+        writer = csv.writer(f, **csv_kwargs)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([row.get(column, "") for column in columns] if isinstance(row, dict) else row)
+    return file_url
+
+
+def remove_file(file_url):
+    """Delete a file written by a test."""
+    file_path = get_file_path(file_url)
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+
+def read_csv_file(file_url, encoding):
+    with open(get_file_path(file_url), encoding=encoding, newline="") as f:
+        return list(csv.reader(f))
+
+
+@contextmanager
+def capture_realtime():
+    """Collect the realtime messages published while the block runs as {event: [message, ...]}."""
+    messages = {}
+
+    def publish_realtime(event=None, message=None, *args, **kwargs):
+        messages.setdefault(event, []).append(message)
+
+    with patch("frappe.publish_realtime", publish_realtime):
+        yield messages
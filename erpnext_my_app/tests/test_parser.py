@@ -0,0 +1,914 @@
+import csv
+import os
+from io import StringIO
+from unittest.mock import patch
+import frappe
+from frappe.utils import add_days, get_site_path, getdate, now_datetime, nowdate
+from frappe.utils.file_manager import get_file_path
+from frappe.tests.utils import FrappeTestCase
+from frappe.custom.doctype.custom_field.custom_field import create_custom_field
+from erpnext_my_app.parser.item_index import ItemIndex, split_skus
+from erpnext_my_app.parser.utils import (
+    COMPANY_NAME_DEFAULT,
+    EXPORT_DRAFT_MAX_DAYS,
+    ROW_LINES_FIELD,
+    SHARD_RESULT_EXPIRY,
+    group_rows,
+    iter_csv_rows,
+    iter_file_lines,
+    scan_row_keys,
+)
+from erpnext_my_app.parser.sharded_job import ShardedJob, merge_results, run_lane_shard
+from erpnext_my_app.parser.delivery_importer import DeliveryImporter, partition_by_delivery_note
+from erpnext_my_app.parser.upack import UpackParser
+from erpnext_my_app.parser.fukutsu import FukutsuParser
+from erpnext_my_app.parser.customer_index import CustomerIndex, normalize_phone, normalize_text, partition_by_buyer
+from erpnext_my_app.parser.order_importer import OrderImporter, get_state_name_from_pincode
+from erpnext_my_app.parser.postal_codes import PostalCodeIndex, get_postal_code_prefix
+from erpnext_my_app.parser.carrier_layouts import CarrierLayout, Column, get_carrier_layout
+from erpnext_my_app.parser.instrumentation import QueryProfile, StageTimer, get_query_kind, get_query_shape
+from erpnext_my_app.parser.csv_file import CsvFileWriter
+from erpnext_my_app.parser.delivery_exporter import DeliveryExporter
+from erpnext_my_app.parser.shipment_exporter import ShipmentExporter
+from erpnext_my_app.parser.checkpoint import ExportWatermark, ImportCheckpoint
+from erpnext_my_app.api import export_delivery_notes_to_csv_task, export_shipment_to_csv_task, import_orders, import_orders_task
+from erpnext_my_app.tests.fixtures import (
+    TEST_ITEM,
+    amazon_row,
+    capture_realtime,
+    make_customer,
+    make_delivery_note,
+    make_sales_order,
+    read_csv_file,
+    remove_file,
+    setup_test_data,
+    write_amazon_file,
+    write_fukutsu_file,
+    write_upack_file,
+)
+
+# 通道分片测试中记录执行过的分片（分片方法需要能被 pickle，定义在模块级）
+lane_calls = []
+
+
+def record_lane_call(batch_id, shard_no, user, value):
+    lane_calls.append((shard_no, value))
+
+
+class TestItemIndex(FrappeTestCase):
+    def setUp(self):
+        frappe.set_user("Administrator")
+
+        # 确保 custom_amazon_sku 字段存在
+        create_custom_field("Item", {
+            "fieldname": "custom_amazon_sku",
+            "label": "Amazon SKU",
+            "fieldtype": "Data",
+            "insert_after": "item_code",
+            "unique": 0,
+        })
+
+        # 顶层 Item Group
+        if not frappe.db.exists("Item Group", "All Item Groups"):
+            frappe.get_doc({
+                "doctype": "Item Group",
+                "item_group_name": "All Item Groups",
+                "is_group": 1
+            }).insert()
+
+        # 一个商品登记了多个亚马逊 SKU
+        if not frappe.db.exists("Item", "多SKU测试商品"):
+            frappe.get_doc({
+                "doctype": "Item",
+                "item_code": "多SKU测试商品",
+                "item_name": "多SKU测试商品",
+                "item_group": "All Item Groups",
+                "stock_uom": "Nos",
+                "is_stock_item": 0,
+                "custom_amazon_sku": "rs-100a, rs-100b、RS-100C"
+            }).insert()
+
+    def test_split_skus(self):
+        self.assertEqual(split_skus("a-1, b-2、c-3；d-4 e-5"), ["a-1", "b-2", "c-3", "d-4", "e-5"])
+        self.assertEqual(split_skus(""), [])
+        self.assertEqual(split_skus(None), [])
+
+    def test_resolve_skus(self):
+        index = ItemIndex()
+        index.resolve_skus(["rs-100a", "rs-100c", "100b", "not-exists", None])
+
+        self.assertEqual(index.get_item_code("rs-100a"), "多SKU测试商品")
+        # 大小写不敏感
+        self.assertEqual(index.get_item_code("rs-100c"), "多SKU测试商品")
+        # 与原来 like '%sku%' 一样支持包含匹配
+        self.assertEqual(index.get_item_code("100b"), "多SKU测试商品")
+        self.assertIsNone(index.get_item_code("not-exists"))
+
+    def tearDown(self):
+        # 回滚所有更改
+        frappe.db.rollback()
+
+
+class TestStreamingHelpers(FrappeTestCase):
+    def setUp(self):
+        self.file_path = get_site_path("public", "files", "stream-test.txt")
+
+    def tearDown(self):
+        # 删除测试写入站点的文件
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+    def test_iter_file_lines(self):
+        # 用很小的块读取，确保被截断的 shift_jis 多字节字符能正确解码
+        with open(self.file_path, "w", encoding="shift_jis", newline="") as f:
+            f.write("order-id\tsku\r\n注文-1\tあいう\r\n注文-2\tかきく")
+
+        lines = list(iter_file_lines("/files/stream-test.txt", "shift_jis", chunk_size=3))
+        self.assertEqual(lines, ["order-id\tsku\r\n", "注文-1\tあいう\r\n", "注文-2\tかきく"])
+
+    def test_group_rows(self):
+        rows = [
+            {"order-id": "A", "sku": "1"},
+            {"order-id": "A", "sku": "2"},
+            {"order-id": "B", "sku": "3"},
+            {"order-id": "", "sku": "4"},
+            {"order-id": "A", "sku": "5"},
+            {"order-id": "C", "sku": "1"},
+        ]
+        keys, split_keys, skus = scan_row_keys(rows, "order-id", "sku")
+        self.assertEqual(keys, {"A", "B", "C"})
+        self.assertEqual(split_keys, {"A"})
+        self.assertEqual(skus, {"1", "2", "3", "5"})
+
+        # 不连续的订单 A 在最后作为完整的一组产出
+        groups = [(key, [row["sku"] for row in group]) for key, group in group_rows(rows, "order-id", split_keys)]
+        self.assertEqual(groups, [("B", ["3"]), ("C", ["1"]), ("A", ["1", "2", "5"])])
+
+    def test_iter_csv_rows(self):
+        content = 'order-id,note\nA,1\nB,"2\n3"\nC,4\n'
+        rows = list(iter_csv_rows(StringIO(content)))
+        # 表头是第 0 行，带换行的字段占两行
+        self.assertEqual([(row["order-id"], row[ROW_LINES_FIELD]) for row in rows], [("A", (1, 2)), ("B", (2, 4)), ("C", (4, 5))])
+        self.assertEqual(rows[1]["note"], "2\n3")
+
+        # 从断点行开始读取，之前的行不解析
+        rows = list(iter_csv_rows(StringIO(content), 4))
+        self.assertEqual([(row["order-id"], row[ROW_LINES_FIELD]) for row in rows], [("C", (4, 5))])
+
+    def test_group_rows_resume_lines(self):
+        content = "order-id,sku\nA,1\nA,2\nB,3\nC,4\nB,5\nD,6\n"
+        keys, split_keys, _ = scan_row_keys(iter_csv_rows(StringIO(content)), "order-id")
+        groups = [(key, group.first_line, group.resume_line) for key, group in group_rows(iter_csv_rows(StringIO(content)), "order-id", split_keys)]
+        # 不连续的订单 B 最后才产出，断点不能越过它的第一行
+        self.assertEqual(groups, [("A", 1, 3), ("C", 3, 3), ("D", 3, 3), ("B", 3, 3)])
+
+    def test_csv_file_writer(self):
+        # tell() 返回已编码的字节数，无法编码的字符替换为 ?
+        writer = CsvFileWriter("csv-writer-test.csv", "cp932", quoting=csv.QUOTE_ALL)
+        try:
+            writer.writerow(["注文", "😀"])
+            self.assertEqual(writer.tell(), len('"注文","?"\r\n'.encode("cp932")))
+            writer.writerow(["a"])
+            writer.file.flush()
+            self.assertEqual(writer.tell(), os.path.getsize(writer.file_path))
+            with open(writer.file_path, encoding="cp932", newline="") as f:
+                self.assertEqual(f.read(), '"注文","?"\r\n"a"\r\n')
+        finally:
+            writer.discard()
+        self.assertFalse(os.path.exists(writer.file_path))
+
+
+class TestShardedJob(FrappeTestCase):
+    def test_merge_results(self):
+        result = merge_results([
+            {"status": "success", "errors": [], "platform": "amazon", "order_count": 3, "imported_count": 0},
+            {"status": "error", "errors": ["a"], "platform": "amazon", "imported_count": 1},
+            {"status": "success", "errors": ["b"], "platform": "amazon", "imported_count": 2},
+        ])
+        self.assertEqual(result, {
+            "status": "error",
+            "errors": ["a", "b"],
+            "platform": "amazon",
+            "order_count": 3,
+            "imported_count": 3,
+        })
+
+    def test_lane_shards(self):
+        job = ShardedJob("test_sharded_job", "Administrator")
+        lane_calls.clear()
+        try:
+            with patch("erpnext_my_app.parser.sharded_job.enqueue") as enqueue:
+                job.enqueue_lane_shard(record_lane_call, 0, 0, value="a")
+                job.enqueue_lane_shard(record_lane_call, 0, 1, value="b")
+                # 同一通道同时只有一个任务，第二个分片等第一个执行完再启动
+                self.assertEqual(enqueue.call_count, 1)
+                run_lane_shard(job.event, job.batch_id, 0)
+                self.assertEqual(enqueue.call_count, 2)
+                run_lane_shard(job.event, job.batch_id, 0)
+                self.assertEqual(enqueue.call_count, 2)
+            self.assertEqual(lane_calls, [(0, "a"), (1, "b")])
+            self.assertFalse(job.cache.exists(job._key("lane:0:running")))
+        finally:
+            job.cache.delete(job._key("lane:0"), job._key("lane:0:running"))
+
+    def test_results_expire(self):
+        # 协调任务没有登记总数（例如中途退出）时，分片结果也要能过期
+        job = ShardedJob("test_sharded_job", "Administrator")
+        job.finish_shard(0, {"status": "success", "imported_count": 1})
+        try:
+            self.assertEqual(job.cache.hgetall(job._name("results")), {"0": {"status": "success", "imported_count": 1}})
+            ttl = job.cache.ttl(job._key("results"))
+            self.assertGreater(ttl, 0)
+            self.assertLessEqual(ttl, SHARD_RESULT_EXPIRY)
+        finally:
+            job.cache.delete_value(job._name("results"))
+            job.cache.delete(job._key("done"))
+
+
+class TestDeliveryImporter(FrappeTestCase):
+    def setUp(self):
+        setup_test_data()
+        self.customer = make_customer("配送 三郎", email="haiso@example.com", phone="090-3333-4444")
+        self.files = []
+
+    def tearDown(self):
+        for file_url in self.files:
+            remove_file(file_url)
+        frappe.db.rollback()
+
+    def make_delivery_notes(self, *amazon_order_ids):
+        orders = []
+        for amazon_order_id in amazon_order_ids:
+            so = make_sales_order(self.customer, amazon_order_id)
+            orders.append((so, make_delivery_note(so)))
+        return orders
+
+    def write_file(self, write, filename, rows):
+        file_url = write(filename, rows)
+        self.files.append(file_url)
+        return file_url
+
+    def get_shipments(self, delivery_note):
+        return frappe.get_all(
+            "Shipment",
+            filters=[["Shipment", "docstatus", "=", 1], ["Shipment Delivery Note", "delivery_note", "=", delivery_note]],
+            pluck="awb_number",
+        )
+
+    def test_partition_by_delivery_note(self):
+        rows = [{"delivery_note_id": dn} for dn in ["DN1", "DN2", "DN1", "DN3", "DN4", "DN3", "DN5"]]
+        shards = list(partition_by_delivery_note(rows, 2, lanes=1))
+        # 只有一个桶时按顺序每凑满两条产出一个分片
+        self.assertEqual(
+            [[row["delivery_note_id"] for row in shard] for shard in shards],
+            [["DN1", "DN2"], ["DN1", "DN3"], ["DN4", "DN3"], ["DN5"]]
+        )
+
+        # 多个桶时每条记录只分配一次，分片不超过上限
+        shards = list(partition_by_delivery_note(rows * 2, 3))
+        self.assertEqual(sorted(row["delivery_note_id"] for shard in shards for row in shard), sorted(row["delivery_note_id"] for row in rows * 2))
+        self.assertTrue(all(len(shard) <= 3 for shard in shards))
+
+    def test_partition_by_delivery_note_streams(self):
+        consumed = []
+
+        def stream():
+            for n in range(10):
+                consumed.append(n)
+                yield {"delivery_note_id": "DN1"}
+
+        # 桶凑满一个分片就立即产出，不等整个文件解析完
+        shard = next(partition_by_delivery_note(stream(), 3))
+        self.assertEqual(len(shard), 3)
+        self.assertEqual(consumed, [0, 1, 2])
+
+    def test_resume_upack(self):
+        (so1, dn1), (so2, dn2) = self.make_delivery_notes("250-7000000-0000011", "250-7000000-0000012")
+        file_url = self.write_file(write_upack_file, "upack-resume-test.csv", [
+            ["111122223333", nowdate(), dn1.name, so1.amazon_order_id, "配送 三郎", "799-0704"],
+            ["444455556666", nowdate(), dn2.name, so2.amazon_order_id, "配送 三郎", "799-0704"],
+        ])
+        # 上次导入在第一条记录提交后被终止
+        records = list(DeliveryImporter("upack").iter_orders(file_url))
+        checkpoint = ImportCheckpoint("shipments", file_url, "delivery_note_id")
+        checkpoint.advance(records[0])
+        checkpoint.save()
+
+        # 再次提交同一文件时跳过断点之前的行，导入完成后删除断点
+        importer = DeliveryImporter("upack")
+        self.assertEqual(len(importer.import_orders(file_url)), 1)
+        self.assertEqual(importer.orders_count, 1)
+        self.assertEqual(self.get_shipments(dn1.name), [])
+        self.assertEqual(self.get_shipments(dn2.name), ["444455556666"])
+        self.assertIsNone(frappe.db.get_default(checkpoint.key))
+
+    def test_import_upack(self):
+        (so1, dn1), (so2, dn2) = self.make_delivery_notes("250-7000000-0000001", "250-7000000-0000002")
+        file_url = self.write_file(write_upack_file, "upack-import-test.csv", [
+            ["111122223333", nowdate(), dn1.name, so1.amazon_order_id, "配送 三郎", "799-0704"],
+            # 同一发货单的第二行视为重复，只取第一行
+            ["999999999999", nowdate(), dn1.name, so1.amazon_order_id, "配送 三郎", "799-0704"],
+            ["444455556666", nowdate(), dn2.name, so2.amazon_order_id, "配送 三郎", "799-0704"],
+            ["777788889999", nowdate(), "MAT-DN-MISSING-0001", "", "配送 三郎", "799-0704"],
+        ])
+
+        importer = DeliveryImporter("upack")
+        self.assertEqual(len(importer.import_orders(file_url)), 2)
+        self.assertEqual(importer.orders_count, 3)
+        self.assertEqual(importer.errors, ["发货单不存在： MAT-DN-MISSING-0001<br>"])
+        self.assertEqual(self.get_shipments(dn1.name), ["111122223333"])
+        self.assertEqual(self.get_shipments(dn2.name), ["444455556666"])
+        self.assertEqual(frappe.db.get_value("Sales Order", so1.name, "custom_tracking_number"), "111122223333 (upack)")
+        self.assertEqual(frappe.db.get_value("Sales Order", so2.name, "custom_tracking_number"), "444455556666 (upack)")
+
+        # 再次导入同一文件：已有装运单的发货单被跳过，不会重复创建
+        importer = DeliveryImporter("upack")
+        self.assertEqual(importer.import_orders(file_url), [])
+        self.assertEqual(importer.errors, [
+            f"发货单对应的装运单已经存在：{dn1.name}<br>",
+            f"发货单对应的装运单已经存在：{dn2.name}<br>",
+            "发货单不存在： MAT-DN-MISSING-0001<br>",
+        ])
+        self.assertEqual(self.get_shipments(dn1.name), ["111122223333"])
+
+    def test_import_across_preload_batches(self):
+        orders = self.make_delivery_notes("250-7000000-0000003", "250-7000000-0000004", "250-7000000-0000005")
+        file_url = self.write_file(write_upack_file, "upack-batch-test.csv", [
+            [f"12345678900{n}", nowdate(), dn.name, so.amazon_order_id, "配送 三郎", "799-0704"]
+            for n, (so, dn) in enumerate(orders)
+        ])
+
+        # 每批只预加载一条记录时，排队的快递单号也要跨批次保留并全部写入
+        with patch("erpnext_my_app.parser.delivery_importer.SHIPMENT_PRELOAD_BATCH_SIZE", 1):
+            importer = DeliveryImporter("upack")
+            self.assertEqual(len(importer.import_orders(file_url)), 3)
+        self.assertEqual(importer.errors, [])
+        for n, (so, dn) in enumerate(orders):
+            self.assertEqual(self.get_shipments(dn.name), [f"12345678900{n}"])
+            self.assertEqual(frappe.db.get_value("Sales Order", so.name, "custom_tracking_number"), f"12345678900{n} (upack)")
+
+    def test_import_fukutsu(self):
+        (so, dn), = self.make_delivery_notes("250-7000000-0000006")
+        # 福山通运的文件中发货单号和订单号前面带有单引号
+        file_url = self.write_file(write_fukutsu_file, "fukutsu-import-test.csv", [
+            ["987654321098", nowdate(), "配送 三郎", "799-0704", f"'{dn.name}", f"'{so.amazon_order_id}"],
+        ])
+
+        # 流式解析与一次读入整个文件的解析结果一致
+        records = DeliveryImporter("fukutsu").parse(file_url)
+        self.assertEqual(records, FukutsuParser(file_url).parse())
+        self.assertEqual(records, [{
+            "delivery_note_id": dn.name,
+            "amazon_order_id": so.amazon_order_id,
+            "tracking_no": "987654321098",
+            "carrier": "fukutsu",
+            "shipping_date": getdate(nowdate()),
+        }])
+
+        importer = DeliveryImporter("fukutsu")
+        self.assertEqual(len(importer.import_orders(file_url)), 1)
+        self.assertEqual(self.get_shipments(dn.name), ["987654321098"])
+        self.assertEqual(frappe.db.get_value("Sales Order", so.name, "custom_tracking_number"), "987654321098 (fukutsu)")
+
+    def test_stream_upack(self):
+        # 带 BOM 的 UTF-8 文件，流式解析与一次读入整个文件的解析结果一致
+        file_url = self.write_file(write_upack_file, "upack-stream-test.csv", [
+            ["111122223333", nowdate(), "MAT-DN-0001", "250-7000000-0000007", "配送 三郎", "799-0704"],
+            ["111122223333", nowdate(), "MAT-DN-0001", "250-7000000-0000007", "配送 三郎", "799-0704"],
+            ["", nowdate(), "", "", "", ""],
+            ["444455556666", "", "MAT-DN-0002", "250-7000000-0000008", "配送 三郎", "799-0704"],
+        ])
+        records = DeliveryImporter("upack").parse(file_url)
+        self.assertEqual(records, UpackParser(file_url).parse())
+        self.assertEqual([record["delivery_note_id"] for record in records], ["MAT-DN-0001", "MAT-DN-0002"])
+
+class TestCustomerIndex(FrappeTestCase):
+    def test_normalize(self):
+        self.assertEqual(normalize_phone("+81-90-1234-5678"), "09012345678")
+        self.assertEqual(normalize_phone("０９０ １２３４ ５６７８"), "09012345678")
+        self.assertEqual(normalize_phone("123"), "")
+        self.assertEqual(normalize_text(" 土居町津根２８４０ "), normalize_text("土居町津根 2840"))
+
+    def test_rollback(self):
+        index = CustomerIndex()
+        index.add_customer({"email": "a@example.com", "phone": ""}, "CUST-1")
+        index.savepoint()
+        index.add_customer({"email": "b@example.com", "phone": "090-1234-5678"}, "CUST-2")
+        index.add_address("CUST-2", {"pincode": "799-0704", "address_line1": "土居町"}, "ADDR-2")
+        index.rollback()
+        self.assertEqual(index.find_customer({"email": "a@example.com"}), "CUST-1")
+        self.assertIsNone(index.find_customer({"email": "b@example.com", "phone": "09012345678"}))
+        self.assertIsNone(index.find_address("CUST-2", {"pincode": "799-0704", "address_line1": "土居町"}))
+
+    def test_partition_by_buyer(self):
+        def order(order_id, email, phone):
+            return {"order_id": order_id, "customer": {"email": email, "phone": phone}}
+
+        # 订单 1、3 电话相同；订单 2、4 邮箱相同，订单 4、5 电话相同
+        orders = [
+            order("1", "a@example.com", "090-1111-1111"),
+            order("2", "b@example.com", ""),
+            order("3", "c@example.com", "09011111111"),
+            order("4", "B@example.com ", "080-2222-2222"),
+            order("5", "d@example.com", "+81 80 2222 2222"),
+            order("6", "e@example.com", ""),
+        ]
+        shards = list(partition_by_buyer(orders, 2, lanes=3))
+        lanes = {order["order_id"]: lane for lane, shard in shards for order in shard}
+        self.assertEqual(sorted(lanes), ["1", "2", "3", "4", "5", "6"])
+        self.assertEqual(lanes["1"], lanes["3"])
+        self.assertEqual({lanes["2"], lanes["4"], lanes["5"]}, {lanes["2"]})
+        self.assertTrue(all(len(shard) <= 2 for lane, shard in shards))
+
+    def test_partition_by_buyer_streams(self):
+        consumed = []
+
+        def stream():
+            for n in range(10):
+                consumed.append(n)
+                yield {"order_id": str(n), "customer": {"email": "same@example.com"}}
+
+        # 通道凑满一个分片就立即产出，不等整个文件解析完
+        shards = partition_by_buyer(stream(), 3)
+        lane, shard = next(shards)
+        self.assertEqual([order["order_id"] for order in shard], ["0", "1", "2"])
+        self.assertEqual(consumed, [0, 1, 2])
+
+    def test_preload_phone_formats(self):
+        # 已保存的电话与文件中的电话格式不同，也要能找到已有客户
+        setup_test_data()
+        hyphenated = make_customer("電話 太郎", phone="090-1234-5678")
+        international = make_customer("電話 花子", phone="+81 (80) 1111-2222")
+        index = CustomerIndex()
+        index.preload([
+            {"customer": {"email": "", "phone": "09012345678"}},
+            {"customer": {"email": "", "phone": "080-1111-2222"}},
+        ])
+        self.assertEqual(index.find_customer({"phone": "090 1234 5678"}), hyphenated.customer)
+        self.assertEqual(index.find_customer({"phone": "０８０１１１１２２２２"}), international.customer)
+
+    def test_preload_email_case(self):
+        # 已保存的邮箱与文件中的邮箱大小写不同，也要能找到已有客户
+        setup_test_data()
+        mixed = make_customer("メール 次郎", email="Mail.Jiro@Example.com")
+        index = CustomerIndex()
+        index.preload([{"customer": {"email": " mail.jiro@example.COM ", "phone": ""}}])
+        self.assertEqual(index.find_customer({"email": "MAIL.JIRO@example.com"}), mixed.customer)
+
+    def tearDown(self):
+        # 回滚所有更改
+        frappe.db.rollback()
+
+
+class TestPostalCodes(FrappeTestCase):
+    def test_japanese_postal_codes(self):
+        self.assertEqual(get_state_name_from_pincode("JP", "799-0704", ""), "愛媛県")
+        self.assertEqual(get_state_name_from_pincode("JP", "１００－０００１", "Tokyo"), "東京都")
+        self.assertEqual(get_state_name_from_pincode("JP", "0600001", None), "北海道")
+        self.assertEqual(get_state_name_from_pincode("JP", "0100001", None), "秋田県")
+        # 手工录入的邮编：带〒标记、全角数字
+        self.assertEqual(get_state_name_from_pincode("JP", "〒７９９－０７０４", None), "愛媛県")
+        self.assertEqual(get_state_name_from_pincode("JP", " 〒 100-0001", None), "東京都")
+        # 文件中已经是规范的都道府县名称时保持不变
+        self.assertEqual(get_state_name_from_pincode("JP", "4980001", "三重県"), "三重県")
+        # 无法识别的邮编返回原来的州
+        self.assertEqual(get_state_name_from_pincode("JP", "12345", "大阪"), "大阪")
+
+    def test_get_postal_code_prefix(self):
+        self.assertEqual(get_postal_code_prefix("〒７９９ー０７０４", 7), 799)
+        self.assertEqual(get_postal_code_prefix("〶060-0001", 7), 60)
+        self.assertIsNone(get_postal_code_prefix("〒12345", 7))
+
+    def test_overlapping_ranges(self):
+        index = PostalCodeIndex({"A": (100, 199), "B": ((150, 160), (300, 399)), "C": (200, 200)})
+        self.assertEqual(index.lookup(99), [])
+        self.assertEqual(index.lookup(100), ["A"])
+        self.assertEqual(index.lookup(155), ["A", "B"])
+        self.assertEqual(index.lookup(161), ["A"])
+        self.assertEqual(index.lookup(200), ["C"])
+        self.assertEqual(index.lookup(250), [])
+        self.assertEqual(index.lookup(399), ["B"])
+        self.assertEqual(index.lookup(400), [])
+
+
+class TestCarrierLayouts(FrappeTestCase):
+    def test_build_row(self):
+        layout = CarrierLayout([
+            Column("ID", "dn_name"),
+            Column("电话", ("address_phone", "customer_phone"), "000"),
+            Column("固定", default=1),
+            Column("数量", "item_count", 0, formatter=int),
+        ])
+        self.assertEqual(layout.headers, ["ID", "电话", "固定", "数量"])
+        self.assertEqual(layout.build_row({"dn_name": "DN1", "customer_phone": "090", "item_count": 2.0}), ["DN1", "090", 1, 2])
+        self.assertEqual(layout.build_row({"address_phone": "080", "customer_phone": "090"}), ["", "080", 1, 0])
+        self.assertEqual(layout.build_row({}), ["", "000", 1, 0])
+
+    def test_get_carrier_layout(self):
+        self.assertEqual(get_carrier_layout("fukutsu").encoding, "cp932")
+        self.assertIs(get_carrier_layout("unknown"), get_carrier_layout("upack"))
+
+
+class TestStageTimer(FrappeTestCase):
+    def test_nested_stages(self):
+        timer = StageTimer("test")
+        wrappers = set()
+        for _ in timer.iterate("parse", range(2)):
+            with timer.stage("create"):
+                # 计数器只在第一个阶段开始时安装一次
+                wrappers.add(vars(frappe.local.db)["sql"])
+                frappe.db.sql("select 1")
+                with timer.stage("submit"):
+                    frappe.db.sql("select 1")
+                    frappe.db.sql("select 1")
+        summary = timer.summary()
+        # 迭代结束的那次调用也计入 parse
+        self.assertEqual(summary["stages"]["parse"]["calls"], 3)
+        # 子阶段的查询不计入父阶段
+        self.assertEqual(summary["stages"]["create"]["queries"], 2)
+        self.assertEqual(summary["stages"]["submit"]["queries"], 4)
+        self.assertEqual(summary["queries"], 6)
+        self.assertEqual(len(wrappers), 1)
+        self.assertNotIn("sql", vars(frappe.local.db))
+
+    def test_counters_uninstall_in_any_order(self):
+        timer = StageTimer("test")
+        with timer.stage("load"):
+            profile = QueryProfile().install()
+            frappe.db.sql("select 1")
+        # 计时器先结束，性能分析器仍然计数
+        timer.summary()
+        frappe.db.sql("select 1")
+        profile.uninstall()
+        self.assertEqual(timer.summary()["queries"], 1)
+        self.assertEqual(profile.count, 2)
+        self.assertNotIn("sql", vars(frappe.local.db))
+
+
+class TestDeliveryExporter(FrappeTestCase):
+    def setUp(self):
+        setup_test_data()
+        self.customer = make_customer("出荷 太郎", email="shukka@example.com", phone="090-1111-2222")
+        self.files = []
+        # 每个测试都从没有水位开始
+        frappe.defaults.clear_default(key=ExportWatermark("delivery_notes", "upack").key)
+
+    def tearDown(self):
+        for file_url in self.files:
+            remove_file(file_url)
+        frappe.db.rollback()
+
+    def make_order(self, amazon_order_id, submit_delivery_note=True):
+        so = make_sales_order(self.customer, amazon_order_id)
+        return so, make_delivery_note(so, submit=submit_delivery_note)
+
+    def export(self, **kwargs):
+        with capture_realtime() as messages:
+            export_delivery_notes_to_csv_task(**kwargs)
+        result = messages["export_delivery_completed"][-1]["result"]
+        if result["file_url"]:
+            self.files.append(result["file_url"])
+        return result
+
+    def exported_delivery_notes(self, **kwargs):
+        result = self.export(carrier="upack", incremental=1, **kwargs)
+        if not result["file_url"]:
+            return []
+        return [row[0] for row in read_csv_file(result["file_url"], "utf-8")[1:]]
+
+    def export_rows(self, carrier, sale_order_ids):
+        layout = get_carrier_layout(carrier)
+        exporter = DeliveryExporter(carrier, ignore_pending_orders=False)
+        file_doc = exporter.export(sale_order_ids)
+        self.files.append(file_doc.file_url)
+        return exporter, read_csv_file(file_doc.file_url, layout.encoding)
+
+    def test_export_rows(self):
+        so, dn = self.make_order("250-8000000-0000011")
+        pending = make_sales_order(self.customer, "250-8000000-0000012")
+        now = nowdate().replace("-", "")
+        item = f"{TEST_ITEM}*1.0"
+
+        # 有发货单的订单按发货单打印，没有发货单的订单按销售订单的商品打印
+        exporter, rows = self.export_rows("upack", [so.name, pending.name])
+        self.assertEqual(exporter.errors, [])
+        self.assertEqual(rows, [
+            get_carrier_layout("upack").headers,
+            [dn.name, "250-8000000-0000011", "出荷 太郎", "", "出荷 太郎", "090-1111-2222",
+             "土居町津根2840", "四国中央市", "愛媛県", "799-0704", f" {item}", "1",
+             COMPANY_NAME_DEFAULT, "0896-22-4988", "土居町津根2840", "四国中央市", "爱媛県", "799-0704", "", ""],
+            ["", "250-8000000-0000012", "出荷 太郎", "", "出荷 太郎", "090-1111-2222",
+             "土居町津根2840", "四国中央市", "愛媛県", "799-0704", f" {item}", "1",
+             COMPANY_NAME_DEFAULT, "0896-22-4988", "土居町津根2840", "四国中央市", "爱媛県", "799-0704", "", ""],
+        ])
+
+        exporter, rows = self.export_rows("fukutsu", [so.name, pending.name])
+        self.assertEqual(exporter.errors, [])
+        self.assertEqual(rows, [
+            get_carrier_layout("fukutsu").headers,
+            ["", "090-1111-2222", "土居町津根2840", "四国中央市", "愛媛県", "出荷 太郎", "出荷 太郎", "799-0704", "0",
+             "", "1896224988", "", "1", "", "", "", "",
+             item, "", "", "われもの注意", dn.name, "250-8000000-0000011",
+             "", "", "", "1", "0", now, ""],
+            ["", "090-1111-2222", "土居町津根2840", "四国中央市", "愛媛県", "出荷 太郎", "出荷 太郎", "799-0704", "0",
+             "", "1896224988", "", "1", "", "", "", "",
+             item, "", "", "", "", "250-8000000-0000012",
+             "", "", "", "1", "0", now, ""],
+        ])
+        # fukutsu 的文件每个字段都加引号
+        with open(get_file_path(self.files[-1]), encoding="cp932", newline="") as f:
+            self.assertTrue(f.readline().startswith('"荷受人コード","電話番号",'))
+
+    def test_export_unknown_sales_order(self):
+        so, dn = self.make_order("250-8000000-0000013")
+        pending = make_sales_order(self.customer, "250-8000000-0000014")
+
+        # 批量装载时找不到的销售订单只记录错误，其余订单照常导出
+        exporter, rows = self.export_rows("upack", [so.name, "SAL-ORD-MISSING-0001", pending.name])
+        self.assertEqual(exporter.errors, ["销售订单未找到: SAL-ORD-MISSING-0001<br>"])
+        self.assertEqual(exporter.count, 2)
+        self.assertEqual(
+            [(row[0], row[1], row[10], row[11]) for row in rows[1:]],
+            [(dn.name, "250-8000000-0000013", f" {TEST_ITEM}*1.0", "1"), ("", "250-8000000-0000014", f" {TEST_ITEM}*1.0", "1")],
+        )
+
+    def test_incremental_first_run(self):
+        self.make_order("250-8000000-0000001")
+        # 第一次增量导出不导出历史发货单，只把水位设为现在
+        self.assertEqual(self.exported_delivery_notes(), [])
+        self.assertIsNotNone(ExportWatermark("delivery_notes", "upack").value)
+
+        so, dn = self.make_order("250-8000000-0000002")
+        self.assertEqual(self.exported_delivery_notes(), [dn.name])
+        self.assertEqual(self.exported_delivery_notes(), [])
+
+    def test_incremental_from_date(self):
+        so, dn = self.make_order("250-8000000-0000003")
+        # 第一次增量导出指定了起始日期时，从该日期开始导出
+        self.assertIn(dn.name, self.exported_delivery_notes(filters={"from_date": nowdate()}))
+
+    def test_incremental_modified_after_export(self):
+        self.exported_delivery_notes()
+        so, dn = self.make_order("250-8000000-0000004")
+        self.assertEqual(self.exported_delivery_notes(), [dn.name])
+
+        # 开票等后续操作会更新已导出发货单的 modified，不能因此重复打印面单
+        frappe.db.set_value("Delivery Note", dn.name, "per_billed", 100)
+        self.assertEqual(self.exported_delivery_notes(), [])
+
+    def test_incremental_late_submitted_draft(self):
+        so, draft = self.make_order("250-8000000-0000005", submit_delivery_note=False)
+        self.exported_delivery_notes()
+        so, dn = self.make_order("250-8000000-0000006")
+        self.assertEqual(self.exported_delivery_notes(), [dn.name])
+
+        # 水位之前创建、之后才提交的发货单也要导出
+        draft.submit()
+        self.assertEqual(self.exported_delivery_notes(), [draft.name])
+
+    def test_incremental_draft_bounds(self):
+        so, stale = self.make_order("250-8000000-0000007", submit_delivery_note=False)
+        so, deleted = self.make_order("250-8000000-0000008", submit_delivery_note=False)
+        so, pending = self.make_order("250-8000000-0000009", submit_delivery_note=False)
+        # 创建时间超过保留天数的草稿不再记录
+        frappe.db.set_value("Delivery Note", stale.name, "creation", add_days(now_datetime(), -EXPORT_DRAFT_MAX_DAYS - 1), update_modified=False)
+        self.exported_delivery_notes()
+        drafts = ExportWatermark("delivery_notes", "upack").value["drafts"]
+        self.assertNotIn(stale.name, drafts)
+        self.assertIn(deleted.name, drafts)
+        self.assertIn(pending.name, drafts)
+
+        # 已删除的草稿不再带到下一次；上次水位到新水位之间新建的草稿加入
+        frappe.delete_doc("Delivery Note", deleted.name)
+        so, new = self.make_order("250-8000000-0000010", submit_delivery_note=False)
+        so, dn = self.make_order("250-8000000-0000015")
+        self.assertEqual(self.exported_delivery_notes(), [dn.name])
+        drafts = ExportWatermark("delivery_notes", "upack").value["drafts"]
+        self.assertNotIn(deleted.name, drafts)
+        self.assertIn(pending.name, drafts)
+        self.assertIn(new.name, drafts)
+
+
+class TestOrderImporter(FrappeTestCase):
+    def setUp(self):
+        setup_test_data()
+        self.order_ids = ["250-9000000-0000001", "250-9000000-0000002"]
+        self.file_url = write_amazon_file("order-import-test.txt", [amazon_row(order_id) for order_id in self.order_ids])
+
+    def tearDown(self):
+        remove_file(self.file_url)
+        frappe.db.rollback()
+
+    def test_reimport(self):
+        self.assertEqual(len(OrderImporter("amazon").import_orders(self.file_url)), 2)
+
+        # 任务超时后重新提交同一个文件：已提交的订单在解析阶段被一次批量查询剔除
+        importer = OrderImporter("amazon")
+        with QueryProfile() as profile:
+            self.assertEqual(importer.import_orders(self.file_url), [])
+        self.assertEqual(importer.orders_count, 2)
+        self.assertEqual(importer.errors, [f"电商订单已经导入：{order_id}<br>" for order_id in self.order_ids])
+        self.assertEqual(profile.kinds["insert"], 0)
+
+    def test_resume(self):
+        # 上次导入在第一个订单提交后被终止
+        orders = list(OrderImporter("amazon").iter_orders(self.file_url))
+        checkpoint = ImportCheckpoint("orders", self.file_url, "order_id")
+        checkpoint.advance(orders[0])
+        checkpoint.save()
+
+        # 再次提交同一文件时，断点之前的订单不再扫描和解析
+        importer = OrderImporter("amazon")
+        self.assertEqual(len(importer.import_orders(self.file_url)), 1)
+        self.assertEqual(importer.orders_count, 1)
+        self.assertFalse(frappe.db.exists("Sales Order", {"amazon_order_id": self.order_ids[0]}))
+        self.assertTrue(frappe.db.exists("Sales Order", {"amazon_order_id": self.order_ids[1]}))
+        self.assertIsNone(frappe.db.get_default(checkpoint.key))
+
+    def test_dry_run(self):
+        imported = make_sales_order(make_customer("既存 次郎", phone="090-7777-8888"), "250-9000000-0000009")
+        order_ids = ["250-9000000-0000006", "250-9000000-0000007", "250-9000000-0000008", imported.amazon_order_id]
+        file_url = write_amazon_file("order-dry-run-test.txt", [
+            amazon_row(order_ids[0]),
+            amazon_row(order_ids[1], sku="not-a-test-sku"),
+            amazon_row(order_ids[2], ship_address_1="", ship_postal_code=""),
+            amazon_row(order_ids[3]),
+        ])
+        self.addCleanup(remove_file, file_url)
+        doctypes = ("Sales Order", "Customer", "Address", "Contact")
+        counts = {doctype: frappe.db.count(doctype) for doctype in doctypes}
+
+        # 预检只报告每个订单的问题，不创建任何单据
+        report = import_orders(file_url, platform="amazon", dry_run=1)
+        self.assertEqual(report["status"], "error")
+        self.assertTrue(report["dry_run"])
+        self.assertEqual(report["order_count"], 4)
+        self.assertEqual(report["valid_count"], 1)
+        self.assertEqual(sorted(report["orders"], key=lambda order: order["order_id"]), [
+            {"order_id": order_ids[1], "unmatched_skus": ["not-a-test-sku"]},
+            {"order_id": order_ids[2], "missing_address": ["pincode", "address_line1"]},
+            {"order_id": order_ids[3], "already_imported": True},
+        ])
+        self.assertEqual({doctype: frappe.db.count(doctype) for doctype in doctypes}, counts)
+
+    def test_failed_order_rollback(self):
+        order_ids = ["250-9000000-0000003", "250-9000000-0000004", "250-9000000-0000005"]
+        buyer = {"buyer": "巻戻 花子", "email": "makimodoshi@example.com", "phone": "090-5555-6666"}
+        file_url = write_amazon_file("order-rollback-test.txt", [
+            amazon_row(order_ids[0]),
+            amazon_row(order_ids[1], **buyer),
+            amazon_row(order_ids[2], **buyer),
+        ])
+        self.addCleanup(remove_file, file_url)
+
+        importer = OrderImporter("amazon")
+        orders = list(importer.iter_orders(file_url))
+        # 第二个订单在为新买家创建客户、地址和联系人之后，插入销售订单时失败
+        orders[1]["items"][0]["item_code"] = "不存在的测试商品"
+        created = importer.create_orders(orders)
+
+        self.assertEqual(len(created), 2)
+        self.assertEqual(len(importer.errors), 1)
+        self.assertTrue(importer.errors[0].startswith(f"电商订单导入失败：{order_ids[1]} "))
+        self.assertFalse(frappe.db.exists("Sales Order", {"amazon_order_id": order_ids[1]}))
+        self.assertTrue(frappe.db.exists("Sales Order", {"amazon_order_id": order_ids[0]}))
+
+        # 失败订单新建的客户被回滚，同一买家的下一个订单重新创建客户，且只创建一次
+        customers = frappe.get_all("Customer", filters={"custom_phone": "090-5555-6666"}, pluck="name")
+        self.assertEqual(len(customers), 1)
+        self.assertEqual(frappe.db.get_value("Sales Order", {"amazon_order_id": order_ids[2]}, "customer"), customers[0])
+        self.assertEqual(frappe.db.count("Address", {"address_title": f"{customers[0]} - Shipping"}), 1)
+
+
+class TestShipmentExporter(FrappeTestCase):
+    def test_assemble(self):
+        # 并行渲染的各块按顺序拼接，再按大小上限拆分成都带表头的文件
+        part_paths = []
+        for part in range(3):
+            writer = CsvFileWriter("shipment-part-test.part", "shift_jis", is_private=1, delimiter="\t")
+            writer.writerows([[f"250-{part}-{n}", "B0ABCDEFGH", 1] for n in range(4)])
+            part_paths.append(writer.close())
+
+        files = ShipmentExporter("amazon", max_bytes=300).assemble(part_paths)
+        for file_doc in files:
+            self.addCleanup(remove_file, file_doc.file_url)
+        contents = [read_csv_file(file_doc.file_url, "shift_jis") for file_doc in files]
+        self.assertGreater(len(files), 1)
+        self.assertTrue(all(rows[1][0].startswith("注文番号") for rows in contents))
+        self.assertEqual(
+            [row[0] for rows in contents for row in rows[2:]],
+            [f"250-{part}-{n}\tB0ABCDEFGH\t1" for part in range(3) for n in range(4)]
+        )
+        self.assertFalse(any(os.path.exists(path) for path in part_paths))
+
+
+class TestQueryProfile(FrappeTestCase):
+    def test_query_shape(self):
+        self.assertEqual(
+            get_query_shape("select `name` from `tabItem`\n where `name` in ('a', 'b''c') and qty > 2 limit %s"),
+            "select `name` from `tabitem` where `name` in (?) and qty > ? limit ?",
+        )
+        self.assertEqual(get_query_shape("select 1 where x in (1, 2)"), get_query_shape("select 5 where x in (3)"))
+        self.assertEqual(get_query_kind(" SAVEPOINT erpnext_my_app_import_record"), "transaction")
+        self.assertEqual(get_query_kind("(select 1)"), "select")
+
+    def test_repeated_shapes(self):
+        with QueryProfile() as profile:
+            for name in ("a", "b", "c"):
+                frappe.db.sql("select name from `tabItem` where name = %s", name)
+            frappe.db.sql("select count(*) from `tabItem`")
+        self.assertEqual(profile.count, 4)
+        self.assertEqual(profile.kinds["select"], 4)
+        self.assertEqual(profile.repeated_shapes(), [("select name from `tabitem` where name = ?", 3)])
+        profile.assert_within(3, 2)
+        self.assertRaises(AssertionError, profile.assert_within, 3, 1)
+        self.assertRaises(AssertionError, profile.assert_within, 3, 2, max_repeats=2)
+
+
+class TestQueryBudget(FrappeTestCase):
+    # 记录数足够多时，逐条查询（N+1）的语句形状会执行 RECORDS 次以上
+    RECORDS = 20
+
+    def setUp(self):
+        setup_test_data()
+        self.customer = make_customer("予算 四郎", email="yosan@example.com", phone="090-4444-5555")
+        self.files = []
+
+    def tearDown(self):
+        for file_url in self.files:
+            remove_file(file_url)
+        frappe.db.rollback()
+
+    def run_task(self, task, event, **kwargs):
+        with capture_realtime() as messages:
+            task(user="Administrator", **kwargs)
+        result = messages[event][-1]["result"]
+        self.files += result.get("file_urls") or [result["file_url"]]
+        return result
+
+    def profile_task(self, task, event, **kwargs):
+        # 先执行一次加载 DocType 元数据等缓存，只统计第二次执行的查询
+        self.run_task(task, event, **kwargs)
+        with QueryProfile() as profile:
+            result = self.run_task(task, event, **kwargs)
+        return result, profile
+
+    def test_export_tasks(self):
+        sale_order_ids = []
+        records = []
+        for n in range(self.RECORDS):
+            so = make_sales_order(self.customer, f"250-6000000-{n:07d}")
+            dn = make_delivery_note(so)
+            sale_order_ids.append(so.name)
+            records.append({"delivery_note_id": dn.name, "tracking_no": f"55556666{n:04d}", "carrier": "upack", "shipping_date": getdate()})
+        self.assertEqual(len(DeliveryImporter("upack").create_shipments(records)), self.RECORDS)
+
+        for task, event, kwargs in (
+            (export_delivery_notes_to_csv_task, "export_delivery_completed", {"carrier": "upack"}),
+            (export_delivery_notes_to_csv_task, "export_delivery_completed", {"carrier": "fukutsu"}),
+            (export_shipment_to_csv_task, "export_shipments_completed", {"platform": "amazon"}),
+        ):
+            result, profile = self.profile_task(task, event, sale_order_ids=sale_order_ids, **kwargs)
+            self.assertEqual(result["errors"], [])
+            self.assertEqual(result["imported_count"], self.RECORDS)
+            # 查询次数与订单数无关：只有固定数量的批量查询和保存文件的查询
+            profile.assert_within(self.RECORDS, 2)
+            self.assertEqual(profile.repeated_shapes(self.RECORDS), [])
+
+    def test_parallel_shipment_export(self):
+        records = []
+        for n in range(self.RECORDS):
+            dn = make_delivery_note(make_sales_order(self.customer, f"250-6200000-{n:07d}"))
+            records.append({"delivery_note_id": dn.name, "tracking_no": f"66667777{n:04d}", "carrier": "upack", "shipping_date": getdate()})
+        DeliveryImporter("upack").create_shipments(records)
+        criteria = {"from_date": nowdate()}
+        expected = self.run_task(export_shipment_to_csv_task, "export_shipments_completed", filters=criteria)
+
+        # 按主键范围分成小块并行渲染（此处在当前进程中依次执行），拼接结果与直接导出相同
+        with patch("erpnext_my_app.api.SHIPMENT_EXPORT_CHUNK_SIZE", 7), \
+                patch("erpnext_my_app.parser.sharded_job.enqueue", lambda method, queue, timeout, **kwargs: method(**kwargs)):
+            result = self.run_task(export_shipment_to_csv_task, "export_shipments_completed", filters=criteria)
+        self.assertEqual(result["errors"], expected["errors"])
+        self.assertEqual(result["imported_count"], expected["imported_count"])
+        self.assertEqual(
+            [row for file_url in result["file_urls"] for row in read_csv_file(file_url, "shift_jis")],
+            [row for file_url in expected["file_urls"] for row in read_csv_file(file_url, "shift_jis")]
+        )
+
+    def test_import_orders_task(self):
+        order_ids = [f"250-6100000-{n:07d}" for n in range(self.RECORDS)]
+        file_url = write_amazon_file("order-budget-test.txt", [amazon_row(order_id) for order_id in order_ids])
+        self.files.append(file_url)
+
+        result = self.run_task(import_orders_task, "import_orders_completed", file_url=file_url, platform="amazon")
+        self.assertEqual(result["errors"], [])
+        self.assertEqual(result["imported_count"], self.RECORDS)
+
+        # 重新导入同一文件：已导入的订单、SKU 和商品都由批量查询处理，每种语句只执行一次
+        with QueryProfile() as profile:
+            result = self.run_task(import_orders_task, "import_orders_completed", file_url=file_url, platform="amazon")
+        self.assertEqual(result["imported_count"], 0)
+        self.assertEqual(len(result["errors"]), self.RECORDS)
+        self.assertEqual(profile.kinds["insert"], 0)
+        profile.assert_within(self.RECORDS, 0.5, max_repeats=1)
+        self.assertEqual(profile.repeated_shapes(), [])